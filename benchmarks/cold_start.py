@@ -0,0 +1,109 @@
+"""
+Import-time benchmark guarding the cold start of ANOTAR.
+
+Every module the app and the CLI start from is imported in a fresh interpreter,
+a few times, and the fastest run is reported. Provider SDKs, OCR, PDF, image,
+HTTP and NumPy libraries must not be loaded by the import itself: they are
+pulled in by the first request that needs them.
+
+``main`` and the Streamlit pages run once on import, as in a bare Streamlit
+session, so they need streamlit installed. Background work they start, like the
+OCR warm-up, is waited for before the loaded libraries are checked.
+
+Run from the repository root:
+
+    python benchmarks/cold_start.py --budget 0.5
+
+Exits with status 1 when an import takes longer than the budget or loads one of
+the deferred libraries.
+"""
+import argparse, json, os, subprocess, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    "utils.llm", "utils.preprocess", "utils.obsidian", "utils.pipeline", "cli",
+    "main", "pages.notes", "pages.explorer", "pages.settings",
+]
+
+# Loaded on first use only
+DEFERRED = ["openai", "groq", "ollama", "mistralai", "google.generativeai", "easyocr", "torch", "pypdfium2", "PIL", "httpx", "numpy"]
+
+PROBE = """
+import sys, time, json, threading
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+for thread in threading.enumerate():
+    if thread.name == "ocr-warm-up":
+        thread.join()
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {deferred!r} if name in sys.modules]}}))
+"""
+
+
+def measure(module, repeat):
+    """
+    Import ``module`` in ``repeat`` fresh interpreters.
+
+    Returns:
+        dict: Fastest import time in ``seconds`` and the deferred libraries it ``loaded``,
+            or the ``error`` the import failed with
+    """
+    best = None
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, deferred=DEFERRED)],
+            cwd=ROOT, capture_output=True, text=True,
+        )
+        if process.returncode:
+            return {"error": process.stderr.strip().splitlines()[-1] if process.stderr.strip() else f"exit status {process.returncode}"}
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+
+def slowest_imports(module, count):
+    """The ``count`` imports that take longest, cumulatively, when importing ``module`` (from ``-X importtime``)."""
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT, capture_output=True, text=True)
+    timings = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        timings.append((int(cumulative), name.strip()))
+    return sorted(timings, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long ANOTAR's entry modules take to import.")
+    parser.add_argument("modules", nargs="*", default=MODULES, help="Modules to import (default: the app and CLI entry modules)")
+    parser.add_argument("--budget", type=float, default=0.5, help="Seconds an import may take (default: 0.5)")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters per module, the fastest counts (default: 3)")
+    parser.add_argument("--top", type=int, default=0, help="Also list the N slowest imports of each module")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        result = measure(module, max(1, args.repeat))
+        if "error" in result:
+            print(f"{module:<20} could not be imported: {result['error']}")
+            failed = True
+            continue
+
+        problems = []
+        if result["seconds"] > args.budget:
+            problems.append(f"over the {args.budget:.2f}s budget")
+        if result["loaded"]:
+            problems.append(f"loads {', '.join(result['loaded'])}")
+        failed = failed or bool(problems)
+        print(f"{module:<20} {result['seconds'] * 1000:8.1f} ms  {'; '.join(problems) or 'ok'}")
+
+        for microseconds, name in slowest_imports(module, args.top) if args.top else ():
+            print(f"    {microseconds / 1000:8.1f} ms  {name}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import argparse, glob, logging, os, sys, time
+from utils.pipeline import take_notes, LocalFile, STAGES
+
+SUPPORTED_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg")
+
+
+def collect_inputs(patterns):
+    """
+    Expand files, directories (recursively) and glob patterns into the supported files they name.
+
+    Args:
+        patterns (list): Paths, directories or glob patterns given on the command line
+
+    Returns:
+        list: Paths of PDFs and images, without duplicates
+    """
+    paths = []
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True) or [pattern]
+        for match in matches:
+            if os.path.isdir(match):
+                for root, dirs, files in os.walk(match):
+                    dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                    paths.extend(os.path.join(root, name) for name in sorted(files))
+            elif os.path.isfile(match):
+                paths.append(match)
+            else:
+                print(f"Skipping '{match}': no such file or directory", file=sys.stderr)
+    return [path for path in dict.fromkeys(paths) if path.lower().endswith(SUPPORTED_EXTENSIONS)]
+
+
+def _print_summary(results, elapsed):
+    succeeded = sum(1 for result in results if result["note_path"])
+    failed = len(results) - succeeded
+    print()
+    print(f"Processed {len(results)} file(s) in {elapsed:.1f}s: {succeeded} succeeded, {failed} failed")
+    if elapsed > 0:
+        print(f"Throughput: {succeeded / elapsed * 60:.1f} files/min")
+    print(f"{'stage':<14}{'files':>7}{'total s':>10}{'mean s':>9}{'p50 s':>9}{'max s':>9}")
+    for stage in STAGES:
+        timings = sorted(result["timings"][stage] for result in results if stage in result["timings"])
+        if not timings:
+            continue
+        print(f"{stage:<14}{len(timings):>7}{sum(timings):>10.1f}{sum(timings) / len(timings):>9.2f}{timings[len(timings) // 2]:>9.2f}{timings[-1]:>9.2f}")
+    for result in results:
+        if result["error"] is not None:
+            print(f"FAILED {result['name']}: {result['error']}", file=sys.stderr)
+
+
+def run_batch(args):
+    from utils.obsidian import get_vault_path
+
+    paths = collect_inputs(args.inputs)
+    if not paths:
+        print("No PDFs or images found.", file=sys.stderr)
+        return 1
+
+    vault_path = args.vault or get_vault_path()[0]
+    titles = args.title or [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    workers = {"preprocessed": args.preprocess_workers, "generated": args.concurrency, "formatted": args.concurrency}
+    workers = {stage: count for stage, count in workers.items() if count}
+
+    print(f"Taking notes for {len(paths)} file(s) into {vault_path}")
+
+    def on_progress(i, stage, error=None):
+        if stage == "written":
+            print(f"[{i + 1}/{len(paths)}] {paths[i]}: done")
+        elif stage == "failed":
+            print(f"[{i + 1}/{len(paths)}] {paths[i]}: failed ({error})")
+        elif args.verbose:
+            print(f"[{i + 1}/{len(paths)}] {paths[i]}: {stage}")
+
+    started = time.perf_counter()
+    results = take_notes(
+        [LocalFile(path) for path in paths],
+        title=titles,
+        vault_path=vault_path,
+        model_generation=args.generation_model,
+        model_formatting=args.formatting_model or args.generation_model,
+        ocr_enhance=args.ocr,
+        use_cache=not args.no_cache,
+        hedge=args.hedge,
+        workers=workers,
+        on_progress=on_progress,
+    )
+    _print_summary(results, time.perf_counter() - started)
+    return 0 if all(result["note_path"] for result in results) else 2
+
+
+def run_watch(args):
+    from utils.obsidian import get_vault_path
+    from utils.watcher import InboxWatcher, WATCHER_CONFIG
+
+    folders = WATCHER_CONFIG["FOLDERS"]
+    if args.inbox:
+        folders = [{"INBOX": args.inbox, "VAULT_FOLDER": args.vault_folder or os.path.basename(os.path.normpath(args.inbox))}]
+
+    watcher = InboxWatcher(
+        folders,
+        vault_path=args.vault or get_vault_path()[0],
+        model_generation=args.generation_model or WATCHER_CONFIG["GENERATION_MODEL"],
+        model_formatting=args.formatting_model or WATCHER_CONFIG["FORMATTING_MODEL"],
+        ocr_enhance=args.ocr,
+        hedge=args.hedge,
+        debounce=args.debounce or WATCHER_CONFIG["DEBOUNCE_SECONDS"],
+        polling=args.polling,
+    )
+    try:
+        watcher.run(initial_scan=not args.no_initial_scan)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="anotar", description="Headless note taking for ANOTAR.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print every stage transition and log to stderr")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    batch = commands.add_parser("batch", help="Take notes for a set of PDFs and images")
+    batch.add_argument("inputs", nargs="+", help="Files, directories or glob patterns (quote globs to use ** recursion)")
+    batch.add_argument("--vault", help="Vault folder to write notes to (defaults to the configured vault)")
+    batch.add_argument("--title", help="Append every file to this note instead of one note per file")
+    batch.add_argument("-g", "--generation-model", default="gemini-1.5-flash-8b", help="Model used to generate notes")
+    batch.add_argument("-f", "--formatting-model", help="Model used to format notes (defaults to the generation model)")
+    batch.add_argument("-c", "--concurrency", type=int, help="Concurrent generation and formatting requests")
+    batch.add_argument("--preprocess-workers", type=int, help="Files preprocessed (OCR'd) at the same time")
+    batch.add_argument("--ocr", action="store_true", help="Force OCR on PDFs that have a text layer")
+    batch.add_argument("--no-cache", action="store_true", help="Bypass the LLM response cache")
+    batch.add_argument("--hedge", action="store_true", help="Also send slow requests to the next model of HEDGING.FALLBACK_CHAIN (may use another provider)")
+    batch.set_defaults(handler=run_batch)
+
+    watch = commands.add_parser("watch", help="Take notes for files dropped into inbox folders as they arrive")
+    watch.add_argument("--inbox", help="Folder to watch instead of the WATCHER.FOLDERS from config.json")
+    watch.add_argument("--vault-folder", help="Vault folder mirroring --inbox (defaults to the inbox folder name)")
+    watch.add_argument("--vault", help="Vault root (defaults to the configured vault)")
+    watch.add_argument("-g", "--generation-model", help="Model used to generate notes")
+    watch.add_argument("-f", "--formatting-model", help="Model used to format notes")
+    watch.add_argument("--ocr", action="store_true", help="Force OCR on PDFs that have a text layer")
+    watch.add_argument("--hedge", action="store_true", help="Also send slow requests to the next model of HEDGING.FALLBACK_CHAIN (may use another provider)")
+    watch.add_argument("--debounce", type=float, help="Seconds a file must stay unchanged before it is picked up")
+    watch.add_argument("--polling", action="store_true", help="Poll for changes (for network shares without change notifications)")
+    watch.add_argument("--no-initial-scan", action="store_true", help="Ignore files already in the inbox at start-up")
+    watch.set_defaults(handler=run_watch)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+    )
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,8 @@
 import streamlit as st
 from st_pages import get_nav_from_toml
+from utils.reader_pool import warm_up_on_start
+
+warm_up_on_start()
 
 st.logo("pages/note.png")
 nav = get_nav_from_toml(".streamlit/pages_sections.toml")
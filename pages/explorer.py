@@ -4,8 +4,10 @@ import time
 import shutil
 from pathlib import Path
 import math
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from utils.obsidian import get_vault_path
+from utils.vault_index import get_vault_index
+from utils.note_viewer import get_outline, read_window, window_start
 
 st.set_page_config(layout="wide")
 
@@ -32,6 +34,7 @@ class StreamlitFileManager:
         # Create root directory if it doesn't exist
         if not os.path.exists(self.root_path):
             os.makedirs(self.root_path)
+        self.index = get_vault_index(self.root_path)
 
     def _get_state_key(self, key: str) -> str:
         """Generate a unique session state key."""
@@ -49,6 +52,8 @@ class StreamlitFileManager:
             'upload_success': [],
             'upload_progress': 0,
             'page_content' : None,
+            'search_query': "",
+            'related_notes': None,
         }
         
         for key, default_value in state_vars.items():
@@ -56,27 +61,131 @@ class StreamlitFileManager:
             if state_key not in st.session_state:
                 st.session_state[state_key] = default_value
 
-    def _get_files_and_folders(self) -> List[Dict[str, Any]]:
-        """Get list of files and folders in current directory."""
-        items = []
+    def _get_files_and_folders(self, offset: int = 0, limit: Optional[int] = None) -> Tuple[int, List[Dict[str, Any]]]:
+        """Get the total count and one page of the files and folders in current directory, folders first."""
         try:
-            for item in os.listdir(st.session_state[self._get_state_key('current_path')]):
-                if not item.startswith('.') and not item.endswith('.ini') and not item == 'assets':
-                    full_path = os.path.join(
-                        st.session_state[self._get_state_key('current_path')], 
-                        item
-                    )
-                    is_directory = os.path.isdir(full_path)
-                    items.append({
-                        'name': item,
-                        'path': full_path,
-                        'is_directory': is_directory,
-                        'size': os.path.getsize(full_path) if not is_directory else 0,
-                        'modified': os.path.getmtime(full_path)
-                    })
+            return self.index.list_dir(st.session_state[self._get_state_key('current_path')], offset, limit)
         except Exception as e:
             print(f"Error accessing path: {e}")
-        return items
+            return 0, []
+
+    def _open_note(self, path: str):
+        """Show a note in place of the listing."""
+        st.session_state[self._get_state_key('previous_path')] = st.session_state[self._get_state_key('current_path')]
+        st.session_state[self._get_state_key('current_path')] = path
+        st.session_state[self._get_state_key('show_new_folder_input')] = False
+        st.session_state[self._get_state_key('current_page')] = 1
+        # Only the position in the note is kept; its text is read a window at a time
+        st.session_state[self._get_state_key('page_content')] = {'part': 0}
+
+    def _render_note(self):
+        """Render the window of sections of the open note, with navigation for large notes."""
+        path = st.session_state[self._get_state_key('current_path')]
+        position = st.session_state[self._get_state_key('page_content')]
+        try:
+            outline = get_outline(path)
+        except OSError as e:
+            st.error(f"Could not open note: {e}")
+            return
+        if not outline:
+            st.markdown("# Empty File!!")
+            return
+
+        first = min(position['part'], len(outline) - 1)
+        content, last = read_window(path, outline, first)
+        if first > 0 or last < len(outline):
+            headings = [i for i, part in enumerate(outline) if part['title']]
+            col1, col2, col3 = st.columns([1, 3, 1])
+            with col1:
+                if st.button("⬅️ Previous", disabled=first == 0, key=f"{self.key_prefix}note_previous", use_container_width=True):
+                    position['part'] = window_start(outline, first)
+                    st.rerun()
+            with col2:
+                if headings:
+                    # The heading the window starts in, so the outline follows the scrolling
+                    current = max((i for i in headings if i <= first), default=headings[0])
+                    jump = st.selectbox(
+                        "Jump to heading",
+                        options=headings,
+                        index=headings.index(current),
+                        format_func=lambda i: "\u2003" * (outline[i]['level'] - 1) + outline[i]['title'],
+                        key=f"{self.key_prefix}note_outline_{path}_{current}",
+                        label_visibility="collapsed",
+                    )
+                    if jump != current:
+                        position['part'] = jump
+                        st.rerun()
+                st.caption(f"Sections {first + 1}–{last} of {len(outline)}")
+            with col3:
+                if st.button("Next ➡️", disabled=last >= len(outline), key=f"{self.key_prefix}note_next", use_container_width=True):
+                    position['part'] = last
+                    st.rerun()
+            st.divider()
+        st.markdown(content)
+
+    def _render_search_results(self, offset: int) -> int:
+        """Render one page of full-text search results and return the total number of matches."""
+        try:
+            with st.spinner("Searching..."):
+                total, results = self.index.search(
+                    st.session_state[self._get_state_key('search_query')],
+                    offset,
+                    st.session_state[self._get_state_key('items_per_page')],
+                )
+        except Exception as e:
+            st.error(f"Search failed: {e}")
+            return 0
+
+        if not results:
+            st.info("No notes found.")
+            return total
+
+        st.caption(f"{total} note(s) found")
+        for result in results:
+            if st.button(
+                f"📄 {result['name'][:-3]}",
+                key=f"{self.key_prefix}result_{result['path']}",
+                use_container_width=True,
+            ):
+                self._open_note(result['path'])
+                st.rerun()
+            folder = os.path.relpath(os.path.dirname(result['path']), self.root_path)
+            st.caption(f"📂 {'Root' if folder == '.' else folder}")
+            st.markdown(result['snippet'])
+        st.divider()
+        return total
+
+    def _render_related_notes(self):
+        """Render links to the notes most similar to the open one."""
+        path = st.session_state[self._get_state_key('current_path')]
+        try:
+            # Every button click reruns the page: search again only for another note or a new version of it
+            note = (path, os.stat(path).st_mtime_ns)
+            cached = st.session_state[self._get_state_key('related_notes')]
+            if cached and cached['note'] == note:
+                related = cached['related']
+            else:
+                # NumPy comes with the related-notes index, so only once a note is open
+                from utils.related import get_related_notes
+                with st.spinner("Finding related notes..."):
+                    related = get_related_notes(self.root_path).related(path)
+                st.session_state[self._get_state_key('related_notes')] = {'note': note, 'related': related}
+        except Exception as e:
+            print(f"Error finding related notes: {e}")
+            return
+        if not related:
+            return
+
+        st.divider()
+        st.markdown("##### Related notes")
+        for note in related:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                if st.button(f"📄 {note['link']}", key=f"{self.key_prefix}related_{note['path']}", use_container_width=True):
+                    self._open_note(note['path'])
+                    st.rerun()
+            with col2:
+                st.caption(f"{note['score']:.0%} similar")
 
     def _handle_file_upload(self, uploaded_files) -> bool:
         """Handle file upload process with progress tracking."""
@@ -108,6 +217,7 @@ class StreamlitFileManager:
             progress_bar.progress(progress)
             status_text.text(f"Uploading file {idx} of {total_files}: {uploaded_file.name}")
         
+        self.index.invalidate()
         success_count = sum(1 for item in st.session_state[self._get_state_key('upload_success')] 
                           if item["status"] == "success")
         st.success(f"Successfully uploaded {success_count} of {total_files} files")
@@ -132,6 +242,7 @@ class StreamlitFileManager:
                 st.error("A folder with this name already exists!")
                 return False
             os.makedirs(new_folder_path)
+            self.index.invalidate()
             return True
         except Exception as e:
             st.error(f"Error creating folder: {e}")
@@ -144,6 +255,7 @@ class StreamlitFileManager:
                 shutil.rmtree(path)
             else:
                 os.remove(path)
+            self.index.invalidate()
             return True
         except Exception as e:
             st.error(f"Error deleting item: {e}")
@@ -246,6 +358,16 @@ class StreamlitFileManager:
 
             if not st.session_state[self._get_state_key('page_content')]:
                 
+                query = st.text_input(
+                    "Search notes",
+                    key=f"{self.key_prefix}search",
+                    placeholder="🔍 Search notes",
+                    label_visibility="collapsed",
+                )
+                if query != st.session_state[self._get_state_key('search_query')]:
+                    st.session_state[self._get_state_key('search_query')] = query
+                    st.session_state[self._get_state_key('current_page')] = 1
+
                 # Top navigation bar
                 col3, col4, col5 = st.columns([1, 1, 1])
                 
@@ -308,17 +430,20 @@ class StreamlitFileManager:
                 st.divider()
 
 
-            # File/Folder List
-            items = self._get_files_and_folders()
-            items.sort(key=lambda x: (not x['is_directory'], x['name'].lower()))
-            
             start_idx = (st.session_state[self._get_state_key('current_page')] - 1) * st.session_state[self._get_state_key('items_per_page')]
-            end_idx = start_idx + st.session_state[self._get_state_key('items_per_page')]
-            paginated_items = items[start_idx:end_idx]
+
+            # Search Results
+            if st.session_state[self._get_state_key('search_query')].strip() and not st.session_state[self._get_state_key('page_content')]:
+                self._render_pagination(self._render_search_results(start_idx))
+                return
+
+            # File/Folder List
+            total_items, paginated_items = self._get_files_and_folders(start_idx, st.session_state[self._get_state_key('items_per_page')])
 
             if not paginated_items:
-                if content := st.session_state[self._get_state_key('page_content')]:
-                    st.markdown(content)
+                if st.session_state[self._get_state_key('page_content')]:
+                    self._render_note()
+                    self._render_related_notes()
                 else:
                     print("No items found!")
                     st.error("No items found !!")
@@ -346,17 +471,7 @@ class StreamlitFileManager:
                                 key=f"{self.key_prefix}file_{item['path']}",
                                 use_container_width=True,
                             ):
-                                st.session_state[self._get_state_key('previous_path')] = st.session_state[self._get_state_key('current_path')]
-                                st.session_state[self._get_state_key('current_path')] = item['path']
-                                st.session_state[self._get_state_key('show_new_folder_input')] = False
-                                st.session_state[self._get_state_key('current_page')] = 1
-
-                                with open(item['path'], 'r') as f:
-                                    content = f.read()
-                                    if not content:
-                                        content = "# Empty File!!"
-                                    st.session_state[self._get_state_key('page_content')] = content
-
+                                self._open_note(item['path'])
                                 st.rerun()
 
                     with col_super:
@@ -387,7 +502,7 @@ class StreamlitFileManager:
                                 st.session_state[f"delete_button_{item['path']}"] = False
 
                 st.divider()
-            self._render_pagination(len(items))
+            self._render_pagination(total_items)
 
     @property
     def current_path(self) -> str:
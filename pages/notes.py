@@ -1,12 +1,13 @@
 import streamlit as st
-import pypdfium2 as pdfium
 import logging, os, time
 from io import BytesIO
-from utils.obsidian import get_vault_path, create_obsidian_note
-from utils.preprocess import preprocess_file
+from utils.obsidian import get_vault_path
+from utils.pipeline import STAGES
+from utils.jobs import job_store, submit_batch, resume_batch, unfinished_batches, discard_batch, BatchInUseError
 from utils.directory_manager import get_folder_structure
+from utils.reader_pool import warm_up_once
 from utils.cypher.key import get_api_key
-from utils.llm import get_providers, get_models, generate_notes, format_notes, MissingAPIKeyError
+from utils.llm import get_providers, get_models, llm_cache_stats, MissingAPIKeyError, HEDGING_CONFIG
 
 log_file_path = "runtime_log.log"
 logging.basicConfig(filename=log_file_path, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -27,6 +28,12 @@ if "use_same" not in st.session_state:
     st.session_state.use_same = True
 if "ocr_enhance" not in st.session_state:
     st.session_state.ocr_enhance = False
+if "use_cache" not in st.session_state:
+    st.session_state.use_cache = True
+if "stream_to_vault" not in st.session_state:
+    st.session_state.stream_to_vault = False
+if "hedge" not in st.session_state:
+    st.session_state.hedge = HEDGING_CONFIG["ENABLED"]
 if "model_generation" not in st.session_state:
     st.session_state.model_generation = 0
 if "model_formatting" not in st.session_state:
@@ -85,6 +92,20 @@ with st.sidebar:
         ocr_enhance = st.session_state.ocr_enhance
         logger.info("OCR Enhance enabled: %s", ocr_enhance)
 
+        st.session_state.use_cache = st.toggle('Use response cache', value=st.session_state.use_cache, help='Reuse notes for files that were already processed with the same models.', disabled=st.session_state.disabled)
+        use_cache = st.session_state.use_cache
+        cache_stats = llm_cache_stats()
+        st.caption(f"Cache: {cache_stats['entries']} entries, {cache_stats['bytes'] / 2**20:.1f} MB, {cache_stats['hit_rate']:.0%} hit rate")
+        logger.info("Response cache enabled: %s", use_cache)
+
+        st.session_state.stream_to_vault = st.toggle('Stream notes into vault', value=st.session_state.stream_to_vault, help='Write notes into the vault while they are being formatted.', disabled=st.session_state.disabled)
+        stream_to_vault = st.session_state.stream_to_vault
+        logger.info("Stream to vault enabled: %s", stream_to_vault)
+
+        st.session_state.hedge = st.toggle('Hedge slow requests', value=st.session_state.hedge, help='Also send requests that take longer than usual to the next model of the fallback chain, possibly at another provider, and keep the first answer. Costs more.', disabled=st.session_state.disabled)
+        hedge = st.session_state.hedge
+        logger.info("Request hedging enabled: %s", hedge)
+
     except Exception as e:
         logger.error("Error in sidebar setup: %s", e)
 
@@ -102,94 +123,124 @@ uploaded_files = st.file_uploader(
     disabled=st.session_state.disabled
     )
 
-file_content = None
-image_path = None
-ocr_result = None
-notes = None
-formatted_notes = None
-note_path = None
+def run_batch(names, run):
+    """Show one status per file while ``run(on_progress, on_stream)`` takes the notes; returns how many succeeded."""
+    progress_bar = st.progress(0)
+    statuses = [st.status(f'{name}: Waiting...', expanded=False) for name in names]
+    previews = [status.empty() for status in statuses]
+    streamed = [[] for _ in names]
+    last_render = [0.0 for _ in names]
+    stage_labels = {
+        "preprocessed": "Generating Notes...",
+        "generated": "Formatting Notes...",
+        "formatted": "Writing to file...",
+    }
+    steps_done = 0
+
+    def on_progress(i, stage, error=None):
+        nonlocal steps_done
+        name, status = names[i], statuses[i]
+        if stage == "failed":
+            status.update(label=f'{name}: Notes Creation Failed!', state='error', expanded=True)
+            if isinstance(error, MissingAPIKeyError):
+                status.error(f"{error}")
+            else:
+                status.error(f"An error occurred while taking notes for {name}")
+            return
+
+        steps_done += 1
+        progress_bar.progress(min(steps_done / (len(STAGES) * len(names)), 1.0))
+        if stage == "written":
+            previews[i].markdown("".join(streamed[i][1:]))
+            status.write("Notes created successfully!")
+            status.update(label=f'{name}: Notes Created Successfully!', state='complete', expanded=False)
+        else:
+            status.write(stage_labels[stage])
+            status.update(label=f'{name}: {stage_labels[stage]}')
+
+    def on_stream(i, stage, chunk):
+        if not streamed[i] or streamed[i][0] != stage:
+            streamed[i][:] = [stage]
+            statuses[i].update(expanded=True)
+        streamed[i].append(chunk)
+        # Re-rendering the whole preview is linear in its length, so throttle it
+        now = time.monotonic()
+        if now - last_render[i] > 0.25:
+            last_render[i] = now
+            previews[i].markdown("".join(streamed[i][1:]))
+
+    results = run(on_progress, on_stream)
+
+    all_done = 0
+    for result in results:
+        if result["note_path"]:
+            all_done += 1
+            logger.info("Notes created successfully: %s", result["note_path"])
+        else:
+            logger.error("Notes creation failed for file: %s", result["name"])
+    return all_done
+
+
+unfinished = unfinished_batches()
+if unfinished:
+    with st.expander(f"Unfinished batches ({len(unfinished)})", expanded=True):
+        for batch in unfinished:
+            started = time.strftime('%Y-%m-%d %H:%M', time.localtime(batch["created"]))
+            st.write(f'**{started}**: {batch["written"]} of {batch["total"]} file(s) written, {batch["failed"]} failed ({batch["options"]["model_generation"]})')
+            if batch["running"]:
+                # Resuming would run the files a second time alongside the live run
+                st.caption("Running in another tab or process")
+            resume_col, discard_col = st.columns(2)
+            if resume_col.button('Resume', key=f'resume_{batch["id"]}', use_container_width=True, disabled=batch["running"]):
+                names = [job["name"] for job in job_store.jobs(batch["id"])]
+                try:
+                    all_done = run_batch(names, lambda on_progress, on_stream: resume_batch(
+                        batch["id"],
+                        use_cache=use_cache,
+                        hedge=hedge,
+                        on_progress=on_progress,
+                        on_stream=on_stream,
+                        stream_to_vault=stream_to_vault,
+                    ))
+                    if all_done == len(names):
+                        st.balloons()
+                except BatchInUseError as e:
+                    st.warning(str(e))
+            if discard_col.button('Discard', key=f'discard_{batch["id"]}', use_container_width=True, disabled=batch["running"]):
+                try:
+                    discard_batch(batch["id"])
+                    st.rerun()
+                except BatchInUseError as e:
+                    st.warning(str(e))
 
 if uploaded_files and obsidian_db:
     logger.info("Number of uploaded files: %d", len(uploaded_files))
+    # Pictures always go through OCR: start loading the reader while "Take Notes" is still to be clicked
+    if ocr_enhance or any(not file.name.lower().endswith('.pdf') for file in uploaded_files):
+        warm_up_once()
 
-    all_done = 0
     take_notes_button = st.button(
                                 'Take Notes', 
                                 use_container_width=True, 
                                 # on_click=disable_widgets
                                 )
-    progress_bar = st.progress(0)
 
     if take_notes_button:
-        for i, file in enumerate(uploaded_files):
-            with st.status('Reading file...', expanded=False) as status:
-                try:
-                    file_content, image_path, ocr_result = preprocess_file(file, ocr_enhance)
-                    logger.info("File preprocessed successfully: %s", file.name)
-                    progress_bar.progress((4 * i + 1) / (4 * len(uploaded_files)))
-                except Exception as e:
-                    logger.error("Error processing file: %s; %s", file.name, e, exc_info=True)
-                    st.warning(f"An error occurred while processing file: {file.name}")
-
-                if file_content or image_path or ocr_result:
-                    try:
-                        st.write('Generating Notes...')
-                        status.update(label='Generating Notes...')
-                        notes = generate_notes(file=file_content, image_path=image_path, ocr_enhance_info=ocr_result, model=model_generation)
-                        logger.info("Notes generated successfully for file: %s", file.name)
-                        progress_bar.progress((4 * i + 2) / (4 * len(uploaded_files)))
-                    except MissingAPIKeyError as e:
-                        logger.error(f"{e}")
-                        st.error(f"{e}")
-                    except Exception as e:
-                        logger.error("Error generating notes for file %s: %s", file.name, e, exc_info=True)
-                        st.info(f"An error occurred while generating notes for {file.name}")
-
-                if image_path:
-                    os.remove(image_path)
-                    logger.info("Temporary image file removed: %s", image_path)
-
-                if notes:
-                    try:
-                        st.write('Formatting Notes...')
-                        status.update(label='Formatting Notes...')
-                        formatted_notes = format_notes(notes=notes, model=model_formatting)
-                        logger.info("Notes formatted successfully for file: %s", file.name)
-                        progress_bar.progress((4 * i + 3) / (4 * len(uploaded_files)))
-                    except MissingAPIKeyError as e:
-                        logger.error(f"{e}")
-                        st.info(f"{e}")
-                    except Exception as e:
-                        logger.error("Error formatting notes for file %s: %s", file.name, e, exc_info=True)
-                        st.info(f"An error occurred while formatting notes for {file.name}")
-
-                if formatted_notes:
-                    try:
-                        st.write('Writing to file...')
-                        status.update(label='Writing to file...')
-                        note_path = create_obsidian_note(
-                            note_title=title,
-                            note_content=formatted_notes,
-                            vault_path=obsidian_db,
-                            uploaded_file=file
-                        )
-                        progress_bar.progress((4 * i + 4) / (4 * len(uploaded_files)))
-                    except Exception as e:
-                        logger.error("Error creating notes for file %s: %s", file.name, e, exc_info=True)
-                        st.info(f"An error occurred while creating notes file for {file.name}")
-
-                if note_path:
-                    all_done += 1
-                    st.write(f"Notes created successfully!")
-                    logger.info("Notes created successfully: %s", note_path)
-                    status.update(label='Notes Created Successfully!', state='complete', expanded=False)
-                    
-                else:
-                    status.update(label='Notes Creation Failed!', state='error', expanded=True)
-                    st.error(f"Notes creation failed!")
-                    logger.error("Notes creation failed for file: %s", file.name, exc_info=True)
-                    break
-                
+        # The batch is recorded before anything runs, so an interrupted run can be resumed above
+        all_done = run_batch([file.name for file in uploaded_files], lambda on_progress, on_stream: submit_batch(
+            uploaded_files,
+            title=title,
+            vault_path=obsidian_db,
+            model_generation=model_generation,
+            model_formatting=model_formatting,
+            ocr_enhance=ocr_enhance,
+            use_cache=use_cache,
+            hedge=hedge,
+            on_progress=on_progress,
+            on_stream=on_stream,
+            stream_to_vault=stream_to_vault,
+        ))
+
         enable_widgets()
         if all_done == len(uploaded_files) and all_done > 0:
             st.snow()
@@ -2,6 +2,7 @@ import streamlit as st
 import os, json
 from utils.cypher.key import load_or_generate_key, load_api_keys_from_env, save_api_key_to_env, remove_api_key_from_env, encrypt_key
 from utils.obsidian import get_vault_path
+from utils.clients import reset_clients
 from dotenv import load_dotenv
 
 config = json.load(open("config.json"))
@@ -61,6 +62,7 @@ if loaded_keys:
                     if st.button("Confirm", key=f"{provider}_confirm", type="primary"):
                         for key_name in keys:
                             remove_api_key_from_env(key_name)
+                        reset_clients()
                         st.session_state.confirm_deletion[provider] = False
                         st.rerun()
                 
@@ -83,6 +85,7 @@ if available_providers:
             if provider == 'Ollama':
                 for key in keys:
                     save_api_key_to_env(key, "Ollama")
+                    reset_clients()
                     st.session_state.selected_providers[provider] = False
                     st.rerun()
             else:            
@@ -94,6 +97,7 @@ if available_providers:
                     )
                     if st.button(f"Save", key=f"{key_name}_save", type="primary"):
                         if api_key:
-                            save_api_key_to_env(key_name, api_key)                        
+                            save_api_key_to_env(key_name, api_key)
+                            reset_clients()
                             st.session_state.selected_providers[provider] = False
                             st.rerun()
\ No newline at end of file
@@ -0,0 +1,22 @@
+from utils.markdown import normalize_markdown
+
+
+def test_amounts_around_prose_are_escaped():
+    assert normalize_markdown("Price $5 and $10 total") == ("Price \\$5 and \\$10 total", [])
+
+
+def test_amount_before_math_is_escaped():
+    assert normalize_markdown("Pay $5 for $x = 3$ now") == ("Pay \\$5 for $x = 3$ now", [])
+
+
+def test_math_is_left_alone():
+    assert normalize_markdown("Area $x^2$ and $5$") == ("Area $x^2$ and $5$", [])
+
+
+def test_indented_code_is_left_alone():
+    text = "Run:\n\n    echo $HOME\n\n    x=$1\n\nThen $a$."
+    assert normalize_markdown(text) == (text, [])
+
+
+def test_indented_list_continuation_is_not_code():
+    assert normalize_markdown("- item\n\n    more $x")[1] == ["line 3: unbalanced $"]
@@ -0,0 +1,147 @@
+import os, json, time, hashlib, sqlite3, threading
+from typing import Optional, Dict, Any
+
+config = json.load(open("config.json"))
+CACHE_CONFIG = config["CACHE"]
+CACHE_DIR = CACHE_CONFIG["DIR"]
+
+
+def make_key(*parts) -> str:
+    """
+    Build a content-addressed cache key from ``parts``.
+
+    Bytes are hashed separately so large payloads (images, PDFs) never have to
+    be serialised; everything else must be JSON-serialisable.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            digest.update(b"b:" + hashlib.sha256(part).digest())
+        else:
+            digest.update(b"j:" + json.dumps(part, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    Persistent key/value cache stored in a single SQLite file.
+
+    Entries are evicted least-recently-used first once the cache grows past
+    ``max_bytes``, and dropped outright once older than ``max_age`` seconds.
+    Hit and miss counters are persisted alongside the entries.
+
+    Args:
+        path (str): Location of the SQLite file
+        max_bytes (int): Size budget for stored values, ``None`` for unbounded
+        max_age (float): Maximum entry age in seconds, ``None`` to keep forever
+    """
+
+    def __init__(self, path: str, max_bytes: Optional[int] = None, max_age: Optional[float] = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so reopen in every process
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _count(self, conn, name):
+        conn.execute(
+            "INSERT INTO stats(name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row and self.max_age is not None and now - row[1] > self.max_age:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self._count(conn, "misses")
+                return None
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self._count(conn, "hits")
+            return bytes(row[0])
+
+    def set(self, key: str, value: bytes):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries(key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now),
+            )
+            self._evict(conn, now)
+
+    def get_text(self, key: str) -> Optional[str]:
+        value = self.get(key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set_text(self, key: str, value: str):
+        self.set(key, value.encode("utf-8"))
+
+    def _evict(self, conn, now):
+        if self.max_age is not None:
+            conn.execute("DELETE FROM entries WHERE created < ?", (now - self.max_age,))
+        if self.max_bytes is not None:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                # Walk entries from least to most recently used until back under budget
+                excess, cutoff = total - self.max_bytes, None
+                for accessed, size in conn.execute("SELECT accessed, size FROM entries ORDER BY accessed"):
+                    excess -= size
+                    cutoff = accessed
+                    if excess <= 0:
+                        break
+                conn.execute("DELETE FROM entries WHERE accessed <= ?", (cutoff,))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            conn = self._connect()
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            counters = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM stats")
+
+
+def open_cache(name: str) -> DiskCache:
+    """Open the cache named ``name`` using its limits from the CACHE section of config.json."""
+    limits = CACHE_CONFIG[name]
+    max_age_days = limits.get("MAX_AGE_DAYS")
+    return DiskCache(
+        os.path.join(CACHE_DIR, f"{name.lower()}.sqlite3"),
+        max_bytes=limits.get("MAX_BYTES"),
+        max_age=max_age_days * 86400 if max_age_days is not None else None,
+    )
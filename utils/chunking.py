@@ -0,0 +1,131 @@
+import json, math
+from typing import List, Tuple
+
+config = json.load(open("config.json"))
+MODEL_CONTEXT_SIZES = config["MODEL_CONTEXT_SIZES"]
+CHUNKING_CONFIG = config["CHUNKING"]
+
+# Invisible markers preprocess_pdf leaves in the extracted text: every page is
+# separated by PAGE_BREAK and pages that open a top-level outline entry start
+# with SECTION_BREAK. They are stripped before anything is sent to a model.
+PAGE_BREAK = "\f"
+SECTION_BREAK = "\x1d"
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap, tokenizer-free token estimate used for budgeting."""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHUNKING_CONFIG["CHARS_PER_TOKEN"])
+
+
+def get_context_size(model: str) -> int:
+    return MODEL_CONTEXT_SIZES.get(model, MODEL_CONTEXT_SIZES["default"])
+
+
+def get_input_budget(model: str, max_output_tokens: int, prompt: str = "") -> int:
+    """
+    Tokens left for document content once the prompt and the answer are accounted for.
+
+    Args:
+        model (str): Model the request is sent to
+        max_output_tokens (int): Tokens requested for the answer
+        prompt (str): Fixed prompt text sent with every chunk
+
+    Returns:
+        int: Token budget for the document text of one request
+    """
+    context_size = get_context_size(model)
+    reserved = min(max_output_tokens, context_size // 2) + estimate_tokens(prompt)
+    budget = int((context_size - reserved) * CHUNKING_CONFIG["SAFETY_MARGIN"])
+    return max(budget, CHUNKING_CONFIG["MIN_CHUNK_TOKENS"])
+
+
+def strip_markers(text: str) -> str:
+    if not text:
+        return text
+    return text.replace(SECTION_BREAK, "").replace(PAGE_BREAK, "\n")
+
+
+def split_text(text: str, budget: int) -> List[str]:
+    """
+    Split ``text`` into pieces of at most ``budget`` tokens.
+
+    Cuts prefer paragraph breaks, then line breaks, and only fall back to hard
+    character cuts for single lines that are longer than the budget.
+    """
+    if estimate_tokens(text) <= budget:
+        return [text]
+
+    max_chars = budget * CHUNKING_CONFIG["CHARS_PER_TOKEN"]
+    for separator in ("\n\n", "\n"):
+        parts = text.split(separator)
+        if len(parts) == 1:
+            continue
+        pieces, current = [], ""
+        for part in parts:
+            candidate = current + separator + part if current else part
+            if current and len(candidate) > max_chars:
+                pieces.append(current)
+                current = part
+            else:
+                current = candidate
+        pieces.append(current)
+        return [chunk for piece in pieces for chunk in split_text(piece, budget)]
+
+    return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+
+
+def chunk_document(text: str, ocr_text: str, budget: int) -> List[Tuple[str, str]]:
+    """
+    Pack the pages of a preprocessed document into chunks of at most ``budget`` tokens.
+
+    The text layer and the OCR text are paired page by page so that every chunk
+    carries both views of the same pages. A new chunk is started at an outline
+    section once the current one is at least half full, otherwise at the page
+    boundary where the budget runs out. Oversized pages are split further.
+
+    Args:
+        text (str): Text layer as returned by ``preprocess_pdf``
+        ocr_text (str): OCR text as returned by ``preprocess_pdf``
+        budget (int): Token budget per chunk
+
+    Returns:
+        list: ``(text, ocr_text)`` pairs with markers stripped
+    """
+    text_pages = text.split(PAGE_BREAK) if text else []
+    ocr_pages = ocr_text.split(PAGE_BREAK) if ocr_text else []
+    page_count = max(len(text_pages), len(ocr_pages))
+    text_pages += [""] * (page_count - len(text_pages))
+    ocr_pages += [""] * (page_count - len(ocr_pages))
+
+    chunks, current_text, current_ocr, used = [], [], [], 0
+
+    def flush():
+        nonlocal current_text, current_ocr, used
+        if current_text or current_ocr:
+            chunks.append(("\n".join(current_text).strip(), "\n".join(current_ocr).strip()))
+        current_text, current_ocr, used = [], [], 0
+
+    for page_text, page_ocr in zip(text_pages, ocr_pages):
+        starts_section = page_text.startswith(SECTION_BREAK)
+        page_text = strip_markers(page_text)
+        page_tokens = estimate_tokens(page_text) + estimate_tokens(page_ocr)
+
+        if used and (used + page_tokens > budget or (starts_section and used >= budget // 2)):
+            flush()
+
+        if page_tokens > budget:
+            # A single page that does not fit on its own: give text and OCR their own pieces
+            for piece in split_text(page_text, budget):
+                chunks.append((piece, ""))
+            for piece in split_text(page_ocr, budget):
+                chunks.append(("", piece))
+            continue
+
+        current_text.append(page_text)
+        current_ocr.append(page_ocr)
+        used += page_tokens
+
+    flush()
+    return [(chunk_text, chunk_ocr) for chunk_text, chunk_ocr in chunks if chunk_text or chunk_ocr]
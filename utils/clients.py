@@ -0,0 +1,107 @@
+import json, threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import httpx
+
+config = json.load(open("config.json"))
+HTTP_CONFIG = config["HTTP"]
+
+_lock = threading.Lock()
+_clients = {}
+
+
+# httpx and the provider SDKs are imported on first use, so only the providers in use are ever loaded
+def _http_limits() -> "httpx.Limits":
+    import httpx
+    return httpx.Limits(
+        max_connections=HTTP_CONFIG["MAX_CONNECTIONS"],
+        max_keepalive_connections=HTTP_CONFIG["MAX_KEEPALIVE_CONNECTIONS"],
+        keepalive_expiry=HTTP_CONFIG["KEEPALIVE_EXPIRY"],
+    )
+
+
+def _http_client() -> "httpx.Client":
+    import httpx
+    # One pooled keep-alive connection set per provider client, sized for parallel calls
+    return httpx.Client(limits=_http_limits(), timeout=HTTP_CONFIG["TIMEOUT"])
+
+
+def _close(client):
+    close = getattr(client, "close", None)
+    if close:
+        try:
+            close()
+        except Exception as e:
+            print("Error closing client:", e)
+
+
+def _retire(client):
+    # Other threads may still be mid-request on the old client: close it only once
+    # any request it started has had time to finish or time out
+    timer = threading.Timer(HTTP_CONFIG["TIMEOUT"], _close, (client,))
+    timer.daemon = True
+    timer.start()
+
+
+def _get_client(slot, credentials, factory):
+    """
+    Return the long-lived client for ``slot``, building it with ``factory`` on first use.
+
+    A client is rebuilt only when the ``credentials`` it was built with change;
+    the replaced client is closed after ``HTTP.TIMEOUT`` seconds, not right away.
+    """
+    with _lock:
+        entry = _clients.get(slot)
+        if entry and entry[0] == credentials:
+            return entry[1]
+        client = factory()
+        _clients[slot] = (credentials, client)
+    if entry:
+        _retire(entry[1])
+    return client
+
+
+def get_openai_client(api_key: str, endpoint: str):
+    from openai import OpenAI
+    return _get_client(("OpenAI", endpoint), api_key, lambda: OpenAI(base_url=endpoint, api_key=api_key, http_client=_http_client()))
+
+
+def get_groq_client(api_key: str):
+    from groq import Groq
+    return _get_client(("Groq",), api_key, lambda: Groq(api_key=api_key, http_client=_http_client()))
+
+
+def get_mistral_client(api_key: str):
+    from mistralai import Mistral
+    return _get_client(("Mistral AI",), api_key, lambda: Mistral(api_key=api_key, client=_http_client()))
+
+
+def get_ollama_client():
+    import ollama
+    return _get_client(("Ollama",), None, lambda: ollama.Client(limits=_http_limits(), timeout=HTTP_CONFIG["TIMEOUT"]))
+
+
+def get_gemini_model(api_key: str, model: str, system_instruction: str):
+    import google.generativeai as genai
+
+    def configure():
+        genai.configure(api_key=api_key)
+        return api_key
+
+    # genai keeps its transport globally, so configure once per key and reuse it for every model
+    _get_client(("Google Gemini",), api_key, configure)
+    return _get_client(
+        ("Google Gemini", model, system_instruction),
+        api_key,
+        lambda: genai.GenerativeModel(model_name=model, system_instruction=system_instruction),
+    )
+
+
+def reset_clients():
+    """Drop every cached client, e.g. after API keys were edited on the settings page, letting requests in flight finish."""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for _, client in clients:
+        _retire(client)
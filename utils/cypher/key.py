@@ -1,4 +1,4 @@
-import os, json
+import os, json, threading
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv, set_key, unset_key
 
@@ -11,6 +11,50 @@ ENV_FILE = config["ENV_FILE"]
 # Load environment variables
 load_dotenv(ENV_FILE, override=True)
 
+# Decrypted keys and the Fernet instance, kept until .env or secret.key change
+_secrets = {}
+_fernet = None
+_stamp = None
+_version = 0
+_lock = threading.RLock()
+
+
+def _file_stamp(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+        return None
+
+
+def _check_files():
+    """Drop the cached secrets if .env or secret.key changed since they were read."""
+    global _stamp
+    stamp = (_file_stamp(ENV_FILE), _file_stamp(KEY_FILE))
+    if stamp != _stamp:
+        if _stamp is not None:
+            # Edited outside this process: pick up the new values first
+            load_dotenv(ENV_FILE, override=True)
+            invalidate_secrets()
+        _stamp = stamp
+
+
+def invalidate_secrets():
+    """Forget every decrypted key, e.g. after the settings page saved or removed one."""
+    global _fernet, _stamp, _version
+    with _lock:
+        _secrets.clear()
+        _fernet = None
+        _stamp = None
+        _version += 1
+
+
+def get_secrets_version() -> int:
+    """Number that changes whenever the secrets may have, for caching what is derived from them."""
+    with _lock:
+        _check_files()
+        return _version
+
 # Function to encrypt a key
 def encrypt_key(key: str) -> str:
     encryption_key = load_or_generate_key()
@@ -33,6 +77,8 @@ def load_api_keys_from_env(providers):
 def save_api_key_to_env(key_name, key):
     encrypted_key = encrypt_key(key)
     set_key(ENV_FILE, key_name, encrypted_key)
+    os.environ[key_name] = encrypted_key
+    invalidate_secrets()
     print("Saved key for", key_name)
 
 # Function to remove API keys from .env
@@ -40,10 +86,19 @@ def remove_api_key_from_env(key_name):
     unset_key(ENV_FILE, key_name)
     if key_name in os.environ:
         del os.environ[key_name]
+    invalidate_secrets()
     print("Deleted key for", key_name)
 
 # Function to load or generate an encryption key
 def load_or_generate_key():
+    global _fernet
+    with _lock:
+        _check_files()
+        if _fernet is None:
+            _fernet = _read_or_generate_key()
+        return _fernet
+
+def _read_or_generate_key():
     # Check if the key already exists in the environment
     try:
         with open(KEY_FILE, 'rb') as key_file:
@@ -61,13 +116,17 @@ def load_or_generate_key():
     
     return Fernet(key)
 
-# Function to decrypt a key
+# Function to decrypt a key, once until the key files change
 def get_api_key(key_name: str) -> str:
-    encryption_key = load_or_generate_key()
-    key = os.getenv(key_name)
-    decrypted_key = None
-    if key:    
-        decrypted_key = encryption_key.decrypt(key)
-        decrypted_key = decrypted_key.decode("utf-8")
-    return decrypted_key
+    with _lock:
+        encryption_key = load_or_generate_key()
+        if key_name in _secrets:
+            return _secrets[key_name]
+        key = os.getenv(key_name)
+        decrypted_key = None
+        if key:    
+            decrypted_key = encryption_key.decrypt(key)
+            decrypted_key = decrypted_key.decode("utf-8")
+        _secrets[key_name] = decrypted_key
+        return decrypted_key
 
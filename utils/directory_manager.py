@@ -1,5 +1,6 @@
 from dotenv import load_dotenv
 from utils.cypher.key import get_api_key, ENV_FILE
+from utils.vault_index import get_vault_index
 import os
 
 load_dotenv(ENV_FILE, override=True)
@@ -10,6 +11,8 @@ VAULT = get_api_key("OBSIDIAN_VAULT_PATH")
 def get_folder_structure(base_path):
     """
     Recursively get the folder structure starting from base_path
+
+    Answered from the vault index, which only lists folders again whose mtime changed.
     
     Args:
         base_path (str): Root directory to start exploring
@@ -21,48 +24,32 @@ def get_folder_structure(base_path):
     if not base_path:
         return
 
-    folder_paths = []
-    
     # Ensure the base path exists
     if not os.path.exists(base_path):
-        return folder_paths
-    
-    # Walk through the directory
-    for root, dirs, _ in os.walk(base_path):
-        # Filter out hidden directories in-place
-        dirs[:] = [dir for dir in dirs if not dir.startswith('.') and dir != 'assets']
-        
-        for dir in dirs:
-            # Create relative path
-            full_path = os.path.join(root, dir)
-            relative_path = os.path.relpath(full_path, base_path)
-            
-            # Add to folder paths
-            folder_paths.append(relative_path)
-    
-    return sorted(folder_paths)
+        return []
+
+    return get_vault_index(base_path).folders()
 
-def list_directory_tree(path, indent=0, base_url=None):
+def list_directory_tree(path, indent=0, base_url=None, root=None):
     tree = ""
+    root = root or VAULT or path
     try:
-        for entry in os.scandir(path):
-            if entry.name.startswith(".") or entry.name == "assets" or entry.name.endswith(".ini"):
-                continue
-            
+        _, entries = get_vault_index(root).list_dir(path)
+        for entry in entries:
             prefix = "├─" + "──" * indent
             
-            if entry.is_dir():
+            if entry['is_directory']:
                 if indent == 0:
                     tree += "---\n"
-                tree += f"{prefix}📂 ***{entry.name}***\n\n"
-                tree += list_directory_tree(entry.path, indent + 1, base_url)
+                tree += f"{prefix}📂 ***{entry['name']}***\n\n"
+                tree += list_directory_tree(entry['path'], indent + 1, base_url, root)
             else:
                 if base_url:
-                    relative_path = os.path.relpath(entry.path, start=VAULT).replace(" ", "%20")
+                    relative_path = os.path.relpath(entry['path'], start=VAULT).replace(" ", "%20")
                     file_url = f"{base_url}&file={relative_path}"
-                    tree += f"{prefix}📄 [{entry.name}]({file_url})\n\n"
+                    tree += f"{prefix}📄 [{entry['name']}]({file_url})\n\n"
                 else:
-                    tree += f"{prefix}📄 {entry.name}\n\n"
+                    tree += f"{prefix}📄 {entry['name']}\n\n"
     except PermissionError:
         tree += f"{' ' * (4 * indent)}❌ Permission Denied: {path}\n"
     return tree
@@ -0,0 +1,31 @@
+import os
+import time
+
+if os.name == "nt":
+    import msvcrt
+
+    def lock_file(file):
+        """Block until this process holds the exclusive OS lock on the open ``file``."""
+        # LK_LOCK gives up after 10 seconds, so keep trying without a deadline
+        while True:
+            try:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+                return
+            except OSError:
+                time.sleep(0.05)
+
+    def unlock_file(file):
+        """Release the OS lock taken with :func:`lock_file`."""
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def lock_file(file):
+        """Block until this process holds the exclusive OS lock on the open ``file``."""
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+    def unlock_file(file):
+        """Release the OS lock taken with :func:`lock_file`."""
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
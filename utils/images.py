@@ -0,0 +1,149 @@
+import io, os, json, math
+from typing import TYPE_CHECKING, List, Optional, Tuple
+from utils.cache import open_cache, make_key
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+config = json.load(open("config.json"))
+IMAGE_LIMITS = config["IMAGE_LIMITS"]
+
+# Images with more colours than this are photos, for which PNG is slow and several times larger
+PNG_MAX_COLORS = 256
+# Changes whenever _prepare encodes images differently, so older prepared images are not reused
+PREPARED_VERSION = 2
+
+image_cache = open_cache("IMAGES")
+
+
+def get_image_limits(model: str) -> dict:
+    return {**IMAGE_LIMITS["default"], **IMAGE_LIMITS.get(model, {})}
+
+
+def _encoded_size(data: bytes) -> int:
+    """Size of ``data`` once base64-encoded, as images are sent."""
+    return math.ceil(len(data) / 3) * 4
+
+
+def _fit(image: "Image.Image", max_edge: int, max_short_edge: int = None) -> "Image.Image":
+    from PIL import Image
+    scale = min(1.0, max_edge / max(image.size))
+    if max_short_edge:
+        scale = min(scale, max_short_edge / min(image.size))
+    if scale < 1.0:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+    return image
+
+
+def _encode(image: "Image.Image", image_format: str, quality: int) -> bytes:
+    # Saving without exif/pnginfo drops the metadata (GPS, camera, thumbnails)
+    buffer = io.BytesIO()
+    if image_format == "JPEG":
+        image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def _prepare(image_path: str, limits: dict) -> Tuple[str, bytes]:
+    # Imported here rather than at the top so that loading the app does not pay for Pillow
+    from PIL import Image, ImageOps
+    with Image.open(image_path) as source:
+        # Phone photos are stored sideways with an EXIF rotation; bake it in before the EXIF goes
+        image = ImageOps.exif_transpose(source)
+        image.load()
+
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    if has_alpha:
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image.convert("RGBA"), mask=image.convert("RGBA").getchannel("A"))
+        image = background
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    image = _fit(image, limits["MAX_EDGE"], limits.get("MAX_SHORT_EDGE"))
+
+    # Screenshots and scans of text are often smaller as PNG, photos as JPEG: keep whichever is
+    # smaller, but only try PNG where it stands a chance
+    quality = limits["QUALITY"]
+    candidates = [("image/jpeg", _encode(image, "JPEG", quality))]
+    if has_alpha or image.getcolors(PNG_MAX_COLORS) is not None:
+        candidates.append(("image/png", _encode(image, "PNG", quality)))
+    mime_type, data = min(candidates, key=lambda candidate: len(candidate[1]))
+
+    # Over the payload limit, which applies to the base64 text sent: lower the JPEG quality first, then the resolution
+    while _encoded_size(data) > limits["MAX_BYTES"]:
+        if quality > limits["MIN_QUALITY"]:
+            quality = max(limits["MIN_QUALITY"], quality - 10)
+        else:
+            image = _fit(image, int(max(image.size) * 0.75))
+        mime_type, data = "image/jpeg", _encode(image, "JPEG", quality)
+        if max(image.size) <= 256:
+            break
+
+    print(f"Prepared image {os.path.basename(image_path)}: {os.path.getsize(image_path) / 1024:.0f} KB -> {len(data) / 1024:.0f} KB {mime_type} {image.width}x{image.height}")
+    return mime_type, data
+
+
+def prepare_image(image_path: str, model: str) -> Tuple[str, bytes]:
+    """
+    Shrink an image to what ``model`` actually looks at before it is uploaded.
+
+    The image is rotated upright, downscaled to the model's effective resolution
+    (``MAX_EDGE``/``MAX_SHORT_EDGE`` in ``IMAGE_LIMITS``), stripped of metadata and
+    re-encoded as the smaller of JPEG and PNG. Images still over ``MAX_BYTES``
+    once base64-encoded, as they are sent, get a lower JPEG quality, down to
+    ``MIN_QUALITY``, and then a lower resolution.
+    Results are kept in the ``IMAGES`` disk cache, keyed by path, mtime, size and
+    limits, so packed, hedged and retried requests prepare an image once.
+
+    Args:
+        image_path (str): Image to prepare
+        model (str): Model the image is sent to
+
+    Returns:
+        tuple: MIME type and encoded image bytes
+    """
+    limits = get_image_limits(model)
+    stat = os.stat(image_path)
+    key = make_key("image", PREPARED_VERSION, os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size, sorted(limits.items()))
+    cached = image_cache.get(key)
+    if cached is not None:
+        mime_type, _, data = cached.partition(b"\0")
+        return mime_type.decode("ascii"), data
+    mime_type, data = _prepare(image_path, limits)
+    image_cache.set(key, mime_type.encode("ascii") + b"\0" + data)
+    return mime_type, data
+
+
+def pack_images(image_paths: List[str], model: str, max_images: Optional[int] = None) -> List[List[int]]:
+    """
+    Group images, in order, into as few requests to ``model`` as its limits allow.
+
+    A group never holds more than the model's ``MAX_IMAGES`` (or ``max_images``
+    if lower) and its prepared images, base64-encoded, never add up to more than
+    ``MAX_REQUEST_BYTES``. An image that is too large on its own still gets a
+    group of its own.
+
+    Args:
+        image_paths (list): Images to send, in order
+        model (str): Model they are sent to
+        max_images (int): Further cap on the images per request
+
+    Returns:
+        list: Groups of indices into ``image_paths``
+    """
+    limits = get_image_limits(model)
+    count = min(limits["MAX_IMAGES"], max_images or limits["MAX_IMAGES"])
+    groups, current, size = [], [], 0
+    for i, image_path in enumerate(image_paths):
+        encoded = _encoded_size(prepare_image(image_path, model)[1])
+        if current and (len(current) >= count or size + encoded > limits["MAX_REQUEST_BYTES"]):
+            groups.append(current)
+            current, size = [], 0
+        current.append(i)
+        size += encoded
+    if current:
+        groups.append(current)
+    return groups
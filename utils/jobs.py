@@ -0,0 +1,321 @@
+import os, json, time, uuid, shutil, socket, sqlite3, logging, threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Sequence, Union
+from utils.cache import CACHE_DIR
+from utils.pipeline import take_notes, LocalFile, BATCH_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# batches.finished
+RUNNING, FINISHED, FINISHED_WITH_FAILURES = 0, 1, 2
+
+
+class BatchInUseError(RuntimeError):
+    def __init__(self, batch_id):
+        super().__init__(f"Batch '{batch_id}' is already being run by another session or process")
+
+
+class JobStore:
+    """
+    Durable record of note-taking batches, one job per uploaded file.
+
+    Every file of a batch is spooled to disk when the batch is submitted, and
+    each job remembers the last stage it completed together with the artifacts
+    of that stage (extracted text, generated and formatted notes, note path),
+    so a batch interrupted by a rerun, a closed tab or a crash can be resumed
+    from where each file stopped instead of being paid for again.
+
+    A batch is run under a lease: the runner stamps the batch with its owner
+    and refreshes a heartbeat while it runs, so other tabs, sessions and
+    processes can tell a batch that is still running from one that was
+    interrupted (``BATCH.LEASE_SECONDS`` without a heartbeat).
+
+    Args:
+        path (str): Location of the SQLite file
+        spool_dir (str): Folder the uploaded files and scratch images are kept in
+    """
+
+    def __init__(self, path: str = os.path.join(CACHE_DIR, "jobs.sqlite3"), spool_dir: str = os.path.join(CACHE_DIR, "jobs")):
+        self.path = path
+        self.spool_dir = spool_dir
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS batches ("
+                "id TEXT PRIMARY KEY, created REAL NOT NULL, options TEXT NOT NULL, finished INTEGER NOT NULL DEFAULT 0, "
+                "owner TEXT, heartbeat REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "batch_id TEXT NOT NULL, idx INTEGER NOT NULL, name TEXT NOT NULL, path TEXT NOT NULL, "
+                "title TEXT NOT NULL, vault_path TEXT NOT NULL, stage TEXT, artifacts TEXT NOT NULL DEFAULT '{}', "
+                "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, updated REAL NOT NULL, gave_up INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (batch_id, idx))"
+            )
+            # Stores created before leases and give-ups were tracked
+            for table, column, definition in (
+                ("batches", "owner", "TEXT"),
+                ("batches", "heartbeat", "REAL"),
+                ("jobs", "gave_up", "INTEGER NOT NULL DEFAULT 0"),
+            ):
+                if column not in [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _batch_dir(self, batch_id: str) -> str:
+        return os.path.join(self.spool_dir, batch_id)
+
+    def create_batch(self, files: List[Any], title: Union[str, Sequence[str]], vault_path: Union[str, Sequence[str]], options: Dict[str, Any]) -> str:
+        """
+        Spool ``files`` to disk and record one pending job per file.
+
+        Args:
+            files (list): Uploaded files (anything with ``name`` and ``getbuffer``)
+            title (str | list): Note title, or one title per file
+            vault_path (str | list): Vault folder, or one folder per file
+            options (dict): Keyword arguments the batch is run with (models, OCR)
+
+        Returns:
+            str: Id of the new batch
+        """
+        batch_id = uuid.uuid4().hex
+        batch_dir = self._batch_dir(batch_id)
+        os.makedirs(batch_dir, exist_ok=True)
+        now = time.time()
+        rows = []
+        for i, file in enumerate(files):
+            path = os.path.join(batch_dir, f"{i:05d}{os.path.splitext(file.name)[1]}")
+            with open(path, "wb") as f:
+                f.write(file.getbuffer())
+            rows.append((
+                batch_id, i, file.name, path,
+                title if isinstance(title, str) else title[i],
+                vault_path if isinstance(vault_path, str) else vault_path[i],
+                now,
+            ))
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            conn.execute("INSERT INTO batches(id, created, options) VALUES (?, ?, ?)", (batch_id, now, json.dumps(options)))
+            conn.executemany("INSERT INTO jobs(batch_id, idx, name, path, title, vault_path, updated) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("COMMIT")
+        logger.info("Created batch %s with %d job(s)", batch_id, len(rows))
+        return batch_id
+
+    def options(self, batch_id: str) -> Dict[str, Any]:
+        with self._lock:
+            row = self._connect().execute("SELECT options FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown batch '{batch_id}'")
+        return json.loads(row[0])
+
+    def jobs(self, batch_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT idx, name, path, title, vault_path, stage, artifacts, attempts, error, gave_up FROM jobs WHERE batch_id = ? ORDER BY idx",
+                (batch_id,),
+            ).fetchall()
+        return [
+            {
+                "index": idx, "name": name, "path": path, "title": title, "vault_path": vault_path,
+                "stage": stage, "artifacts": json.loads(artifacts), "attempts": attempts, "error": error,
+                "gave_up": bool(gave_up),
+            }
+            for idx, name, path, title, vault_path, stage, artifacts, attempts, error, gave_up in rows
+        ]
+
+    def record(self, batch_id: str, index: int, stage: Optional[str], artifacts: Dict[str, Any]):
+        """Mark ``stage`` as completed for a job and store the artifacts it produced; ``None`` only stores the artifacts."""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT artifacts FROM jobs WHERE batch_id = ? AND idx = ?", (batch_id, index)).fetchone()
+            merged = {**json.loads(row[0]), **artifacts} if row else artifacts
+            conn.execute(
+                "UPDATE jobs SET stage = COALESCE(?, stage), artifacts = ?, error = NULL, updated = ? WHERE batch_id = ? AND idx = ?",
+                (stage, json.dumps(merged), time.time(), batch_id, index),
+            )
+
+    def record_writing(self, batch_id: str, index: int, note_path: str, offset: int):
+        """
+        Note that a job's section is about to be appended to ``note_path``, which is ``offset`` bytes long.
+
+        If the process dies between the append and recording the ``written``
+        stage, a resumed run finds the section after ``offset`` and does not
+        append it a second time.
+        """
+        self.record(batch_id, index, None, {"writing": {"note_path": note_path, "offset": offset}})
+
+    def record_failure(self, batch_id: str, index: int, error: BaseException, attempts: int, final: bool = False):
+        """Count a failed run of a job; it is given up on when ``final`` or after ``BATCH.MAX_ATTEMPTS`` attempts in all."""
+        with self._lock:
+            self._connect().execute(
+                "UPDATE jobs SET attempts = attempts + ?, error = ?, updated = ?, "
+                "gave_up = CASE WHEN ? OR attempts + ? >= ? THEN 1 ELSE 0 END WHERE batch_id = ? AND idx = ?",
+                (attempts, f"{type(error).__name__}: {error}", time.time(), final, attempts, BATCH_CONFIG["MAX_ATTEMPTS"], batch_id, index),
+            )
+
+    def keep_file(self, batch_id: str, index: int, path: str, part: Optional[int] = None) -> str:
+        """Move a scratch file (e.g. a prepared image, or ``part`` of several) into the batch's spool folder so it survives a restart."""
+        suffix = "" if part is None else f".{part:05d}"
+        target = os.path.join(self._batch_dir(batch_id), f"{index:05d}.scratch{suffix}{os.path.splitext(path)[1]}")
+        shutil.move(path, target)
+        return target
+
+    def unfinished(self) -> List[Dict[str, Any]]:
+        """
+        Batches with at least one job that has not been written or given up on yet, oldest first.
+
+        ``running`` is set for batches whose lease is live, i.e. that another tab,
+        session or process is running right now.
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT b.id, b.created, b.options, b.owner IS NOT NULL AND b.heartbeat >= ?, COUNT(*), "
+                "SUM(CASE WHEN j.stage = 'written' THEN 1 ELSE 0 END), SUM(CASE WHEN j.error IS NOT NULL THEN 1 ELSE 0 END) "
+                "FROM batches b JOIN jobs j ON j.batch_id = b.id WHERE b.finished = ? GROUP BY b.id ORDER BY b.created",
+                (time.time() - BATCH_CONFIG["LEASE_SECONDS"], RUNNING),
+            ).fetchall()
+        return [
+            {"id": batch_id, "created": created, "options": json.loads(options), "running": bool(running), "total": total, "written": written, "failed": failed}
+            for batch_id, created, options, running, total, written, failed in rows
+        ]
+
+    def _acquire(self, batch_id: str) -> Optional[str]:
+        owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        now = time.time()
+        with self._lock:
+            cursor = self._connect().execute(
+                "UPDATE batches SET owner = ?, heartbeat = ? WHERE id = ? AND finished = ? AND (owner IS NULL OR heartbeat < ?)",
+                (owner, now, batch_id, RUNNING, now - BATCH_CONFIG["LEASE_SECONDS"]),
+            )
+        return owner if cursor.rowcount else None
+
+    def _heartbeat(self, batch_id: str, owner: str):
+        with self._lock:
+            self._connect().execute("UPDATE batches SET heartbeat = ? WHERE id = ? AND owner = ?", (time.time(), batch_id, owner))
+
+    def _release(self, batch_id: str, owner: str):
+        with self._lock:
+            self._connect().execute("UPDATE batches SET owner = NULL, heartbeat = NULL WHERE id = ? AND owner = ?", (batch_id, owner))
+
+    @contextmanager
+    def lease(self, batch_id: str):
+        """
+        Hold the batch's lease while the block runs, refreshing its heartbeat in the background.
+
+        Raises:
+            BatchInUseError: The batch is finished or its lease is held by a live runner
+        """
+        owner = self._acquire(batch_id)
+        if owner is None:
+            raise BatchInUseError(batch_id)
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(BATCH_CONFIG["LEASE_SECONDS"] / 3):
+                try:
+                    self._heartbeat(batch_id, owner)
+                except sqlite3.Error as e:
+                    logger.warning("Could not refresh the lease of batch %s: %s", batch_id, e)
+
+        heartbeat = threading.Thread(target=beat, name=f"batch-lease-{batch_id[:8]}", daemon=True)
+        heartbeat.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            heartbeat.join()
+            self._release(batch_id, owner)
+
+    def finish(self, batch_id: str, failed: bool = False):
+        """Mark a batch as done, or done with failures, and drop its spooled files; the job records are kept."""
+        with self._lock:
+            self._connect().execute("UPDATE batches SET finished = ? WHERE id = ?", (FINISHED_WITH_FAILURES if failed else FINISHED, batch_id))
+        shutil.rmtree(self._batch_dir(batch_id), ignore_errors=True)
+        if failed:
+            logger.warning("Batch %s finished with failures", batch_id)
+        else:
+            logger.info("Batch %s finished", batch_id)
+
+    def discard(self, batch_id: str):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM jobs WHERE batch_id = ?", (batch_id,))
+            conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+            conn.execute("COMMIT")
+        shutil.rmtree(self._batch_dir(batch_id), ignore_errors=True)
+        logger.info("Batch %s discarded", batch_id)
+
+
+job_store = JobStore()
+
+
+def resume_batch(batch_id: str, **kwargs) -> List[Dict[str, Any]]:
+    """
+    Run every unfinished job of a batch, starting each file after its last completed stage.
+
+    The batch is finished once every file is written, or finished with failures
+    once the files that are not have been given up on (``BATCH.MAX_ATTEMPTS``).
+
+    Args:
+        batch_id (str): Batch to run
+        **kwargs: Run-time options passed on to ``take_notes`` (callbacks, cache, workers, streaming)
+
+    Returns:
+        list: Result dicts as returned by ``take_notes``, one per file of the batch
+
+    Raises:
+        BatchInUseError: Another session or process is running the batch
+    """
+    with job_store.lease(batch_id):
+        jobs = job_store.jobs(batch_id)
+        results = take_notes(
+            [LocalFile(job["path"], name=job["name"]) for job in jobs],
+            title=[job["title"] for job in jobs],
+            vault_path=[job["vault_path"] for job in jobs],
+            **job_store.options(batch_id),
+            job_store=job_store,
+            batch_id=batch_id,
+            **kwargs,
+        )
+        if all(result["note_path"] for result in results):
+            job_store.finish(batch_id)
+        elif all(job["stage"] == "written" or job["gave_up"] for job in job_store.jobs(batch_id)):
+            job_store.finish(batch_id, failed=True)
+    return results
+
+
+def submit_batch(
+    files: List[Any],
+    title: Union[str, Sequence[str]],
+    vault_path: Union[str, Sequence[str]],
+    model_generation: str,
+    model_formatting: str,
+    ocr_enhance: bool = False,
+    **kwargs,
+) -> List[Dict[str, Any]]:
+    """Record ``files`` as a durable batch and run it; see :func:`resume_batch` to pick it up again."""
+    batch_id = job_store.create_batch(
+        files, title, vault_path,
+        {"model_generation": model_generation, "model_formatting": model_formatting, "ocr_enhance": ocr_enhance},
+    )
+    return resume_batch(batch_id, **kwargs)
+
+
+def unfinished_batches() -> List[Dict[str, Any]]:
+    return job_store.unfinished()
+
+
+def discard_batch(batch_id: str):
+    # Only once no one is running it, so its spool folder is not pulled out from under a runner
+    with job_store.lease(batch_id):
+        job_store.discard(batch_id)
@@ -1,21 +1,41 @@
-import json, base64, os
-from typing import List, Tuple, Union
-import ollama
-import google.generativeai as genai
-from openai import OpenAI
-from mistralai import Mistral
-from groq import Groq
-from utils.cypher.key import get_api_key
+import re, json, time, base64, hashlib, os, asyncio, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import lru_cache
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+from utils.cypher.key import get_api_key, get_secrets_version
+from utils.cache import open_cache, make_key
+from utils.chunking import CHUNKING_CONFIG, PAGE_BREAK, chunk_document, estimate_tokens, get_context_size, get_input_budget, split_text, strip_markers
+from utils.clients import get_openai_client, get_groq_client, get_mistral_client, get_ollama_client, get_gemini_model
+from utils.ratelimit import rate_limited, retry_after, ADAPTIVE_CONFIG
+from utils.markdown import normalize_markdown
+from utils.images import prepare_image, pack_images, get_image_limits
 from dotenv import load_dotenv
-from PIL import Image
 
 config = json.load(open("config.json"))
 PROVIDER_KEYS = config["PROVIDER_KEYS"]
+PROVIDER_CONCURRENCY = config["PROVIDER_CONCURRENCY"]
 MODEL_PROVIDER_MAPPING = config["MODEL_PROVIDER_MAPPING"]
+HEDGING_CONFIG = config["HEDGING"]
+FORMATTING_CONFIG = config["FORMATTING"]
+PACKING_CONFIG = config["PACKING"]
 
 ENV_FILE = config["ENV_FILE"]
 load_dotenv(ENV_FILE, override=True)
 
+GENERATION_OPTIONS = {"temperature": 0.4, "max_tokens": 8192}
+
+llm_cache = open_cache("LLM")
+
+# Enough threads for every provider to reach its concurrency ceiling at once
+_llm_executor = ThreadPoolExecutor(max_workers=sum(PROVIDER_CONCURRENCY.values()) + 4, thread_name_prefix="llm")
+# Hedged requests race on their own threads so a waiting caller never starves its own contenders
+_hedge_executor = ThreadPoolExecutor(max_workers=2 * sum(PROVIDER_CONCURRENCY.values()), thread_name_prefix="llm-hedge")
+
+# Recent response latencies per (kind, model, streaming), used to place the hedging deadline
+_latencies = {}
+_latencies_lock = threading.Lock()
+
 GENERATE_NOTES_SYSTEM_PROMPT = f"""You are a great note taker. Take concise and well-organized notes from the uploaded images or text. Focus on clarity and conciseness, without additional commentary. Capture key information directly, using the following structure:
     Title: Use a relevant and descriptive title.
     Summary: Provide a brief overview summarizing the main points. Hightlight important terms with ==highlight==, **bold**, *italics*, ***Bold & Italic.
@@ -32,8 +52,34 @@ FORMAT_NOTES_SYSTEM_PROMPT = f"""Review the provided text and ensure it is struc
     2. LaTeX Equations: Check each LaTeX expression to ensure it is syntactically correct, fixing any errors in commands, symbols, or structures. If any LaTeX syntax is misplaced or missing (such as $ or $$ for inline or block math), adjust accordingly. Ensure that all inline LaTeX expressions are within $...$ and all block equations within $$...$$.
     3. Corrective Changes: Make suitable corrections to any Markdown or LaTeX syntax that doesn't comply with standard formatting. After completing these checks and corrections, output only the revised Markdown text without additional commentary."""
 
+REDUCE_NOTES_SYSTEM_PROMPT = f"""You are a great note taker. The provided text contains partial notes taken from consecutive parts of one document, separated by lines of ===. Merge them into a single concise and well-organized set of notes for the whole document, without additional commentary, using the following structure:
+    Title: Use a relevant and descriptive title for the whole document.
+    Summary: Provide a brief overview summarizing the main points of the whole document. Hightlight important terms with ==highlight==, **bold**, *italics*, ***Bold & Italic.
+    Detailed Notes: Combine the detailed notes in document order, removing repetition but keeping every essential detail, table, equation and solution.
+    Equations: Keep all equations in LaTeX, with inline LaTeX expressions within $...$ and all block equations within $$...$$.
+    If there is no content for a particular heading, skip that heading. Use Markdown Syntax but DO NOT USE the markdown codeblock.
+    """
+
+PACKED_NOTES_SYSTEM_PROMPT = GENERATE_NOTES_SYSTEM_PROMPT + """The images are separate, unrelated sources, each introduced by a text part naming it as Source 1, Source 2 and so on. Take separate notes for every source, in the order given, and start the notes of each source with a line containing only its marker, <<<SOURCE n>>> where n is the number of the source. Write nothing before the first marker.
+    """
+
+# Marker lines the packed answer is split on, one per source
+SOURCE_MARKER = re.compile(r"^[ \t]*<<<SOURCE (\d+)>>>[ \t]*$", re.M)
+
+PARTIAL_NOTES_SEPARATOR = "\n\n===\n\n"
+
+# Shorter form of the preamble for the text sent with each of several images
+OCR_CAPTION_PREAMBLE = "Text extracted from it using OCR, which may contain errors: "
+
+OCR_INFO_PREAMBLE = "I'm sharing text extracted from image/pdf using OCR. This additional text can help verify or supplement the information in our discussion. Please review the extracted text for accuracy and reference it as needed: "
+
 
 def get_providers():
+    # Reruns ask on every interaction; the answer only changes with the keys
+    return list(_providers(get_secrets_version()))
+
+@lru_cache(maxsize=1)
+def _providers(secrets_version):
     providers = []
     for provider, keys in PROVIDER_KEYS.items():
         use_provider = True
@@ -43,9 +89,14 @@ def get_providers():
                 break
         if use_provider:
             providers.append(provider)
-    return providers
+    return tuple(providers)
 
 def get_models(providers: List[str]):
+    generation_models, formatting_models = _models(tuple(providers))
+    return list(generation_models), list(formatting_models)
+
+@lru_cache(maxsize=8)
+def _models(providers):
     generation_models, formatting_models = [], []
 
     for provider in providers:
@@ -56,7 +107,10 @@ def get_models(providers: List[str]):
             else:
                 formatting_models.append(model)
 
-    return generation_models, formatting_models
+    return tuple(generation_models), tuple(formatting_models)
+
+def is_multimodal(model_name):
+    return any(models.get(model_name) == "multimodal" for models in MODEL_PROVIDER_MAPPING.values())
 
 def get_model_provider(model_name):
     for provider, models in MODEL_PROVIDER_MAPPING.items():
@@ -73,25 +127,105 @@ class MissingAPIKeyError(Exception):
     def __init__(self, provider):
         super().__init__(f"API key for provider '{provider}' is missing or not configured correctly")
 
+class RequestCancelled(Exception):
+    def __init__(self, model):
+        super().__init__(f"Request to '{model}' was cancelled after another model answered first")
+
+class FallbackChainFailed(Exception):
+    def __init__(self, models, error):
+        super().__init__(f"Every model of the fallback chain failed ({', '.join(models)}); last error: {error}")
+
+class _Cancellation(threading.Event):
+    """An event that also runs callbacks when it is set, to abort a request blocked waiting on the network."""
+
+    def __init__(self):
+        super().__init__()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def set(self):
+        with self._callbacks_lock:
+            super().set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            _close_quietly(callback)
+
+    def on_set(self, callback):
+        with self._callbacks_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return
+        _close_quietly(callback)
+
+def _close_quietly(close):
+    try:
+        close()
+    except Exception as e:
+        print("Error closing cancelled request:", e)
+
 def get_provider_api_key(provider_name, key_name):
     api_key = get_api_key(key_name)
     if not api_key:
         raise MissingAPIKeyError(provider_name)
     return api_key
 
-def get_image_data_url(image_file: str, image_format: str) -> Tuple[Union[str, None], Union[str, None]]:
+def get_image_data_url(image_file: str, model: str) -> Tuple[Union[str, None], Union[str, None]]:
     try:
-        with open(image_file, "rb") as f:
-            image_data = base64.b64encode(f.read()).decode("utf-8")
+        mime_type, image_data = prepare_image(image_file, model)
     except FileNotFoundError:
         raise FileNotFoundError
     except Exception as e:
         print(f"{e}. \nCould not read '{image_file}'.")
         return None, None
-    return image_format, image_data
+    return mime_type, base64.b64encode(image_data).decode("utf-8")
+
+def _image_parts(image_path: Union[str, Sequence[str]], ocr_info: Union[str, Sequence[str]]) -> List[Tuple[str, str]]:
+    # A request carries one image or several; with several, ``ocr_info`` may hold the text sent with each of them
+    if isinstance(image_path, str):
+        return [(ocr_info, image_path)]
+    if isinstance(ocr_info, str):
+        return [(ocr_info if i == 0 else "", path) for i, path in enumerate(image_path)]
+    return list(zip(ocr_info, image_path))
+
+def _image_content(image_path, ocr_info: str, model: str) -> List[dict]:
+    # OpenAI-style content parts (OpenAI, Groq, Mistral): each image follows its text
+    content = []
+    for text, path in _image_parts(image_path, ocr_info):
+        mime_type, image_data = get_image_data_url(path, model)
+        if text or not content:
+            content.append({"type": "text", "text": f"{text}"})
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{mime_type};base64,{image_data}",
+                "detail": "auto"
+            }
+        })
+    return content
+
+def _stream_deltas(chunks):
+    # OpenAI-style streams (OpenAI, Groq, Mistral) carry the text in choices[0].delta.content
+    for chunk in chunks:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+class _ProviderStream:
+    """Text chunks of a streamed answer, with the response they are read from so another thread can close it."""
+
+    def __init__(self, chunks, response):
+        self._chunks = chunks
+        self._response = response
 
+    def __iter__(self):
+        return iter(self._chunks)
 
-def generate_notes_with_ollama(file=None, image_path=None, ocr_info: str = "", model: str="llama3.2-vision", SYSTEM_PROMPT: str = GENERATE_NOTES_SYSTEM_PROMPT):
+    def close(self):
+        # Closing the HTTP response unblocks a read waiting on a stalled provider
+        close = getattr(self._response, "close", None)
+        if close:
+            close()
+
+def generate_notes_with_ollama(file=None, image_path=None, ocr_info: str = "", model: str="llama3.2-vision", SYSTEM_PROMPT: str = GENERATE_NOTES_SYSTEM_PROMPT, stream: bool = False):
     message=[
         {
             "role": "system",
@@ -109,44 +243,51 @@ def generate_notes_with_ollama(file=None, image_path=None, ocr_info: str = "", m
         )
 
     if image_path:
-        image = [f"{get_image_data_url(image_path, 'png')[1]}"]
-        message.append(
-            {
-                "role": "user",
-                "content" : ocr_info,
-                "images": image,
-            }
-        )
+        for text, path in _image_parts(image_path, ocr_info):
+            image = [f"{get_image_data_url(path, model)[1]}"]
+            message.append(
+                {
+                    "role": "user",
+                    "content" : text,
+                    "images": image,
+                }
+            )
 
     options = {
-        "temperature": 0.4,
-        "num_ctx": 8192,
+        "temperature": GENERATION_OPTIONS["temperature"],
+        "num_ctx": get_context_size(model),
         "num_thread": 8,
     }
 
-    response = ollama.chat(model = model, messages=message, options=options)
+    response = get_ollama_client().chat(model = model, messages=message, options=options, stream=stream)
+    if stream:
+        return _ProviderStream((part.message.content for part in response if part.message.content), response)
     return response.message.content
 
-def generate_notes_with_gemini(file=None, image_path=None, ocr_info: str = "", model: str="gemini-1.5-flash-8b",  SYSTEM_PROMPT: str = GENERATE_NOTES_SYSTEM_PROMPT):
+def generate_notes_with_gemini(file=None, image_path=None, ocr_info: str = "", model: str="gemini-1.5-flash-8b",  SYSTEM_PROMPT: str = GENERATE_NOTES_SYSTEM_PROMPT, stream: bool = False):
     gemini_api_key = get_provider_api_key("Google Gemini", "GEMINI_API_KEY")
     
     message = []
 
     if image_path:
-        image = Image.open(image_path)
-        message.append(image)
-        message.append("\n" + ocr_info)
+        for text, path in _image_parts(image_path, ocr_info):
+            # Each image follows the text naming it, as in the OpenAI-style content parts
+            mime_type, image_data = prepare_image(path, model)
+            if text:
+                message.append(text + "\n")
+            message.append({"mime_type": mime_type, "data": image_data})
     
     if file:
         file = file + "\n" + ocr_info
         message.append(file)
 
-    genai.configure(api_key=gemini_api_key)
-    agent = genai.GenerativeModel(model_name=model, system_instruction=SYSTEM_PROMPT)
-    response = agent.generate_content(message, generation_config = {"temperature": 0.4, "max_output_tokens": 8192})
+    agent = get_gemini_model(gemini_api_key, model, SYSTEM_PROMPT)
+    response = agent.generate_content(message, generation_config = {"temperature": GENERATION_OPTIONS["temperature"], "max_output_tokens": GENERATION_OPTIONS["max_tokens"]}, stream=stream)
+    if stream:
+        return _ProviderStream((chunk.text for chunk in response if chunk.parts), response)
     return response.text
 
-def generate_notes_with_gpt(file=None, image_path=None, ocr_info: str = "", model: str="gpt-4o", SYSTEM_PROMPT: str = GENERATE_NOTES_SYSTEM_PROMPT):
+def generate_notes_with_gpt(file=None, image_path=None, ocr_info: str = "", model: str="gpt-4o", SYSTEM_PROMPT: str = GENERATE_NOTES_SYSTEM_PROMPT, stream: bool = False):
     openai_api_key = get_provider_api_key("OpenAI", "OPENAI_API_KEY")
     openai_endpoint = get_provider_api_key("OpenAI", "OPENAI_ENDPOINT")
 
@@ -167,29 +308,20 @@ def generate_notes_with_gpt(file=None, image_path=None, ocr_info: str = "", mode
         )
 
     if image_path:
-        image_format, image_data = get_image_data_url(image_path, "png")
-        image = {
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/{image_format};base64,{image_data}",
-                "detail": "auto"
-            }
-        }
         messages.append(
             {
                 "role": "user",
-                "content": [
-                    {"type": "text", "text": f"{ocr_info}"},
-                    image,
-                ]
+                "content": _image_content(image_path, ocr_info, model),
             }
         )
 
-    client = OpenAI(base_url=openai_endpoint, api_key=openai_api_key)
-    response = client.chat.completions.create(messages=messages, model=model, temperature=0.4, max_tokens=8192)
+    client = get_openai_client(openai_api_key, openai_endpoint)
+    response = client.chat.completions.create(messages=messages, model=model, temperature=GENERATION_OPTIONS["temperature"], max_tokens=GENERATION_OPTIONS["max_tokens"], stream=stream)
+    if stream:
+        return _ProviderStream(_stream_deltas(response), response)
     return response.choices[0].message.content
 
-def generate_notes_with_mistralai(file=None, image_path=None, ocr_info: str = "", model: str="pixtral-12b-2409", SYSTEM_PROMPT: str = GENERATE_NOTES_SYSTEM_PROMPT):
+def generate_notes_with_mistralai(file=None, image_path=None, ocr_info: str = "", model: str="pixtral-12b-2409", SYSTEM_PROMPT: str = GENERATE_NOTES_SYSTEM_PROMPT, stream: bool = False):
     mistralai_api_key = get_provider_api_key("Mistral AI", "MISTRALAI_API_KEY")
 
     messages=[
@@ -209,29 +341,21 @@ def generate_notes_with_mistralai(file=None, image_path=None, ocr_info: str = ""
         )
 
     if image_path:
-        image_format, image_data = get_image_data_url(image_path, "png")
-        image = {
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/{image_format};base64,{image_data}",
-                "detail": "auto"
-            }
-        }
         messages.append(
             {
                 "role": "user",
-                "content": [
-                    {"type": "text", "text": f"{ocr_info}"},
-                    image,
-                ]
+                "content": _image_content(image_path, ocr_info, model),
             }
         )
 
-    client = Mistral(api_key=mistralai_api_key)
-    response = client.chat.complete(messages=messages, model=model, temperature=0.4, max_tokens=8192)
+    client = get_mistral_client(mistralai_api_key)
+    if stream:
+        response = client.chat.stream(messages=messages, model=model, temperature=GENERATION_OPTIONS["temperature"], max_tokens=GENERATION_OPTIONS["max_tokens"])
+        return _ProviderStream(_stream_deltas(event.data for event in response), response)
+    response = client.chat.complete(messages=messages, model=model, temperature=GENERATION_OPTIONS["temperature"], max_tokens=GENERATION_OPTIONS["max_tokens"])
     return response.choices[0].message.content
 
-def generate_notes_with_groq(file=None, image_path=None, ocr_info: str = "", model: str="mixtral-8x7b-32768", SYSTEM_PROMPT: str = GENERATE_NOTES_SYSTEM_PROMPT):
+def generate_notes_with_groq(file=None, image_path=None, ocr_info: str = "", model: str="mixtral-8x7b-32768", SYSTEM_PROMPT: str = GENERATE_NOTES_SYSTEM_PROMPT, stream: bool = False):
     groq_api_key = get_provider_api_key("Groq", "GROQ_API_KEY")
 
     messages=[
@@ -251,78 +375,431 @@ def generate_notes_with_groq(file=None, image_path=None, ocr_info: str = "", mod
         )
 
     if image_path:
-        image_format, image_data = get_image_data_url(image_path, "png")
-        image = {
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/{image_format};base64,{image_data}",
-                "detail": "auto"
-            }
-        }
         messages.append(
             {
                 "role": "user",
-                "content": [
-                    {"type": "text", "text": f"{ocr_info}"},
-                    image,
-                ]
+                "content": _image_content(image_path, ocr_info, model),
             }
         )
 
-    client = Groq(api_key=groq_api_key)
-    response = client.chat.completions.create(messages=messages, model=model, temperature=0.4, max_tokens=8192)
+    client = get_groq_client(groq_api_key)
+    response = client.chat.completions.create(messages=messages, model=model, temperature=GENERATION_OPTIONS["temperature"], max_tokens=GENERATION_OPTIONS["max_tokens"], stream=stream)
+    if stream:
+        return _ProviderStream(_stream_deltas(response), response)
     return response.choices[0].message.content
 
 
-def generate_notes(file=None, image_path=None, ocr_enhance_info: str = "", model: str="gemini-1.5-flash-8b"):
-    results = None
+PROVIDER_FUNCTIONS = {
+    "Google Gemini": generate_notes_with_gemini,
+    "OpenAI": generate_notes_with_gpt,
+    "Mistral AI": generate_notes_with_mistralai,
+    "Groq": generate_notes_with_groq,
+    "Ollama": generate_notes_with_ollama,
+}
+
+def _image_count(image_path) -> int:
+    if not image_path:
+        return 0
+    return 1 if isinstance(image_path, str) else len(image_path)
+
+def _ocr_text(ocr_info) -> str:
+    return ocr_info if isinstance(ocr_info, str) else "\n".join(ocr_info)
+
+def _estimate_prompt_tokens(file=None, image_path=None, ocr_info="", SYSTEM_PROMPT="", **kwargs):
+    prompt_tokens = estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(file) + estimate_tokens(_ocr_text(ocr_info))
+    return prompt_tokens + _image_count(image_path) * CHUNKING_CONFIG["IMAGE_TOKENS"]
+
+def _call_provider(provider, on_chunk=None, cancel=None, **kwargs):
+    """
+    Run a provider call within the provider's rate limits and adaptive concurrency.
+
+    With ``on_chunk`` the provider streams and every chunk is handed to the
+    callback as it arrives; either way the chunks are assembled in linear time.
+    With a ``cancel`` event the call always streams so that it can be abandoned
+    between chunks once the event is set. Throttled requests are retried after
+    the provider's Retry-After, unless part of the answer was already streamed
+    to the caller.
+    """
+    prompt_tokens = _estimate_prompt_tokens(**kwargs)
+    # Notes come out at most about as long as what went in
+    tokens = prompt_tokens + min(prompt_tokens, GENERATION_OPTIONS["max_tokens"])
+    attempt = 0
+    while True:
+        attempt += 1
+        chunks = []
+        try:
+            with rate_limited(provider, kwargs["model"], tokens) as usage:
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled(kwargs["model"])
+                if on_chunk is None and cancel is None:
+                    results = PROVIDER_FUNCTIONS[provider](**kwargs)
+                else:
+                    stream = PROVIDER_FUNCTIONS[provider](stream=True, **kwargs)
+                    if cancel is not None and hasattr(stream, "close"):
+                        # A cancelled request stuck waiting on the provider is cut off rather than
+                        # holding its thread, concurrency slot and connection until the timeout
+                        cancel.on_set(stream.close)
+                    for chunk in stream:
+                        if cancel is not None and cancel.is_set():
+                            # Closing the generator drops the HTTP stream
+                            stream.close()
+                            raise RequestCancelled(kwargs["model"])
+                        chunks.append(chunk)
+                        if on_chunk:
+                            on_chunk(chunk)
+                    results = "".join(chunks)
+                usage.tokens = prompt_tokens + estimate_tokens(results)
+            return results
+        except Exception as e:
+            if cancel is not None and cancel.is_set() and not isinstance(e, RequestCancelled):
+                # The read failed because the stream was closed on cancellation
+                raise RequestCancelled(kwargs["model"]) from e
+            delay = retry_after(e)
+            if delay is None or chunks or attempt > ADAPTIVE_CONFIG["MAX_RETRIES"]:
+                raise
+            print(f"{provider} is throttling requests; retrying in {delay:.1f}s (attempt {attempt})")
+
+def _read_image_bytes(image_path):
+    if not image_path:
+        return b""
+    if not isinstance(image_path, str):
+        return b"".join(hashlib.sha256(_read_image_bytes(path)).digest() for path in image_path)
+    with open(image_path, "rb") as f:
+        return f.read()
+
+def llm_cache_stats():
+    return llm_cache.stats()
+
+def _ocr_info(ocr_text: str):
+    if not ocr_text:
+        return ""
+    return OCR_INFO_PREAMBLE + ocr_text
+
+def _run_cached(kind, provider, model, system_prompt, use_cache, on_chunk, file=None, image_path=None, ocr_info="", cancel=None):
+    cache_key = None
+    if use_cache:
+        cache_key = make_key(kind, model, system_prompt, GENERATION_OPTIONS, file, ocr_info, _read_image_bytes(image_path))
+        cached = llm_cache.get_text(cache_key)
+        if cached is not None:
+            print(f"Using cached response ({kind}) for model: {model, provider}")
+            if on_chunk:
+                on_chunk(cached)
+            return cached
+
+    results = _call_provider(provider, on_chunk, cancel, file=file, image_path=image_path, ocr_info=ocr_info, model=model, SYSTEM_PROMPT=system_prompt)
+
+    if cache_key and results:
+        llm_cache.set_text(cache_key, results)
+    return results
+
+def _record_latency(key, seconds):
+    with _latencies_lock:
+        _latencies.setdefault(key, deque(maxlen=HEDGING_CONFIG["WINDOW"])).append(seconds)
+
+def _hedge_deadline(key):
+    """Latency percentile of recent requests like this one, or the default until enough were seen."""
+    with _latencies_lock:
+        samples = sorted(_latencies.get(key, ()))
+    if len(samples) < HEDGING_CONFIG["MIN_SAMPLES"]:
+        return HEDGING_CONFIG["DEFAULT_DEADLINE_SECONDS"]
+    return samples[min(len(samples) - 1, int(len(samples) * HEDGING_CONFIG["PERCENTILE"] / 100))]
+
+def _fallback_models(model, system_prompt, file=None, image_path=None, ocr_info=""):
+    """Models from the fallback chain, in order, that are configured and can take this request."""
+    providers = get_providers()
+    prompt_tokens = _estimate_prompt_tokens(file=file, image_path=image_path, ocr_info=ocr_info)
+    candidates = []
+    for candidate in HEDGING_CONFIG["FALLBACK_CHAIN"]:
+        if candidate == model:
+            continue
+        try:
+            provider = get_model_provider(candidate)
+        except UnRegisteredModelError:
+            continue
+        if provider not in providers:
+            continue
+        if image_path and MODEL_PROVIDER_MAPPING[provider][candidate] != "multimodal":
+            continue
+        if _image_count(image_path) > get_image_limits(candidate)["MAX_IMAGES"]:
+            continue
+        if get_input_budget(candidate, GENERATION_OPTIONS["max_tokens"], system_prompt) < prompt_tokens:
+            continue
+        candidates.append(candidate)
+    return candidates
+
+def _run_hedged(kind, model, secondary, system_prompt, use_cache, on_chunk, **request):
+    """
+    Send the request to ``model`` and, if it has not answered by the deadline, also to ``secondary``.
+
+    The first model to answer wins and the other one is cancelled. When
+    streaming, answering means producing the first chunk, so only the winner
+    ever streams to ``on_chunk``.
+    """
+    streaming = on_chunk is not None
+    cancels = {model: _Cancellation(), secondary: _Cancellation()}
+    winner = []
+    lock = threading.Lock()
+    started = {model: time.monotonic()}
+
+    def claim(contender):
+        with lock:
+            if not winner:
+                winner.append(contender)
+                _record_latency((kind, contender, streaming), time.monotonic() - started[contender])
+                if contender != model:
+                    # The primary took at least this long; leaving it out would only keep the
+                    # fast answers and pull the deadline down until every request is hedged
+                    _record_latency((kind, model, streaming), time.monotonic() - started[model])
+                for other, cancel in cancels.items():
+                    if other != contender:
+                        cancel.set()
+            return winner[0] == contender
+
+    def run(contender):
+        def forward(chunk):
+            if not claim(contender):
+                raise RequestCancelled(contender)
+            on_chunk(chunk)
+
+        results = _run_cached(kind, get_model_provider(contender), contender, system_prompt, use_cache, forward if streaming else None, cancel=cancels[contender], **request)
+        if not claim(contender):
+            raise RequestCancelled(contender)
+        return results
+
+    futures = [_hedge_executor.submit(run, model)]
+    deadline = _hedge_deadline((kind, model, streaming))
+    done, _ = wait(futures, timeout=deadline)
+    if not done:
+        print(f"{model} has not answered within {deadline:.1f}s; hedging with {secondary}")
+        started[secondary] = time.monotonic()
+        futures.append(_hedge_executor.submit(run, secondary))
+
+    error = None
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            futures.remove(future)
+            try:
+                return future.result()
+            except RequestCancelled:
+                continue
+            except Exception as e:
+                # The other contender may still come through
+                error = error or e
+    raise error
+
+def _run_model(kind, model, system_prompt, use_cache, on_chunk, hedge, file=None, image_path=None, ocr_info=""):
+    """
+    Run one request against ``model``, hedging slow answers and falling back on hard failures.
+
+    Models are tried in the order of ``HEDGING.FALLBACK_CHAIN``, starting with
+    ``model``, until one answers. Once part of an answer has been streamed the
+    error is raised instead, so the caller never sees two answers mixed. When
+    every model of a chain failed, :class:`FallbackChainFailed` is raised so that
+    callers do not retry the whole chain again.
+    """
+    request = {"file": file, "image_path": image_path, "ocr_info": ocr_info}
+    fallbacks = _fallback_models(model, system_prompt, **request)
+    chain = [model] + fallbacks
+    emitted = []
+
+    def forward(chunk):
+        emitted.append(True)
+        on_chunk(chunk)
+
+    for i, candidate in enumerate(chain):
+        try:
+            secondary = next((other for other in chain[i + 1:] if get_model_provider(other) != get_model_provider(candidate)), None)
+            if hedge and secondary:
+                return _run_hedged(kind, candidate, secondary, system_prompt, use_cache, forward if on_chunk else None, **request)
+            return _run_cached(kind, get_model_provider(candidate), candidate, system_prompt, use_cache, forward if on_chunk else None, **request)
+        except Exception as e:
+            if emitted or len(chain) == 1:
+                raise
+            if i == len(chain) - 1:
+                raise FallbackChainFailed(chain, e) from e
+            print(f"{candidate} failed ({e}); falling back to {chain[i + 1]}")
+
+def _map_chunks(function, items):
+    if len(items) == 1:
+        return [function(items[0])]
+    with ThreadPoolExecutor(max_workers=min(len(items), CHUNKING_CONFIG["WORKERS"]), thread_name_prefix="llm-chunk") as executor:
+        return list(executor.map(function, items))
+
+def _reduce_notes(partial_notes: List[str], model, use_cache, on_chunk, hedge):
+    # Merge in groups that fit the context until a single note is left; every round shrinks the input
+    budget = get_input_budget(model, GENERATION_OPTIONS["max_tokens"], REDUCE_NOTES_SYSTEM_PROMPT)
+    while len(partial_notes) > 1:
+        groups, current = [], []
+        for notes in partial_notes:
+            if current and estimate_tokens(PARTIAL_NOTES_SEPARATOR.join(current + [notes])) > budget:
+                groups.append(current)
+                current = []
+            current.append(notes)
+        groups.append(current)
+
+        if len(groups) == len(partial_notes):
+            # No two partial notes fit one request together; keep them side by side rather than overflow
+            print("Partial notes are too large to merge; concatenating them.")
+            notes = "\n\n".join(partial_notes)
+            if on_chunk:
+                on_chunk(notes)
+            return notes
+        final_round = len(groups) == 1
+        print(f"Merging {len(partial_notes)} partial notes in {len(groups)} group(s)")
+        partial_notes = _map_chunks(
+            lambda group: _run_model("reduce_notes", model, REDUCE_NOTES_SYSTEM_PROMPT, use_cache, on_chunk if final_round else None, hedge, file=PARTIAL_NOTES_SEPARATOR.join(group)),
+            groups,
+        )
+    return partial_notes[0]
 
-    ocr_info = ""
-    if len(ocr_enhance_info) > 0:
-        info = "\n".join(ocr_enhance_info)
-        ocr_info = f"""I'm sharing text extracted from image/pdf using OCR. This additional text can help verify or supplement the information in our discussion. Please review the extracted text for accuracy and reference it as needed: {info}"""
+def generate_notes(file=None, image_path=None, ocr_enhance_info: str = "", model: str="gemini-1.5-flash-8b", use_cache: bool = True, on_chunk: Optional[Callable[[str], None]] = None, hedge: Optional[bool] = None):
+    if not isinstance(ocr_enhance_info, str):
+        ocr_enhance_info = "\n".join(ocr_enhance_info)
+    if hedge is None:
+        hedge = HEDGING_CONFIG["ENABLED"]
 
     provider = get_model_provider(model)
-    print(f"Generating Notes using model: {model, provider}")
-
-    if provider == "Google Gemini":
-        results = generate_notes_with_gemini(file=file, image_path=image_path, ocr_info=ocr_info, model=model, SYSTEM_PROMPT=GENERATE_NOTES_SYSTEM_PROMPT)
-    elif provider == "OpenAI":
-        results = generate_notes_with_gpt(file=file, image_path=image_path, ocr_info=ocr_info, model=model, SYSTEM_PROMPT=GENERATE_NOTES_SYSTEM_PROMPT)
-    elif provider == "Mistral AI":
-        results = generate_notes_with_mistralai(file=file, image_path=image_path, ocr_info=ocr_info, model=model, SYSTEM_PROMPT=GENERATE_NOTES_SYSTEM_PROMPT)
-    elif provider == "Groq":
-        results = generate_notes_with_groq(file=file, image_path=image_path, ocr_info=ocr_info, model=model, SYSTEM_PROMPT=GENERATE_NOTES_SYSTEM_PROMPT)
-    elif provider == "Ollama":
-        results = generate_notes_with_ollama(file=file, image_path=image_path, ocr_info=ocr_info, model=model, SYSTEM_PROMPT=GENERATE_NOTES_SYSTEM_PROMPT)
-
-    notes = ""
-    for line in results:
-        notes += line
+    budget = get_input_budget(model, GENERATION_OPTIONS["max_tokens"], GENERATE_NOTES_SYSTEM_PROMPT + OCR_INFO_PREAMBLE)
+
+    def generate(text, ocr_text, image_path=None, on_chunk=None):
+        # Without a text layer or an image the OCR text is the document itself
+        if not text and not image_path:
+            text, ocr_text = _ocr_info(ocr_text), ""
+        return _run_model("generate_notes", model, GENERATE_NOTES_SYSTEM_PROMPT, use_cache, on_chunk, hedge, file=text, image_path=image_path, ocr_info=_ocr_info(ocr_text))
+
+    if image_path and not isinstance(image_path, str):
+        # Rendered pages of one document: as many consecutive pages per request as the model takes
+        page_ocr = ocr_enhance_info.split(PAGE_BREAK) if ocr_enhance_info else []
+        page_ocr += [""] * (len(image_path) - len(page_ocr))
+        groups = pack_images(image_path, model)
+        print(f"Generating Notes using model: {model, provider} over {len(image_path)} pages in {len(groups)} request(s)")
+
+        def generate_pages(group, on_chunk=None):
+            captions = [f"Page {i + 1}" + (f"\n{OCR_CAPTION_PREAMBLE}{strip_markers(page_ocr[i]).strip()}" if page_ocr[i].strip() else "") for i in group]
+            return _run_model("generate_notes", model, GENERATE_NOTES_SYSTEM_PROMPT, use_cache, on_chunk, hedge, image_path=[image_path[i] for i in group], ocr_info=captions)
+
+        if len(groups) == 1:
+            notes = generate_pages(groups[0], on_chunk)
+        else:
+            notes = _reduce_notes(_map_chunks(generate_pages, groups), model, use_cache, on_chunk, hedge)
+    elif image_path or estimate_tokens(file) + estimate_tokens(ocr_enhance_info) <= budget:
+        print(f"Generating Notes using model: {model, provider}")
+        notes = generate(strip_markers(file), strip_markers(ocr_enhance_info), image_path, on_chunk)
+    else:
+        chunks = chunk_document(file or "", ocr_enhance_info, budget)
+        print(f"Generating Notes using model: {model, provider} over {len(chunks)} chunks")
+        partial_notes = _map_chunks(lambda chunk: generate(*chunk), chunks)
+        notes = _reduce_notes(partial_notes, model, use_cache, on_chunk, hedge)
 
     print("Notes generated successfully!")
     return notes
 
-def format_notes(notes: str, model: str="gemini-1.5-flash-8b"):
-    results = None
+def _split_sources(notes: str, count: int) -> List[Optional[str]]:
+    sections = [None] * count
+    markers = list(SOURCE_MARKER.finditer(notes))
+    for marker, following in zip(markers, markers[1:] + [None]):
+        number = int(marker.group(1))
+        section = notes[marker.end():following.start() if following else len(notes)].strip()
+        if 1 <= number <= count and sections[number - 1] is None and section:
+            sections[number - 1] = section
+    return sections
+
+def generate_packed_notes(sources: List[Tuple[str, str, str]], model: str="gemini-1.5-flash-8b", use_cache: bool = True, hedge: Optional[bool] = None) -> List[Optional[str]]:
+    """
+    Take separate notes for several images in as few multimodal requests as ``model`` allows.
+
+    Images are packed in order within the model's image-count and payload limits
+    (see :func:`utils.images.pack_images`) and ``PACKING.MAX_SOURCES``. The model
+    marks where each source's notes start, and the answer is split on those markers.
 
+    Args:
+        sources (list): ``(name, image_path, ocr_text)`` of every image
+        model (str): Multimodal model used to generate the notes
+        use_cache (bool): Reuse cached LLM responses
+        hedge (bool): Hedge slow requests, defaults to HEDGING.ENABLED
+
+    Returns:
+        list: Notes for each source, or ``None`` for sources that ended up alone in a
+            request or whose notes could not be told apart; generate those on their own
+    """
+    if hedge is None:
+        hedge = HEDGING_CONFIG["ENABLED"]
+    groups = pack_images([image_path for _, image_path, _ in sources], model, PACKING_CONFIG["MAX_SOURCES"])
+    print(f"Generating Notes using model: {model, get_model_provider(model)} for {len(sources)} images in {len(groups)} request(s)")
+
+    def generate(group):
+        if len(group) == 1:
+            return [None]
+        captions = []
+        for n, i in enumerate(group, 1):
+            name, _, ocr_text = sources[i]
+            ocr_text = strip_markers(_ocr_text(ocr_text or "")).strip()
+            captions.append(f"Source {n}: {name}" + (f"\n{OCR_CAPTION_PREAMBLE}{ocr_text}" if ocr_text else ""))
+        notes = _run_model("generate_packed_notes", model, PACKED_NOTES_SYSTEM_PROMPT, use_cache, None, hedge, image_path=[sources[i][1] for i in group], ocr_info=captions)
+        sections = _split_sources(notes, len(group))
+        missing = [sources[i][0] for i, section in zip(group, sections) if section is None]
+        if missing:
+            print(f"Could not find the notes for {', '.join(missing)} in the packed answer")
+        return sections
+
+    results = [None] * len(sources)
+    for group, sections in zip(groups, _map_chunks(generate, groups)):
+        for i, section in zip(group, sections):
+            results[i] = section
+    return results
+
+def format_notes(notes: str, model: str="gemini-1.5-flash-8b", use_cache: bool = True, on_chunk: Optional[Callable[[str], None]] = None, hedge: Optional[bool] = None, local_first: Optional[bool] = None):
     provider = get_model_provider(model)
-    print(f"Formatting Notes Structure using model: {model, provider}")
+    if hedge is None:
+        hedge = HEDGING_CONFIG["ENABLED"]
+    if local_first is None:
+        local_first = FORMATTING_CONFIG["LOCAL_FIRST"]
+
+    if local_first:
+        # Most notes only need mechanical fixes; the model is only asked when those are not enough
+        notes, problems = normalize_markdown(notes)
+        if not problems:
+            print("Notes fixed locally; skipping the formatting model")
+            if on_chunk:
+                on_chunk(notes)
+            return notes
+        print(f"Notes have {len(problems)} formatting problem(s) that need the model, e.g. {problems[0]}")
+    budget = get_input_budget(model, GENERATION_OPTIONS["max_tokens"], FORMAT_NOTES_SYSTEM_PROMPT)
 
-    if provider == "Google Gemini":
-        results = generate_notes_with_gemini(file=notes, model=model, SYSTEM_PROMPT=FORMAT_NOTES_SYSTEM_PROMPT)
-    elif provider == "OpenAI":
-        results = generate_notes_with_gpt(file=notes, model=model, SYSTEM_PROMPT=FORMAT_NOTES_SYSTEM_PROMPT)
-    elif provider == "Mistral AI":
-        results = generate_notes_with_mistralai(file=notes, model=model, SYSTEM_PROMPT=FORMAT_NOTES_SYSTEM_PROMPT)
-    elif provider == "Groq":
-        results = generate_notes_with_groq(file=notes, model=model, SYSTEM_PROMPT=FORMAT_NOTES_SYSTEM_PROMPT)
-    elif provider == "Ollama":
-        results = generate_notes_with_ollama(file=notes, model=model, SYSTEM_PROMPT=FORMAT_NOTES_SYSTEM_PROMPT)
-    
-    notes = ""
-    for line in results:
-        notes += line
+    print(f"Formatting Notes Structure using model: {model, provider}")
+    # Formatting is local to each part of the note, so oversized notes are formatted piecewise;
+    # each piece must also fit the answer, which is about as long as the input
+    pieces = split_text(notes, min(budget, GENERATION_OPTIONS["max_tokens"]))
+    if len(pieces) == 1:
+        notes = _run_model("format_notes", model, FORMAT_NOTES_SYSTEM_PROMPT, use_cache, on_chunk, hedge, file=notes)
+    else:
+        notes = "\n\n".join(_map_chunks(
+            lambda piece: _run_model("format_notes", model, FORMAT_NOTES_SYSTEM_PROMPT, use_cache, None, hedge, file=piece),
+            pieces,
+        ))
+        if on_chunk:
+            on_chunk(notes)
 
     print("Notes formatted successfully!")
     return notes
+
+def _threadsafe(loop, on_chunk):
+    # Chunks arrive on an executor thread; hand them to the caller on its event loop
+    if on_chunk is None:
+        return None
+    return lambda chunk: loop.call_soon_threadsafe(on_chunk, chunk)
+
+async def agenerate_notes(file=None, image_path=None, ocr_enhance_info: str = "", model: str="gemini-1.5-flash-8b", use_cache: bool = True, on_chunk: Optional[Callable[[str], None]] = None, hedge: Optional[bool] = None):
+    loop = asyncio.get_running_loop()
+    on_chunk = _threadsafe(loop, on_chunk)
+    return await loop.run_in_executor(_llm_executor, lambda: generate_notes(file=file, image_path=image_path, ocr_enhance_info=ocr_enhance_info, model=model, use_cache=use_cache, on_chunk=on_chunk, hedge=hedge))
+
+async def aformat_notes(notes: str, model: str="gemini-1.5-flash-8b", use_cache: bool = True, on_chunk: Optional[Callable[[str], None]] = None, hedge: Optional[bool] = None):
+    loop = asyncio.get_running_loop()
+    on_chunk = _threadsafe(loop, on_chunk)
+    return await loop.run_in_executor(_llm_executor, lambda: format_notes(notes=notes, model=model, use_cache=use_cache, on_chunk=on_chunk, hedge=hedge))
+
+async def agenerate_packed_notes(sources: List[Tuple[str, str, str]], model: str="gemini-1.5-flash-8b", use_cache: bool = True, hedge: Optional[bool] = None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_llm_executor, lambda: generate_packed_notes(sources=sources, model=model, use_cache=use_cache, hedge=hedge))
@@ -0,0 +1,275 @@
+import re
+from typing import List, Tuple
+
+# A whole note wrapped in ```markdown ... ```, as models sometimes answer
+WRAPPER = re.compile(r"\A\s*```(?:markdown|md)[ \t]*\n(.*?)\n?```\s*\Z", re.S)
+FENCE = re.compile(r"^\s*(`{3,}|~{3,})")
+LIST_ITEM = re.compile(r"^( *)([-*+]|\d{1,9}[.)])( +|$)(.*)$")
+TABLE_ROW = re.compile(r"^\s*\|")
+TABLE_DELIMITER = re.compile(r"^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$")
+HEADING = re.compile(r"^#{1,6}\s")
+# Inline code spans are matched first so their contents are left alone; \\[2pt] line breaks are not delimiters
+BRACKETS = re.compile(r"(`+).*?\1|(?<!\\)\\\[\s*|\s*(?<!\\)\\\]|(?<!\\)\\\(\s*|\s*(?<!\\)\\\)")
+MATH_TOKENS = re.compile(r"(`+).*?\1|\\\$|\$\$|\$")
+# A dollar sign in front of an amount ("costs $5.") rather than opening math
+CURRENCY = re.compile(r"(?<![\\\w$])\$(?=\d[\d,.]*(?:\s|[.,;:!?)]|\Z))")
+# Between two dollar signs, TeX markup or the absence of words means math; words alone mean prose ("$5 and $10")
+MATH_HINT = re.compile(r"[\\^_{}=<>]")
+WORD = re.compile(r"[^\W\d_]{2,}")
+LATEX_ENVIRONMENT = re.compile(r"\\(begin|end)\{([^}]*)\}")
+TABLE_PIPE = re.compile(r"(?<!\\)\|")
+MATH_SPAN = re.compile(r"\$\$.*?\$\$|\$.*?\$")
+
+_DELIMITERS = {"\\[": "$$", "\\]": "$$", "\\(": "$", "\\)": "$"}
+
+
+def _convert_brackets(line: str) -> str:
+    def replace(match):
+        if match.group(1):
+            return match.group(0)
+        return _DELIMITERS[match.group(0).strip()]
+    return BRACKETS.sub(replace, line)
+
+
+def _dollars(line: str) -> List[re.Match]:
+    # Unescaped single dollar signs outside inline code
+    return [m for m in MATH_TOKENS.finditer(line) if not m.group(1) and m.group(0) == "$"]
+
+
+def _escape_amounts(line: str) -> str:
+    """Escape the dollar signs of amounts ("costs $5") that would otherwise open inline math."""
+    if not any(m.group(0) == "$$" for m in MATH_TOKENS.finditer(line) if not m.group(1)):
+        # An amount opening a pair of dollars around prose: "Price $5 and $10 total"
+        escaped = True
+        while escaped:
+            escaped = False
+            dollars = _dollars(line)
+            for opening, closing in zip(dollars[::2], dollars[1::2]):
+                between = line[opening.end():closing.start()]
+                if CURRENCY.match(line, opening.start()) and WORD.search(between) and not MATH_HINT.search(between):
+                    line = line[:opening.start()] + "\\" + line[opening.start():]
+                    escaped = True
+                    break
+
+    # An amount left without a closing dollar
+    if len(_dollars(line)) % 2:
+        for currency in CURRENCY.finditer(line):
+            candidate = line[:currency.start()] + "\\" + line[currency.start():]
+            if len(_dollars(candidate)) % 2 == 0:
+                return candidate
+    return line
+
+
+def _check_latex(math: str, line_number: int) -> List[str]:
+    """Problems in one math expression that only a rewrite can fix."""
+    problems = []
+    depth = 0
+    for i, char in enumerate(math):
+        if char in "{}" and i and math[i - 1] == "\\":
+            continue
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth < 0:
+                break
+    if depth != 0:
+        problems.append(f"line {line_number}: unbalanced braces in math")
+
+    environments = []
+    for kind, name in LATEX_ENVIRONMENT.findall(math):
+        if kind == "begin":
+            environments.append(name)
+        elif not environments or environments.pop() != name:
+            problems.append(f"line {line_number}: \\end{{{name}}} without matching \\begin")
+            break
+    if environments:
+        problems.append(f"line {line_number}: \\begin{{{environments[-1]}}} is never closed")
+
+    if len(re.findall(r"\\left\b", math)) != len(re.findall(r"\\right\b", math)):
+        problems.append(f"line {line_number}: unmatched \\left/\\right")
+    return problems
+
+
+def _split_cells(row: str) -> List[str]:
+    # Pipes inside math ($|x|$) are not column separators
+    row = row.strip()
+    math = [match.span() for match in MATH_SPAN.finditer(row)]
+    cells, start = [], 0
+    for pipe in TABLE_PIPE.finditer(row):
+        if not any(span_start < pipe.start() < span_end for span_start, span_end in math):
+            cells.append(row[start:pipe.start()])
+            start = pipe.end()
+    cells.append(row[start:])
+    if row.startswith("|"):
+        cells = cells[1:]
+    if row.endswith("|") and not row.endswith("\\|") and len(cells) > 1:
+        cells = cells[:-1]
+    return [cell.strip() for cell in cells]
+
+
+def _fix_table(rows: List[str]) -> List[str]:
+    """Give a table a delimiter row and the same number of cells in every row."""
+    cells = [_split_cells(row) for row in rows]
+    has_delimiter = len(rows) > 1 and TABLE_DELIMITER.match(rows[1])
+    if has_delimiter and len({len(row) for row in cells}) == 1:
+        return rows
+    if not has_delimiter:
+        cells.insert(1, ["---"] * len(cells[0]))
+
+    columns = max(len(row) for row in cells)
+    return [
+        "| " + " | ".join(row + ["---" if i == 1 else ""] * (columns - len(row))) + " |"
+        for i, row in enumerate(cells)
+    ]
+
+
+def normalize_markdown(text: str) -> Tuple[str, List[str]]:
+    """
+    Fix the Markdown and LaTeX slips notes usually have, in a single pass over the lines.
+
+    - unwraps a note wrapped in a ```markdown fence
+    - converts ``\\[ \\]`` to ``$$ $$`` and ``\\( \\)`` to ``$ $``, trimming the spaces inside
+    - escapes dollar signs of amounts that would otherwise open inline math, or wrap prose in it
+    - closes display math left open before the next heading or the end of the note
+    - adds missing table delimiter rows, pads short rows and separates tables from paragraphs
+    - re-indents nested lists to their parent item's content column
+
+    Code blocks (fenced or indented) and inline code are left untouched.
+
+    Args:
+        text (str): Notes as returned by the model
+
+    Returns:
+        tuple: The normalized notes and a list of the problems that could not be fixed
+            locally (unbalanced ``$``, braces, environments or ``\\left``/``\\right``)
+    """
+    if not text:
+        return text, []
+
+    wrapped = WRAPPER.match(text)
+    if wrapped:
+        text = wrapped.group(1)
+
+    output, problems = [], []
+    fence = None
+    display_start, display_math = None, []  # line the open $$ block started on, and its contents so far
+    table = []
+    lists = []  # (original indent, new indent, content offset) of the open list items
+
+    def flush_table():
+        if not table:
+            return False
+        if output and output[-1].strip():
+            output.append("")
+        output.extend(_fix_table(table))
+        table.clear()
+        return True
+
+    def close_display():
+        # Close the block right after its last line, not after the blank lines that follow it
+        blank = 0
+        while output and not output[-1].strip():
+            output.pop()
+            blank += 1
+        output.extend(["$$"] + [""] * blank)
+        problems.extend(_check_latex(" ".join(display_math), display_start))
+
+    lines = text.split("\n")
+    indented_code = False
+    for line_number, line in enumerate(lines, 1):
+        # Code blocks pass through untouched
+        fence_match = FENCE.match(line)
+        if fence or (fence_match and display_start is None):
+            flush_table()
+            if fence is None:
+                fence = fence_match.group(1)
+            elif fence_match and fence_match.group(1).startswith(fence[0] * len(fence)) and not line.strip().strip(fence[0]):
+                fence = None
+            output.append(line)
+            continue
+
+        # So do indented code blocks: a line indented four columns after a blank line, outside lists
+        # (where indentation nests items) and equations; blank lines inside the block keep it open
+        if line.strip():
+            indent = len(line.expandtabs(4)) - len(line.expandtabs(4).lstrip(" "))
+            indented_code = (
+                indent >= 4 and not lists and not table and display_start is None
+                and (indented_code or line_number == 1 or not lines[line_number - 2].strip())
+            )
+        if indented_code:
+            output.append(line)
+            continue
+
+        line = _convert_brackets(line)
+
+        if display_start is not None and HEADING.match(line):
+            # A heading cannot be part of an equation: the block was never closed
+            close_display()
+            display_start, display_math = None, []
+
+        # Math delimiters, with the dollar signs of amounts escaped
+        if display_start is None:
+            line = _escape_amounts(line)
+        tokens = [m for m in MATH_TOKENS.finditer(line) if not m.group(1) and m.group(0) != "\\$"]
+
+        inline_start, segment_start = None, 0
+        for token in tokens:
+            if token.group(0) == "$$":
+                if display_start is None:
+                    display_start, display_math, segment_start = line_number, [], token.end()
+                else:
+                    display_math.append(line[segment_start:token.start()])
+                    problems.extend(_check_latex(" ".join(display_math), display_start))
+                    display_start, display_math = None, []
+            elif display_start is None:
+                if inline_start is None:
+                    inline_start = token.end()
+                else:
+                    problems.extend(_check_latex(line[inline_start:token.start()], line_number))
+                    inline_start = None
+        if inline_start is not None:
+            problems.append(f"line {line_number}: unbalanced $")
+        if display_start is not None:
+            display_math.append(line[segment_start:])
+
+        # Tables are collected and fixed as a whole once they end
+        if display_start is None and TABLE_ROW.match(line):
+            table.append(line)
+            continue
+        if flush_table() and line.strip():
+            # Without a blank line the next paragraph would become another table row
+            output.append("")
+
+        # Nested list indentation
+        expanded = line.expandtabs(4)
+        item = LIST_ITEM.match(expanded)
+        if item and display_start is None:
+            indent, marker, _, content = item.groups()
+            indent = len(indent)
+            while lists and indent < lists[-1][0] - 1:
+                lists.pop()
+            if lists and indent <= lists[-1][0] + 1:
+                new_indent = lists.pop()[1]
+            elif lists:
+                new_indent = lists[-1][1] + lists[-1][2]
+            else:
+                new_indent = 0 if indent < 4 else indent
+            lists.append((indent, new_indent, len(marker) + 1))
+            line = " " * new_indent + marker + (" " + content if content else "")
+        elif lists and expanded.strip():
+            indent = len(expanded) - len(expanded.lstrip(" "))
+            if indent == 0:
+                lists.clear()
+            else:
+                # Continuation of the innermost item it is indented under
+                owner = next((entry for entry in reversed(lists) if indent >= entry[0] + 1), lists[0])
+                line = " " * max(0, indent + owner[1] - owner[0]) + expanded.lstrip(" ")
+
+        output.append(line)
+
+    flush_table()
+    if display_start is not None:
+        close_display()
+    return "\n".join(output), problems
+
@@ -0,0 +1,138 @@
+import os, re, json
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
+from utils.cache import open_cache, make_key
+
+config = json.load(open("config.json"))
+NOTE_VIEWER_CONFIG = config["NOTE_VIEWER"]
+
+outline_cache = open_cache("OUTLINE")
+
+SEPARATOR = re.compile(rb"^-{3,}\s*$")
+HEADING = re.compile(rb"^(#{1,6})\s+(.*?)\s*#*\s*$")
+FENCE = re.compile(rb"^\s*(`{3,}|~{3,})")
+OUTLINE_VERSION = 2
+
+
+def _scan(path: str) -> List[Dict[str, Any]]:
+    """
+    Split a note into parts at ``---`` separators and headings, reading it line by line.
+
+    Code blocks and display math are not split at blank lines, and a part that
+    grows past ``NOTE_VIEWER.MAX_PART_BYTES`` is continued in a new part at the
+    next blank line. Once a part is twice that size it is cut at the next line
+    whatever is open, so a fence or ``$$`` that is never closed cannot make the
+    rest of the note one part. Parts are byte ranges, so a window of them can be
+    read with one seek.
+    """
+    parts = []
+    current = {"start": 0, "title": None, "level": 0}
+    fence, display_math = None, False
+    offset = 0
+
+    def cut(at, title=None, level=0):
+        nonlocal current
+        if at > current["start"]:
+            current["end"] = at
+            parts.append(current)
+        current = {"start": at, "title": title, "level": level}
+
+    with open(path, "rb") as f:
+        for line in f:
+            stripped = line.rstrip(b"\r\n")
+            if offset - current["start"] > 2 * NOTE_VIEWER_CONFIG["MAX_PART_BYTES"]:
+                # Whatever is open: an unclosed fence or a stray $$ must not turn the rest of the note into one part
+                cut(offset)
+            fence_match = FENCE.match(stripped)
+            if fence:
+                if fence_match and fence_match.group(1).startswith(fence) and not stripped.strip().strip(fence[:1]):
+                    fence = None
+            elif fence_match and not display_math:
+                fence = fence_match.group(1)
+            elif stripped.count(b"$$") % 2:
+                display_math = not display_math
+            elif display_math:
+                pass
+            elif SEPARATOR.match(stripped):
+                cut(offset)
+            elif HEADING.match(stripped):
+                heading = HEADING.match(stripped)
+                cut(offset, heading.group(2).decode("utf-8", errors="replace"), len(heading.group(1)))
+            elif offset - current["start"] > NOTE_VIEWER_CONFIG["MAX_PART_BYTES"] and not stripped.strip():
+                cut(offset)
+            offset += len(line)
+    cut(offset)
+
+    # Drop parts holding nothing but separators and blank lines
+    with open(path, "rb") as f:
+        kept = []
+        for part in parts:
+            if part["title"] is None and part["end"] - part["start"] <= 64:
+                f.seek(part["start"])
+                if not f.read(part["end"] - part["start"]).replace(b"-", b"").strip():
+                    continue
+            kept.append(part)
+    return kept
+
+
+@lru_cache(maxsize=16)
+def _outline(path: str, mtime_ns: int, size: int) -> Tuple[Dict[str, Any], ...]:
+    # OUTLINE_VERSION changes whenever _scan splits notes differently, so older outlines are not reused
+    key = make_key("outline", OUTLINE_VERSION, path, mtime_ns, size, NOTE_VIEWER_CONFIG["MAX_PART_BYTES"])
+    cached = outline_cache.get_text(key)
+    if cached is not None:
+        return tuple(json.loads(cached))
+    parts = _scan(path)
+    outline_cache.set_text(key, json.dumps(parts))
+    return tuple(parts)
+
+
+def get_outline(path: str) -> Tuple[Dict[str, Any], ...]:
+    """
+    Parts of a note, indexed once per file version (path, mtime and size).
+
+    Returns:
+        tuple: Parts in file order, as dicts with ``start`` and ``end`` byte offsets,
+            ``title`` (heading text, or ``None`` for parts that do not start with a
+            heading) and ``level`` (heading level, 0 for none)
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return _outline(path, stat.st_mtime_ns, stat.st_size)
+
+
+def window_end(outline: Tuple[Dict[str, Any], ...], first: int) -> int:
+    """Index after the last part of the window starting at ``first``, filling up to ``NOTE_VIEWER.WINDOW_BYTES``."""
+    last = first
+    while last < len(outline) and (last == first or outline[last]["end"] - outline[first]["start"] <= NOTE_VIEWER_CONFIG["WINDOW_BYTES"]):
+        last += 1
+    return last
+
+
+def window_start(outline: Tuple[Dict[str, Any], ...], end: int) -> int:
+    """Index of the first part of the window that ends right before part ``end``."""
+    first = end - 1
+    while first > 0 and outline[end - 1]["end"] - outline[first - 1]["start"] <= NOTE_VIEWER_CONFIG["WINDOW_BYTES"]:
+        first -= 1
+    return max(first, 0)
+
+
+def read_window(path: str, outline: Tuple[Dict[str, Any], ...], first: int) -> Tuple[str, int]:
+    """
+    Read the window of parts starting at ``first``.
+
+    Args:
+        path (str): Note to read
+        outline (tuple): Its parts, from :func:`get_outline`
+        first (int): Index of the first part to show
+
+    Returns:
+        tuple: Markdown of the window and the index after its last part
+    """
+    if not outline:
+        return "", 0
+    last = window_end(outline, first)
+    with open(path, "rb") as f:
+        f.seek(outline[first]["start"])
+        text = f.read(outline[last - 1]["end"] - outline[first]["start"])
+    return text.decode("utf-8", errors="replace"), last
@@ -1,9 +1,68 @@
 import os
+import shutil
+import hashlib
 import logging
+import tempfile
+import threading
+from typing import Any, List, Tuple
 from utils.cypher.key import get_api_key
+from utils.markdown import normalize_markdown
+from utils.vault_index import get_vault_index
+from utils.file_lock import lock_file, unlock_file
 
 logger = logging.getLogger(__name__)
 
+
+class _NoteLock:
+    """
+    Exclusive lock on one note, across the threads of this process and across processes.
+
+    The Streamlit app and ``cli.py batch``/``watch`` may write to the same vault,
+    so besides a thread lock the holder keeps an OS lock on a hidden sidecar file
+    next to the note, ``.<note>.md.lock``. The sidecar is left in place: deleting
+    it while another process waits on it would let two writers in.
+    """
+
+    def __init__(self, note_path: str):
+        directory, name = os.path.split(note_path)
+        self._lock_path = os.path.join(directory, f".{name}.lock")
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        try:
+            file = open(self._lock_path, "a+b")
+            try:
+                lock_file(file)
+            except BaseException:
+                file.close()
+                raise
+            self._file = file
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def release(self):
+        file, self._file = self._file, None
+        try:
+            unlock_file(file)
+            file.close()
+        finally:
+            self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# One lock per note file, so concurrent writers never interleave sections of the same note
+_note_locks = {}
+_note_locks_lock = threading.Lock()
+
 def get_vault_path():
     try:
         logger.info("Attempting to retrieve vault path using API key.")
@@ -29,44 +88,272 @@ def get_vault_path():
         logger.error("Error while determining vault path: %s", e, exc_info=True)
         raise
 
-def create_obsidian_note(note_title: str, note_content: str, vault_path: str, uploaded_file):
+def _note_lock(note_path: str) -> _NoteLock:
+    key = os.path.normcase(os.path.abspath(note_path))
+    with _note_locks_lock:
+        if key not in _note_locks:
+            _note_locks[key] = _NoteLock(key)
+        return _note_locks[key]
+
+def _vault_root(vault_path: str):
+    # Assets live at the vault root so identical uploads are shared by every folder
+    root = get_vault_path()[0]
+    try:
+        if os.path.commonpath([os.path.abspath(root), os.path.abspath(vault_path)]) == os.path.abspath(root):
+            return root
+    except ValueError:
+        pass
+    return vault_path
+
+def _read_blocks(uploaded_file, block_size: int = 1 << 20):
+    """Read an upload in blocks, straight from disk when it has a path, without copying it whole."""
+    path = getattr(uploaded_file, "path", None)
+    if isinstance(path, str):
+        with open(path, "rb") as f:
+            yield from iter(lambda: f.read(block_size), b"")
+        return
+    uploaded_file.seek(0)
+    try:
+        yield from iter(lambda: uploaded_file.read(block_size), b"")
+    finally:
+        uploaded_file.seek(0)
+
+def store_asset(vault_path: str, uploaded_file) -> str:
+    """
+    Store an upload once under its content hash in the vault's ``assets`` folder.
+
+    Args:
+        vault_path (str): Folder inside the vault the note is written to
+        uploaded_file: Uploaded file (anything with ``name`` and ``read``/``seek``, or a ``path``)
+
+    Returns:
+        str: File name of the asset, ``<sha256><extension>``
+    """
+    digest = hashlib.sha256()
+    for block in _read_blocks(uploaded_file):
+        digest.update(block)
+    asset_name = digest.hexdigest()[:32] + os.path.splitext(uploaded_file.name)[1].lower()
+
+    assets_dir = os.path.join(_vault_root(vault_path), "assets")
+    asset_path = os.path.join(assets_dir, asset_name)
+    if os.path.exists(asset_path):
+        logger.info("Asset already stored: %s", asset_path)
+        return asset_name
+
+    os.makedirs(assets_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=assets_dir, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out_file:
+            for block in _read_blocks(uploaded_file):
+                out_file.write(block)
+        os.replace(temp_path, asset_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    logger.info("Asset saved to: %s", asset_path)
+    return asset_name
+
+def _append_note(note_path: str, sections: List[str]):
+    """
+    Append ``sections`` to a note in one ``O_APPEND`` write and flush it to disk.
+
+    Only the new bytes are written, however long the note already is. Callers
+    must hold the note's lock.
+    """
+    data = "".join(sections).encode("utf-8")
+    fd = os.open(note_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _replace_note(note_path: str, sections: List[str], keep_bytes: int = None):
+    """
+    Atomically rewrite a note as its current content followed by ``sections``.
+
+    The new content is written to a temporary file next to the note and renamed
+    over it, so readers only ever see the old or the new note. With
+    ``keep_bytes`` only that many bytes of the current content are kept. This
+    copies the whole note, so it is only used where the note has to be cut
+    short (a streamed section being finalized or dropped); plain additions go
+    through :func:`_append_note`. Callers must hold the note's lock.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(note_path) or ".", prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out_file:
+            if os.path.exists(note_path):
+                with open(note_path, "rb") as note_file:
+                    if keep_bytes is None:
+                        shutil.copyfileobj(note_file, out_file)
+                    else:
+                        out_file.write(note_file.read(keep_bytes))
+            # Bytes, as in _append_note, so the line endings are the same whichever way a section is written
+            out_file.write("".join(sections).encode("utf-8"))
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        if os.path.exists(note_path):
+            # mkstemp creates the file private to its owner; keep the note's own permissions
+            shutil.copymode(note_path, temp_path)
+        os.replace(temp_path, note_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def get_note_path(note_title: str, vault_path: str) -> str:
+    return os.path.join(vault_path, f"{note_title}.md")
+
+def note_size(note_path: str) -> int:
     try:
-        logger.info("Starting note creation process for %s", note_title)
-
-        if not os.path.exists(vault_path):
-            logger.info("Vault path does not exist. Creating folder: %s", vault_path)
-            os.makedirs(vault_path)
-        
-        note_filename = f"{note_title}.md"
-        note_path = os.path.join(vault_path, note_filename)
-
-        note_title = note_title.lower().replace(" ", "_")
-        
-        filename = uploaded_file.name.lower().replace(" ", "_")
-
-        file_dir = os.path.join(vault_path, f'assets/assets_{note_title}')
-        if not os.path.exists(file_dir):
-            os.makedirs(file_dir)
-            logger.info("Image directory created: %s", file_dir)
-        
-        target_image_path = os.path.join(file_dir, filename)
-        
-        with open(target_image_path, 'wb') as out_file:
-            out_file.write(uploaded_file.getbuffer())
-            logger.info("Image saved to: %s", target_image_path)
-        
-        file_markdown = f"[[{filename}]]\n"
-        note_content = note_content.replace("\\[ \n", "$").replace(" \n\\]", "$").replace('\\[\n', '$').replace('\n\\]', '$').replace('\\[ ', '$').replace(' \\]', '$').replace('\\[', '$').replace('\\]', '$')
-        note_content = note_content.replace("\\( \n", "$").replace(" \n\\)", "$").replace('\\(\n', '$').replace('\n\\)', '$').replace('\\( ', '$').replace(' \\)', '$').replace('\\(', '$').replace('\\)', '$')
-        if note_content.startswith("```markdown\n") and note_content.endswith("\n```"):
-            note_content = note_content.replace("```markdown\n", "").replace("\n```", "")
-        
-        with open(note_path, 'a', encoding='utf-8') as note_file:
-            note_file.write('\n---\n' + '\n' + file_markdown + '\n' + note_content + '\n' + '\n---\n')
+        return os.path.getsize(note_path)
+    except FileNotFoundError:
+        return 0
+
+def section_written(note_path: str, offset: int, file_name: str) -> bool:
+    """Whether the note has a section for ``file_name`` after its first ``offset`` bytes, i.e. an append of it went through."""
+    try:
+        with open(note_path, "rb") as note_file:
+            note_file.seek(offset)
+            return f"|{file_name}]]".encode("utf-8") in note_file.read()
+    except FileNotFoundError:
+        return False
+
+def _prepare_note(note_title: str, vault_path: str, uploaded_file):
+    if not os.path.exists(vault_path):
+        logger.info("Vault path does not exist. Creating folder: %s", vault_path)
+        os.makedirs(vault_path, exist_ok=True)
+        # Show the new folder in the folder picker without waiting for the next index refresh
+        get_vault_index(_vault_root(vault_path)).invalidate()
+
+    note_path = get_note_path(note_title, vault_path)
+    asset_name = store_asset(vault_path, uploaded_file)
+    file_markdown = f"[[{asset_name}|{uploaded_file.name}]]\n"
+    return note_path, file_markdown
+
+def _index_note(vault_path: str, note_path: str):
+    # Searchable right away; a failed index update must not fail the write, the next sync catches up
+    try:
+        get_vault_index(_vault_root(vault_path)).index_note(note_path)
+        # NumPy comes with the related-notes index, so it is only loaded once a note is written
+        from utils.related import get_related_notes
+        get_related_notes(_vault_root(vault_path)).update_note(note_path)
+    except Exception as e:
+        logger.warning("Could not index note %s: %s", note_path, e)
+
+def _related_links(vault_path: str, note_path: str, note_content: str):
+    try:
+        from utils.related import related_links
+        return related_links(_vault_root(vault_path), note_path, note_content)
+    except Exception as e:
+        logger.warning("Could not find related notes for %s: %s", note_path, e)
+        return ""
+
+def _clean_note_content(note_content: str):
+    note_content, problems = normalize_markdown(note_content)
+    for problem in problems:
+        logger.warning("Note content left with a formatting problem: %s", problem)
+    return note_content
+
+def _section_header(file_markdown: str):
+    return '\n---\n' + '\n' + file_markdown + '\n'
+
+def _section_footer():
+    return '\n' + '\n---\n'
+
+def append_note_sections(note_title: str, vault_path: str, sections: List[Tuple[str, Any]]):
+    """
+    Append one section per ``(note_content, uploaded_file)`` pair to a note in a single write.
+
+    The note is locked against other threads and processes while the sections are appended.
+
+    Args:
+        note_title (str): Title of the note the sections are appended to
+        vault_path (str): Folder inside the vault holding the note
+        sections (list): ``(note_content, uploaded_file)`` pairs, in order
+
+    Returns:
+        str: Path of the note
+    """
+    if not sections:
+        return get_note_path(note_title, vault_path)
+    try:
+        logger.info("Starting note creation process for %s (%d section(s))", note_title, len(sections))
+
+        texts = []
+        for note_content, uploaded_file in sections:
+            note_path, file_markdown = _prepare_note(note_title, vault_path, uploaded_file)
+            note_content = _clean_note_content(note_content)
+            texts.append(_section_header(file_markdown) + note_content + _related_links(vault_path, note_path, note_content) + _section_footer())
+
+        with _note_lock(note_path):
+            _append_note(note_path, texts)
             logger.info("Note content appended to file: %s", note_path)
-        
+        _index_note(vault_path, note_path)
+
         logger.info("Note created successfully at path: %s", note_path)
         return note_path
     except Exception as e:
         logger.error("Error during note creation: %s", e, exc_info=True)
         raise
+
+def create_obsidian_note(note_title: str, note_content: str, vault_path: str, uploaded_file):
+    return append_note_sections(note_title, vault_path, [(note_content, uploaded_file)])
+
+class NoteStream:
+    """
+    Append a note section to ``<note_title>.md`` while it is still being generated.
+
+    Raw chunks are written and flushed as they arrive so the note fills in live in
+    Obsidian. ``close`` then atomically replaces the streamed text with the cleaned
+    final content, so the file ends up identical to a :func:`create_obsidian_note`
+    write. The note's lock, which also keeps other processes out, is held from
+    construction until ``close`` or ``abort``.
+
+    Args:
+        note_title (str): Title of the note the section is appended to
+        vault_path (str): Folder inside the vault holding the note
+        uploaded_file: Source file, stored in the vault's assets folder
+    """
+
+    def __init__(self, note_title: str, vault_path: str, uploaded_file):
+        logger.info("Starting streamed note creation for %s", note_title)
+        self.note_path, self._header = _prepare_note(note_title, vault_path, uploaded_file)
+        self._vault_path = vault_path
+        self._lock = _note_lock(self.note_path)
+        self._lock.acquire()
+        try:
+            # Binary like _append_note: text mode would write CRLF line endings on Windows
+            self._file = open(self.note_path, 'ab')
+            self.offset = self._file.tell()
+            self.write(_section_header(self._header))
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def write(self, chunk: str):
+        self._file.write(chunk.encode('utf-8'))
+        self._file.flush()
+
+    def close(self, note_content: str):
+        try:
+            self._file.close()
+            note_content = _clean_note_content(note_content)
+            related = _related_links(self._vault_path, self.note_path, note_content)
+            _replace_note(self.note_path, [_section_header(self._header) + note_content + related + _section_footer()], keep_bytes=self.offset)
+            logger.info("Streamed note content finalized in file: %s", self.note_path)
+        finally:
+            self._lock.release()
+        _index_note(self._vault_path, self.note_path)
+        return self.note_path
+
+    def abort(self):
+        """Drop the partially streamed section."""
+        try:
+            self._file.close()
+            _replace_note(self.note_path, [], keep_bytes=self.offset)
+            logger.info("Streamed note section discarded in file: %s", self.note_path)
+        finally:
+            self._lock.release()
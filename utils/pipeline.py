@@ -0,0 +1,478 @@
+import io, os, json, time, random, asyncio, logging
+from typing import Callable, List, Dict, Any, Optional, Sequence, Union
+from utils.preprocess import preprocess_file
+from utils.llm import agenerate_notes, agenerate_packed_notes, aformat_notes, is_multimodal, MissingAPIKeyError, UnRegisteredModelError, FallbackChainFailed
+from utils.images import get_image_limits
+from utils.obsidian import append_note_sections, NoteStream, get_note_path, note_size, section_written
+
+config = json.load(open("config.json"))
+BATCH_CONFIG = config["BATCH"]
+PACKING_CONFIG = config["PACKING"]
+
+logger = logging.getLogger(__name__)
+
+STAGES = ["preprocessed", "generated", "formatted", "written"]
+
+# Failures that will not go away by trying again
+PERMANENT_ERRORS = (ValueError, MissingAPIKeyError, UnRegisteredModelError)
+# Not retried within a run either: every model of the fallback chain was already tried,
+# and retrying would send the whole chain again. A later resume may still succeed.
+NON_RETRYABLE_ERRORS = PERMANENT_ERRORS + (FallbackChainFailed,)
+
+
+class LocalFile:
+    """
+    A file on disk that quacks like a Streamlit ``UploadedFile``.
+
+    Contents are read on first use and dropped again by :meth:`release`, so a
+    batch of thousands of files only holds the ones currently in flight.
+    """
+
+    def __init__(self, path: str, name: Optional[str] = None):
+        self.path = path
+        self.name = name or os.path.basename(path)
+        self._buffer = None
+
+    def _data(self) -> io.BytesIO:
+        if self._buffer is None:
+            with open(self.path, "rb") as f:
+                self._buffer = io.BytesIO(f.read())
+        return self._buffer
+
+    def __getattr__(self, name):
+        # read/seek/tell/readinto/getvalue/getbuffer all come from the in-memory copy
+        return getattr(self._data(), name)
+
+    def release(self):
+        self._buffer = None
+
+
+def _report(on_progress, index, stage, error=None):
+    if on_progress:
+        try:
+            on_progress(index, stage, error)
+        except Exception as e:
+            logger.error("Progress callback failed: %s", e, exc_info=True)
+
+
+class _VaultSink:
+    """Buffers streamed chunks for one file until its section may be written to the note."""
+
+    def __init__(self):
+        self.chunks = []
+        self.stream = None
+
+    def write(self, chunk):
+        if self.stream:
+            self.stream.write(chunk)
+        else:
+            self.chunks.append(chunk)
+
+    def attach(self, stream):
+        self.stream = stream
+        stream.write("".join(self.chunks))
+        self.chunks = []
+
+
+def _on_chunk(index, stage, on_stream, sink=None):
+    if not on_stream and not sink:
+        return None
+
+    def on_chunk(chunk):
+        if sink:
+            sink.write(chunk)
+        if on_stream:
+            try:
+                on_stream(index, stage, chunk)
+            except Exception as e:
+                logger.error("Stream callback failed: %s", e, exc_info=True)
+
+    return on_chunk
+
+
+class _Packer:
+    """
+    Coalesces images waiting to be generated into shared multimodal requests.
+
+    A pack is sent once it holds ``size`` items or ``linger`` seconds after its
+    first item arrived, whichever comes first. ``run`` is called with the items
+    of a pack and returns the notes of each, or ``None`` for items to generate
+    on their own. When the pack fails as a whole every item is generated on its
+    own, so one bad source cannot fail (and be retried with) the others.
+    """
+
+    def __init__(self, run: Callable, size: int, linger: float):
+        self.run = run
+        self.size = size
+        self.linger = linger
+        self.pending = []
+        self.timer = None
+        self.tasks = set()
+
+    async def submit(self, item) -> Optional[str]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.size:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.linger, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pack, self.pending = self.pending, []
+        if pack:
+            task = asyncio.ensure_future(self._send(pack))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, pack):
+        try:
+            results = await self.run([item for item, _ in pack])
+        except Exception as e:
+            logger.warning("Packed request for %d source(s) failed, generating them one by one: %s", len(pack), e)
+            results = [None] * len(pack)
+        for (_, future), notes in zip(pack, results):
+            if not future.done():
+                future.set_result(notes)
+
+
+def _same_note(item, other):
+    return item["title"] == other["title"] and item["vault_path"] == other["vault_path"]
+
+
+def _completed(item, stage):
+    return item["stage"] is not None and STAGES.index(item["stage"]) >= STAGES.index(stage)
+
+
+async def _with_retries(name, item, handle):
+    """Run ``handle(item)``, retrying transient failures with jittered exponential backoff."""
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            await handle(item)
+            return
+        except NON_RETRYABLE_ERRORS:
+            raise
+        except Exception as e:
+            if attempt > BATCH_CONFIG["RETRIES"]:
+                raise
+            delay = min(BATCH_CONFIG["BACKOFF_SECONDS"] * 2 ** (attempt - 1), BATCH_CONFIG["MAX_BACKOFF_SECONDS"])
+            delay *= random.uniform(0.5, 1)
+            logger.warning("Attempt %d of %s stage failed for file %s: %s; retrying in %.1fs", attempt, name, item["name"], e, delay)
+            await asyncio.sleep(delay)
+        finally:
+            item["attempts"] = attempt
+
+
+async def _run_stage(name, workers, inbox, outbox, downstream_workers, write_queue, handle, on_progress, on_done, on_failed):
+    """
+    Run ``workers`` copies of ``handle`` over ``inbox``, forwarding finished items to ``outbox``.
+
+    Items that already completed the stage in an earlier run pass straight
+    through. Items that still fail after the retries skip the remaining stages
+    and go straight to the writer so it can keep the upload order moving. Each
+    stage closes its ``outbox`` with one ``None`` per downstream worker once all
+    of its own workers are done.
+    """
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is None:
+                break
+            if _completed(item, name):
+                _report(on_progress, item["index"], name)
+                await outbox.put(item)
+                continue
+            started = time.perf_counter()
+            try:
+                await _with_retries(name, item, handle)
+                await on_done(item, name)
+            except Exception as e:
+                logger.error("Error in %s stage for file %s: %s", name, item["name"], e, exc_info=True)
+                item["error"] = e
+                await on_failed(item, e)
+                _report(on_progress, item["index"], "failed", e)
+                await write_queue.put(item)
+                continue
+            finally:
+                item["timings"][name] = time.perf_counter() - started
+            _report(on_progress, item["index"], name)
+            await outbox.put(item)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    for _ in range(downstream_workers):
+        await outbox.put(None)
+
+
+async def take_notes_async(
+    files: List[Any],
+    title: Union[str, Sequence[str]],
+    vault_path: Union[str, Sequence[str]],
+    model_generation: str,
+    model_formatting: str,
+    ocr_enhance: bool = False,
+    use_cache: bool = True,
+    hedge: Optional[bool] = None,
+    workers: Optional[Dict[str, int]] = None,
+    on_progress: Optional[Callable] = None,
+    on_stream: Optional[Callable] = None,
+    stream_to_vault: bool = False,
+    job_store: Optional[Any] = None,
+    batch_id: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Take notes for many files as a staged pipeline and append them to the vault in upload order.
+
+    Preprocessing, generation, formatting and writing run as separate stages
+    connected by bounded queues, each with its own number of workers, so file
+    ``i + 1`` is OCR'd while file ``i`` waits on the provider. A single writer
+    appends sections strictly in the order of ``files``. When the generation
+    model takes several images per request, images waiting to be generated
+    are packed into shared requests (``PACKING`` in config.json).
+
+    Args:
+        files (list): Uploaded files (anything with ``name``, ``read``/``getvalue`` and ``getbuffer``)
+        title (str | list): Note title the sections are appended to, or one title per file
+        vault_path (str | list): Folder inside the vault to write to, or one folder per file
+        model_generation (str): Model used to generate the notes
+        model_formatting (str): Model used to format the notes
+        ocr_enhance (bool): Force OCR on PDFs with a text layer
+        use_cache (bool): Reuse cached LLM responses
+        hedge (bool): Also send requests that are slower than usual to the next model of
+            HEDGING.FALLBACK_CHAIN, defaults to HEDGING.ENABLED
+        workers (dict): Workers per stage (``preprocessed``, ``generated``, ``formatted``),
+            defaults to BATCH.WORKERS
+        on_progress (callable): Called as ``on_progress(index, stage, error)`` on the event loop thread
+        on_stream (callable): Called as ``on_stream(index, stage, chunk)`` for every streamed chunk
+            of the ``"generating"`` and ``"formatting"`` passes; enables provider streaming
+        stream_to_vault (bool): Stream the formatting pass into the note as it arrives; a file's
+            chunks are buffered until every earlier file has been written
+        job_store (JobStore): Durable store to record every completed stage and its artifacts in;
+            files resume after the last stage recorded for them
+        batch_id (str): Batch in ``job_store`` the files belong to, in the same order
+
+    Returns:
+        list: One result dict per file with ``name``, ``notes``, ``note_path``, ``error`` and
+            ``timings`` (seconds spent in each stage)
+    """
+    workers = {**BATCH_CONFIG["WORKERS"], **(workers or {})}
+    queue_size = BATCH_CONFIG["QUEUE_SIZE"]
+    preprocess_queue = asyncio.Queue(queue_size)
+    generate_queue = asyncio.Queue(queue_size)
+    format_queue = asyncio.Queue(queue_size)
+    # The writer never blocks its producers, so failures can always reach it
+    write_queue = asyncio.Queue()
+
+    items = [
+        {
+            "index": i,
+            "file": file,
+            "name": file.name,
+            "stage": None,
+            "notes": None,
+            "note_path": None,
+            "error": None,
+            "attempts": 0,
+            "timings": {},
+            "title": title if isinstance(title, str) else title[i],
+            "vault_path": vault_path if isinstance(vault_path, str) else vault_path[i],
+            "sink": _VaultSink() if stream_to_vault else None,
+        }
+        for i, file in enumerate(files)
+    ]
+
+    if job_store:
+        # Pick every file up after the last stage an earlier run recorded for it
+        for item, job in zip(items, await asyncio.to_thread(job_store.jobs, batch_id)):
+            artifacts = job["artifacts"]
+            item["stage"] = job["stage"]
+            item["notes"] = artifacts.get("notes")
+            item["note_path"] = artifacts.get("note_path")
+            writing = artifacts.get("writing")
+            if job["stage"] == "formatted" and writing and section_written(writing["note_path"], writing["offset"], item["name"]):
+                # The earlier run appended the section but stopped before recording it
+                logger.info("Section for %s was already written to %s", item["name"], writing["note_path"])
+                item["stage"], item["note_path"] = "written", writing["note_path"]
+                await asyncio.to_thread(job_store.record, batch_id, item["index"], "written", {"note_path": item["note_path"]})
+            if job["stage"] == "preprocessed":
+                item["preprocessed"] = (artifacts["file_content"], artifacts["image_path"], artifacts["ocr_result"])
+
+    def remove_image(item):
+        _, image_path, _ = item.pop("preprocessed", (None, None, None))
+        for path in ([image_path] if isinstance(image_path, str) else image_path or []):
+            if os.path.exists(path):
+                os.remove(path)
+                logger.info("Temporary image file removed: %s", path)
+
+    async def on_done(item, stage):
+        if job_store:
+            if stage == "preprocessed":
+                file_content, image_path, ocr_result = item["preprocessed"]
+                if isinstance(image_path, str):
+                    image_path = await asyncio.to_thread(job_store.keep_file, batch_id, item["index"], image_path)
+                elif image_path:
+                    # Rendered pages of a PDF
+                    image_path = [await asyncio.to_thread(job_store.keep_file, batch_id, item["index"], path, part) for part, path in enumerate(image_path)]
+                item["preprocessed"] = (file_content, image_path, ocr_result)
+                artifacts = {"file_content": file_content, "image_path": image_path, "ocr_result": ocr_result}
+            elif stage == "written":
+                artifacts = {"note_path": item["note_path"]}
+            else:
+                artifacts = {"notes": item["notes"]}
+            await asyncio.to_thread(job_store.record, batch_id, item["index"], stage, artifacts)
+        item["stage"] = stage
+        if stage == "generated":
+            # Only now that the notes are safe is the prepared image no longer needed
+            remove_image(item)
+
+    async def on_failed(item, error):
+        if job_store:
+            final = isinstance(error, PERMANENT_ERRORS)
+            await asyncio.to_thread(job_store.record_failure, batch_id, item["index"], error, item["attempts"], final)
+        else:
+            remove_image(item)
+
+    async def preprocess_item(item):
+        file_content, image_path, ocr_result = await asyncio.to_thread(preprocess_file, item["file"], ocr_enhance, render_pages)
+        if not (file_content or image_path or ocr_result):
+            raise ValueError(f"No content could be extracted from {item['name']}")
+        item["preprocessed"] = (file_content, image_path, ocr_result)
+        if isinstance(item["file"], LocalFile):
+            # Read again for the asset copy at write time rather than held while queued
+            item["file"].release()
+
+    async def generate_pack(pack):
+        sources = [(item["name"], item["preprocessed"][1], item["preprocessed"][2]) for item in pack]
+        return await agenerate_packed_notes(sources, model=model_generation, use_cache=use_cache, hedge=hedge)
+
+    # Single images share multimodal requests where the model takes several; the generation
+    # workers waiting on a pack are what fills it, so a pack never outgrows them
+    pack_size = min(PACKING_CONFIG["MAX_SOURCES"], get_image_limits(model_generation)["MAX_IMAGES"], workers["generated"])
+    packer = None
+    if PACKING_CONFIG["ENABLED"] and is_multimodal(model_generation) and pack_size > 1:
+        packer = _Packer(generate_pack, pack_size, PACKING_CONFIG["LINGER_SECONDS"])
+    render_pages = PACKING_CONFIG["RENDER_SCANNED_PDF_PAGES"] and is_multimodal(model_generation)
+
+    async def generate_item(item):
+        file_content, image_path, ocr_result = item["preprocessed"]
+        if packer and isinstance(image_path, str) and not file_content:
+            notes = await packer.submit(item)
+            if notes is not None:
+                item["notes"] = notes
+                on_chunk = _on_chunk(item["index"], "generating", on_stream)
+                if on_chunk:
+                    on_chunk(notes)
+                return
+        item["notes"] = await agenerate_notes(file=file_content, image_path=image_path, ocr_enhance_info=ocr_result, model=model_generation, use_cache=use_cache, on_chunk=_on_chunk(item["index"], "generating", on_stream), hedge=hedge)
+
+    async def format_item(item):
+        item["notes"] = await aformat_notes(notes=item["notes"], model=model_formatting, use_cache=use_cache, on_chunk=_on_chunk(item["index"], "formatting", on_stream, item["sink"]), hedge=hedge)
+
+    async def open_stream(item):
+        if _completed(item, "written"):
+            return
+        try:
+            item["note_stream"] = await asyncio.to_thread(NoteStream, item["title"], item["vault_path"], item["file"])
+            item["sink"].attach(item["note_stream"])
+        except Exception as e:
+            logger.error("Error opening note stream for file %s: %s", item["name"], e, exc_info=True)
+
+    async def write(batch):
+        note_stream = batch[0].pop("note_stream", None)
+        to_write = []
+        for item in batch:
+            if _completed(item, "written"):
+                _report(on_progress, item["index"], "written")
+            elif item["error"] is not None:
+                if note_stream:
+                    await asyncio.to_thread(note_stream.abort)
+                if isinstance(item["file"], LocalFile):
+                    item["file"].release()
+            else:
+                to_write.append(item)
+        if not to_write:
+            return
+
+        started = time.perf_counter()
+        try:
+            if job_store:
+                if note_stream:
+                    note_path, offset = note_stream.note_path, note_stream.offset
+                else:
+                    note_path = get_note_path(to_write[0]["title"], to_write[0]["vault_path"])
+                    offset = await asyncio.to_thread(note_size, note_path)
+                for item in to_write:
+                    await asyncio.to_thread(job_store.record_writing, batch_id, item["index"], note_path, offset)
+            if note_stream:
+                note_path = await asyncio.to_thread(note_stream.close, to_write[0]["notes"])
+            else:
+                note_path = await asyncio.to_thread(
+                    append_note_sections,
+                    note_title=to_write[0]["title"],
+                    vault_path=to_write[0]["vault_path"],
+                    sections=[(item["notes"], item["file"]) for item in to_write],
+                )
+            for item in to_write:
+                item["note_path"] = note_path
+                await on_done(item, "written")
+                _report(on_progress, item["index"], "written")
+        except Exception as e:
+            logger.error("Error creating notes for file(s) %s: %s", ", ".join(item["name"] for item in to_write), e, exc_info=True)
+            for item in to_write:
+                item["error"] = e
+                await on_failed(item, e)
+                _report(on_progress, item["index"], "failed", e)
+        finally:
+            elapsed = time.perf_counter() - started
+            for item in to_write:
+                item["timings"]["written"] = elapsed / len(to_write)
+                if isinstance(item["file"], LocalFile):
+                    item["file"].release()
+
+    async def writer():
+        # Reorder buffer: sections are appended strictly in upload order, and consecutive
+        # ready sections of the same note are appended in one write
+        pending, next_index = {}, 0
+        if stream_to_vault and items:
+            await open_stream(items[0])
+        while next_index < len(items):
+            item = await write_queue.get()
+            pending[item["index"]] = item
+            while next_index in pending:
+                batch = [pending.pop(next_index)]
+                next_index += 1
+                while not stream_to_vault and next_index in pending and _same_note(batch[0], pending[next_index]):
+                    batch.append(pending.pop(next_index))
+                    next_index += 1
+                await write(batch)
+                if stream_to_vault and next_index < len(items):
+                    await open_stream(items[next_index])
+
+    async def feed():
+        for item in items:
+            await preprocess_queue.put(item)
+        for _ in range(workers["preprocessed"]):
+            await preprocess_queue.put(None)
+
+    await asyncio.gather(
+        feed(),
+        _run_stage("preprocessed", workers["preprocessed"], preprocess_queue, generate_queue, workers["generated"], write_queue, preprocess_item, on_progress, on_done, on_failed),
+        _run_stage("generated", workers["generated"], generate_queue, format_queue, workers["formatted"], write_queue, generate_item, on_progress, on_done, on_failed),
+        _run_stage("formatted", workers["formatted"], format_queue, write_queue, 0, write_queue, format_item, on_progress, on_done, on_failed),
+        writer(),
+    )
+
+    return [
+        {key: item[key] for key in ("name", "notes", "note_path", "error", "timings")}
+        for item in items
+    ]
+
+
+def take_notes(*args, **kwargs) -> List[Dict[str, Any]]:
+    """Blocking wrapper around :func:`take_notes_async` for callers without an event loop."""
+    return asyncio.run(take_notes_async(*args, **kwargs))
@@ -1,55 +1,184 @@
-import easyocr, re, os
-import pypdfium2 as pdfium
-from PIL import Image
+import re, os, io, json, math, multiprocessing, tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from utils.reader_pool import reader_pool, DEFAULT_LANGUAGES, OCR_CONFIG
+from utils.cache import open_cache, make_key
+from utils.chunking import PAGE_BREAK, SECTION_BREAK, strip_markers
 
-def ocr(image_path: str):
+config = json.load(open("config.json"))
+PACKING_CONFIG = config["PACKING"]
+
+RENDER_SCALE = 4
+OCR_WORKERS = OCR_CONFIG["PROCESS_WORKERS"]
+
+_ocr_executor = None
+
+ocr_cache = open_cache("OCR")
+
+def ocr(image, languages=DEFAULT_LANGUAGES):
+    # `image` may be a file path, encoded image bytes or a BGR numpy array
     try:
-        reader = easyocr.Reader(['ch_sim','en'])
-        result = reader.readtext(image_path, detail=0)
+        with reader_pool.reader(languages) as reader:
+            result = reader.readtext(image, detail=0)
         return " ".join(result)
     except Exception as e:
         print("Error during OCR:", e)
 
-def preprocess_pdf(pdf, ocr_enhance=False):
-    text = ""
+def cached_ocr(image, content, scale=None, languages=DEFAULT_LANGUAGES):
+    # `content` is the raw page/image buffer the result is keyed on, so re-runs and
+    # unchanged pages of an edited document skip the reader entirely
+    key = make_key("ocr", sorted(languages), scale, content)
+    result = ocr_cache.get_text(key)
+    if result is None:
+        result = ocr(image, languages)
+        if result is None:
+            return None
+        ocr_cache.set_text(key, result)
+    return result
+
+def _ocr_pdf_page(pages, i):
+    # pdfium renders BGR by default, which is the channel order EasyOCR expects for arrays;
+    # the bitmap must outlive the numpy view over its buffer
+    bitmap = pages[i].render(scale=RENDER_SCALE)
+    return str(cached_ocr(bitmap.to_numpy(), memoryview(bitmap.buffer), RENDER_SCALE))
+
+def _init_ocr_worker(threads):
+    # Split the cores between workers instead of letting every worker's torch grab all of them
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    reader_pool.warm_up()
+
+def _ocr_pdf_pages(pdf_bytes, indices):
+    import pypdfium2 as pdfium
+    pages = pdfium.PdfDocument(pdf_bytes)
+    return [_ocr_pdf_page(pages, i) for i in indices]
+
+def _get_ocr_executor():
+    global _ocr_executor
+    if _ocr_executor is None:
+        threads = max(1, (os.cpu_count() or 1) // OCR_WORKERS)
+        _ocr_executor = ProcessPoolExecutor(
+            max_workers=OCR_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_ocr_worker,
+            initargs=(threads,),
+        )
+    return _ocr_executor
+
+def _read_bytes(file):
+    if isinstance(file, (bytes, bytearray)):
+        return bytes(file)
+    if hasattr(file, "getvalue"):
+        return file.getvalue()
+    with open(file, "rb") as f:
+        return f.read()
+
+def ocr_pdf_parallel(pdf, page_count):
+    """
+    OCR every page of ``pdf`` on a pool of worker processes, each holding its own warm reader.
+
+    Pages are handed out in contiguous runs and collected in page order, so the
+    result matches the serial path exactly.
+    """
+    global _ocr_executor
+    pdf_bytes = _read_bytes(pdf)
+    run_length = max(1, math.ceil(page_count / (OCR_WORKERS * 4)))
+    runs = [range(start, min(start + run_length, page_count)) for start in range(0, page_count, run_length)]
+    try:
+        results = _get_ocr_executor().map(_ocr_pdf_pages, [pdf_bytes] * len(runs), runs)
+        return [text for run in results for text in run]
+    except BrokenProcessPool:
+        print("OCR worker pool crashed; falling back to serial OCR.")
+        _ocr_executor = None
+        import pypdfium2 as pdfium
+        pages = pdfium.PdfDocument(pdf_bytes)
+        return [_ocr_pdf_page(pages, i) for i in range(page_count)]
+
+def _section_starts(pages):
+    # Pages that open a top-level outline entry; chunking prefers to cut there
+    try:
+        return {item.page_index for item in pages.get_toc(max_depth=1) if item.page_index is not None}
+    except Exception as e:
+        print("Could not read PDF outline:", e)
+        return set()
+
+def _render_page_images(pages):
+    # Scratch PNG per page for vision models; they are downscaled per model when the request is built
+    image_paths = []
+    for page in pages:
+        fd, image_path = tempfile.mkstemp(prefix="anotar_page_", suffix=".png")
+        with os.fdopen(fd, "wb") as f:
+            page.render(scale=PACKING_CONFIG["PAGE_RENDER_SCALE"]).to_pil().save(f, format="PNG")
+        image_paths.append(image_path)
+    return image_paths
+
+def preprocess_pdf(pdf, ocr_enhance=False, render_pages=False):
+    # pdfium and Pillow (like EasyOCR in the reader pool) are loaded by the first file that needs them
+    import pypdfium2 as pdfium
     ocr_result = ""
+    image_paths = None
     pages = pdfium.PdfDocument(pdf)
-    for page in pages:
+    section_starts = _section_starts(pages)
+    page_texts = []
+    for i, page in enumerate(pages):
         t = page.get_textpage().get_text_range()
-        if t:
-            text += t
+        page_texts.append((SECTION_BREAK if i in section_starts else "") + (t or ""))
+    text = PAGE_BREAK.join(page_texts)
 
-    text = text.strip()
-    alpha_chars = len(re.findall(r'[a-zA-Z]', text))
-    if len(text) == 0 or alpha_chars / len(text) < 0.3:
+    plain_text = strip_markers(text).strip()
+    if not plain_text:
+        text = ""
+    alpha_chars = len(re.findall(r'[a-zA-Z]', plain_text))
+    if len(plain_text) == 0 or alpha_chars / len(plain_text) < 0.3:
         ocr_enhance = True
+        if render_pages:
+            # Without a usable text layer the model is better off seeing the pages themselves
+            image_paths = _render_page_images(pages)
 
     if ocr_enhance:
-        for i in range(len(pages)):
-            name = f"./ocr/page{i}.png"
-            page = pages[i]
-            image = page.render(scale=4).to_pil()
-            image.save(f'{name}')
-            ocr_result += str(ocr(f'{name}')) + '\n'
-            os.remove(f'{name}')
+        if OCR_WORKERS > 1 and len(pages) > 1:
+            page_results = ocr_pdf_parallel(pdf, len(pages))
+        else:
+            page_results = [_ocr_pdf_page(pages, i) for i in range(len(pages))]
+        ocr_result = PAGE_BREAK.join(page_results)
 
-    return text, None, ocr_result
+    return text, image_paths, ocr_result
+
+def _save_scratch_image(image_bytes):
+    # The vision models still take a file path, so give each job its own scratch copy. JPEGs
+    # are kept as they are (a PNG of a photo is several times larger); the per-model
+    # downscaling and re-encoding happens when the request is built.
+    if image_bytes.startswith(b"\x89PNG"):
+        suffix = ".png"
+    elif image_bytes.startswith(b"\xff\xd8"):
+        suffix = ".jpg"
+    else:
+        suffix = None
+    fd, image_path = tempfile.mkstemp(prefix="anotar_", suffix=suffix or ".png")
+    with os.fdopen(fd, "wb") as f:
+        if suffix:
+            f.write(image_bytes)
+        else:
+            from PIL import Image
+            Image.open(io.BytesIO(image_bytes)).save(f, format="PNG")
+    return image_path
 
 def preprocess_image(image):
     ocr_result = ""
-    name = "./ocr/ocr.png"
-    image = Image.open(image)
-    image.save(f'{name}')
-    image_path = f"{name}"
-    ocr_result += str(ocr(image_path))
+    image_bytes = _read_bytes(image)
+    image_path = _save_scratch_image(image_bytes)
+    ocr_result += str(cached_ocr(image_bytes, image_bytes))
 
     return None, image_path, ocr_result
 
-def preprocess_file(file, ocr_enhance=False):
+def preprocess_file(file, ocr_enhance=False, render_pages=False):
     print("Processing file...")
     if file.name.lower().endswith('.pdf'):
         print("pdf file detected.")
-        results = preprocess_pdf(file, ocr_enhance)
+        results = preprocess_pdf(file, ocr_enhance, render_pages)
     else:
         results = preprocess_image(file)
 
@@ -0,0 +1,258 @@
+import re, json, time, random, threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+config = json.load(open("config.json"))
+PROVIDER_LIMITS = config["PROVIDER_LIMITS"]
+PROVIDER_CONCURRENCY = config["PROVIDER_CONCURRENCY"]
+ADAPTIVE_CONFIG = config["ADAPTIVE_CONCURRENCY"]
+
+# Status codes providers use to say "slow down"
+THROTTLE_STATUS_CODES = (429, 503, 529)
+
+
+class RateLimiter:
+    """
+    Token buckets for requests and tokens per minute.
+
+    Both buckets refill continuously, so bursts up to a full minute's budget
+    are allowed after an idle period. Token reservations are estimates and can
+    be corrected with :meth:`adjust` once the real usage is known; the bucket
+    may go negative, which simply delays the next requests. A provider's
+    Retry-After is honoured through :meth:`block`.
+
+    Args:
+        requests_per_minute (int): Request budget, ``None`` for unlimited
+        tokens_per_minute (int): Token budget, ``None`` for unlimited
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        self.capacity = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.level = {name: capacity for name, capacity in self.capacity.items() if capacity}
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        for name in self.level:
+            capacity = self.capacity[name]
+            self.level[name] = min(capacity, self.level[name] + elapsed * capacity / 60)
+
+    def acquire(self, tokens: int = 0):
+        """Block until one request of ``tokens`` tokens fits both budgets, then take it from them."""
+        wanted = {"requests": 1, "tokens": tokens}
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._blocked_until - now
+                for name, level in self.level.items():
+                    # A request larger than the whole budget only has to wait for a full bucket
+                    need = min(wanted[name], self.capacity[name])
+                    if level < need:
+                        wait = max(wait, (need - level) * 60 / self.capacity[name])
+                if wait <= 0:
+                    for name in self.level:
+                        self.level[name] -= wanted[name]
+                    return
+            time.sleep(wait)
+
+    def adjust(self, tokens: int):
+        """Charge ``tokens`` more (or, if negative, fewer) than were reserved."""
+        with self._lock:
+            if "tokens" in self.level:
+                self.level["tokens"] = min(self.capacity["tokens"], self.level["tokens"] - tokens)
+
+    def block(self, seconds: float):
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limit that adapts to how the provider is coping (AIMD).
+
+    Every healthy response raises the limit additively by ``1 / limit``, i.e.
+    by about one slot per round of requests, up to ``maximum``. Throttling, or
+    a response much slower per token than the running baseline, cuts the limit
+    multiplicatively, at most once per cooldown so that one burst of errors
+    does not collapse it to the minimum.
+
+    Args:
+        maximum (int): Hard ceiling on concurrent requests
+        minimum (int): Floor the limit never drops below
+        initial (float): Starting limit, defaults to half the ceiling
+    """
+
+    def __init__(self, maximum: int, minimum: int = ADAPTIVE_CONFIG["MIN_CONCURRENCY"], initial: Optional[float] = None):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.limit = float(initial or max(self.minimum, maximum // 2))
+        self.active = 0
+        self.baseline = None
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            while self.active >= int(self.limit):
+                self._condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.active -= 1
+                self._condition.notify()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < ADAPTIVE_CONFIG["COOLDOWN_SECONDS"]:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * ADAPTIVE_CONFIG["DECREASE_FACTOR"])
+
+    def on_success(self, seconds_per_token: float):
+        with self._condition:
+            if self.baseline is not None and seconds_per_token > self.baseline * ADAPTIVE_CONFIG["LATENCY_SPIKE_FACTOR"]:
+                self._decrease()
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+            # The baseline keeps moving so a provider that is simply slower today is not punished forever
+            self.baseline = seconds_per_token if self.baseline is None else 0.9 * self.baseline + 0.1 * seconds_per_token
+
+    def on_throttle(self):
+        with self._condition:
+            self._decrease()
+
+
+class _Gate:
+    def __init__(self, provider, model):
+        provider_limits = PROVIDER_LIMITS.get(provider) or {}
+        model_limits = provider_limits.get("MODELS", {}).get(model) or {}
+        self.provider = provider
+        self.model = model
+        self.provider_limiter = _shared_limiter(provider, provider_limits)
+        self.model_limiter = RateLimiter(model_limits.get("REQUESTS_PER_MINUTE"), model_limits.get("TOKENS_PER_MINUTE"))
+        self.concurrency = _shared_concurrency(provider)
+
+
+_lock = threading.Lock()
+_gates = {}
+_provider_limiters = {}
+_controllers = {}
+
+
+def _shared_limiter(provider, limits):
+    if provider not in _provider_limiters:
+        _provider_limiters[provider] = RateLimiter(limits.get("REQUESTS_PER_MINUTE"), limits.get("TOKENS_PER_MINUTE"))
+    return _provider_limiters[provider]
+
+
+def _shared_concurrency(provider):
+    if provider not in _controllers:
+        _controllers[provider] = AdaptiveConcurrency(PROVIDER_CONCURRENCY.get(provider, ADAPTIVE_CONFIG["MIN_CONCURRENCY"]))
+    return _controllers[provider]
+
+
+def _get_gate(provider, model):
+    with _lock:
+        gate = _gates.get((provider, model))
+        if gate is None:
+            gate = _gates[(provider, model)] = _Gate(provider, model)
+        return gate
+
+
+def _status_code(error) -> Optional[int]:
+    # SDKs disagree on where the status lives: e.status_code, e.response.status_code, e.raw_response.status_code or e.code
+    for source in (error, getattr(error, "response", None), getattr(error, "raw_response", None)):
+        status = getattr(source, "status_code", None)
+        if isinstance(status, int):
+            return status
+    status = getattr(error, "code", None)
+    return int(status) if isinstance(status, int) else None
+
+
+def _headers(error):
+    for source in (getattr(error, "response", None), getattr(error, "raw_response", None)):
+        headers = getattr(source, "headers", None)
+        if headers is not None:
+            return headers
+    return {}
+
+
+def retry_after(error) -> Optional[float]:
+    """
+    Seconds to wait before retrying a request that failed with ``error``.
+
+    Returns:
+        float: Delay from the provider's Retry-After hints, the configured default when it
+            gave none, or ``None`` when ``error`` is not a throttling error
+    """
+    if _status_code(error) not in THROTTLE_STATUS_CODES:
+        return None
+
+    headers = _headers(error)
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+
+    # Gemini puts its hint in the error details rather than the headers
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", str(error))
+    if match:
+        return float(match.group(1))
+    return float(ADAPTIVE_CONFIG["DEFAULT_RETRY_AFTER"])
+
+
+class _Usage:
+    def __init__(self):
+        self.tokens = None
+
+
+@contextmanager
+def rate_limited(provider: str, model: str, tokens: int):
+    """
+    Hold a concurrency slot for one request to ``model`` once the provider's budgets allow it.
+
+    The caller may set ``usage.tokens`` on the yielded object to the real size
+    of the exchange so the token budgets are corrected. A throttling error
+    raised inside the block shrinks the provider's concurrency and pauses the
+    model's limiter for the Retry-After period before it propagates.
+
+    Args:
+        provider (str): Provider the request goes to
+        model (str): Model the request goes to
+        tokens (int): Estimated tokens of the whole exchange, prompt and answer
+    """
+    gate = _get_gate(provider, model)
+    gate.model_limiter.acquire(tokens)
+    gate.provider_limiter.acquire(tokens)
+    with gate.concurrency.slot():
+        usage = _Usage()
+        started = time.monotonic()
+        try:
+            yield usage
+        except Exception as e:
+            delay = retry_after(e)
+            if delay is not None:
+                gate.concurrency.on_throttle()
+                gate.model_limiter.block(delay * random.uniform(1, 1.2))
+            raise
+        if usage.tokens is not None:
+            gate.model_limiter.adjust(usage.tokens - tokens)
+            gate.provider_limiter.adjust(usage.tokens - tokens)
+        gate.concurrency.on_success((time.monotonic() - started) / max(usage.tokens or tokens, 1))
+
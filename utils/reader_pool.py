@@ -0,0 +1,140 @@
+import json, threading, time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple
+
+config = json.load(open("config.json"))
+OCR_CONFIG = config["OCR"]
+
+DEFAULT_LANGUAGES = tuple(OCR_CONFIG["LANGUAGES"])
+
+
+class ReaderPool:
+    """
+    Process-wide pool of warm EasyOCR readers, keyed by language set.
+
+    Readers are expensive to build (detection and recognition weights are loaded
+    from disk), so they are built lazily, handed out one caller at a time and
+    returned to the pool afterwards. Readers left idle for longer than
+    ``idle_timeout`` seconds are dropped to give their memory back.
+
+    Args:
+        pool_size (int): Maximum number of readers kept per language set
+        idle_timeout (float): Seconds a reader may stay unused before eviction
+    """
+
+    def __init__(self, pool_size: int = 1, idle_timeout: float = 900):
+        self.pool_size = max(1, pool_size)
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Condition()
+        self._idle: Dict[Tuple[str, ...], List[Tuple[float, object]]] = {}
+        self._built: Dict[Tuple[str, ...], int] = {}
+        self._reaper = None
+
+    @staticmethod
+    def _key(languages: Iterable[str]) -> Tuple[str, ...]:
+        return tuple(sorted(languages))
+
+    def _build(self, key: Tuple[str, ...]):
+        import easyocr
+        print(f"Loading OCR reader for languages: {list(key)}")
+        return easyocr.Reader(list(key))
+
+    def _start_reaper(self):
+        if self._reaper is None and self.idle_timeout:
+            self._reaper = threading.Thread(target=self._reap, name="ocr-reader-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(max(1.0, self.idle_timeout / 2))
+            self.evict_idle()
+
+    def evict_idle(self):
+        """Drop readers that have not been used within ``idle_timeout`` seconds."""
+        now = time.monotonic()
+        with self._lock:
+            for key, idle in self._idle.items():
+                keep = [(last_used, reader) for last_used, reader in idle if now - last_used < self.idle_timeout]
+                evicted = len(idle) - len(keep)
+                if evicted:
+                    self._idle[key] = keep
+                    self._built[key] -= evicted
+                    print(f"Evicted {evicted} idle OCR reader(s) for languages: {list(key)}")
+            self._lock.notify_all()
+
+    @contextmanager
+    def reader(self, languages: Iterable[str] = DEFAULT_LANGUAGES):
+        """
+        Check out a reader for ``languages``, building one if the pool has room.
+
+        Blocks until a reader is free when ``pool_size`` readers are already in use.
+        """
+        key = self._key(languages)
+        reader = None
+        with self._lock:
+            self._start_reaper()
+            while True:
+                idle = self._idle.setdefault(key, [])
+                if idle:
+                    _, reader = idle.pop()
+                    break
+                if self._built.get(key, 0) < self.pool_size:
+                    self._built[key] = self._built.get(key, 0) + 1
+                    break
+                self._lock.wait()
+
+        if reader is None:
+            try:
+                reader = self._build(key)
+            except Exception:
+                with self._lock:
+                    self._built[key] -= 1
+                    self._lock.notify_all()
+                raise
+
+        try:
+            yield reader
+        finally:
+            with self._lock:
+                self._idle.setdefault(key, []).append((time.monotonic(), reader))
+                self._lock.notify_all()
+
+    def warm_up(self, languages: Iterable[str] = DEFAULT_LANGUAGES):
+        """Build one reader for ``languages`` ahead of the first OCR call."""
+        with self.reader(languages):
+            pass
+
+    def warm_up_async(self, languages: Iterable[str] = DEFAULT_LANGUAGES) -> threading.Thread:
+        """Warm up in a background thread so callers are not blocked on model loading."""
+        thread = threading.Thread(target=self._warm_up_quietly, args=(tuple(languages),), name="ocr-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def _warm_up_quietly(self, languages):
+        try:
+            self.warm_up(languages)
+        except Exception as e:
+            print("Error warming up OCR reader:", e)
+
+
+reader_pool = ReaderPool(
+    pool_size=OCR_CONFIG["READER_POOL_SIZE"],
+    idle_timeout=OCR_CONFIG["READER_IDLE_TIMEOUT"],
+)
+
+_warm_up_started = False
+_warm_up_lock = threading.Lock()
+
+def warm_up_once():
+    """Start a one-off background warm-up, e.g. as soon as a file that needs OCR is uploaded; safe to call on every rerun."""
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    reader_pool.warm_up_async()
+
+def warm_up_on_start():
+    """Warm up once when the app starts if ``OCR.WARM_UP_ON_START`` is on in config.json (off by default: it loads torch)."""
+    if OCR_CONFIG.get("WARM_UP_ON_START"):
+        warm_up_once()
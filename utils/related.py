@@ -0,0 +1,310 @@
+import os, re, json, math, zlib, logging, threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+import numpy as np
+from utils.vault_index import VaultIndex, get_vault_index
+from utils.file_lock import lock_file, unlock_file
+
+config = json.load(open("config.json"))
+RELATED_CONFIG = config["RELATED"]
+
+logger = logging.getLogger(__name__)
+
+TOKEN = re.compile(r"[^\W\d_]{2,}", re.UNICODE)
+INITIAL_ROWS = 1024
+
+
+class RelatedNotes:
+    """
+    Local similarity index over the notes of a vault, for "related notes" suggestions.
+
+    Every note is a feature-hashed term-frequency vector (``RELATED.DIMENSIONS``
+    buckets, sublinear counts, signed hashing) stored as float16 in a
+    memory-mapped file, one row per note. Document frequencies are kept per
+    bucket, so TF-IDF weights and cosine similarities are computed at query
+    time and stay right as the vault grows. A query scans the rows in blocks of
+    ``RELATED.BLOCK_ROWS``, so memory use is bounded whatever the vault size.
+
+    Notes come from the vault index (:class:`utils.vault_index.VaultIndex`),
+    whose full-text table also provides their text; a note is vectorized again
+    only when its size or mtime changed.
+
+    The app and ``cli.py batch``/``watch`` share these files, so every read and
+    write happens under an OS lock on a sidecar file, and picks up what another
+    process changed since: the vectors are mapped again when the file size moved
+    and the document frequencies are reloaded when their file was replaced.
+
+    Args:
+        index (VaultIndex): Index of the vault the notes belong to
+    """
+
+    def __init__(self, index: VaultIndex):
+        self.index = index
+        self.dimensions = RELATED_CONFIG["DIMENSIONS"]
+        base = os.path.splitext(index.path)[0]
+        self.vectors_path = base + ".vectors.f16"
+        self.df_path = base + ".df.npy"
+        self.lock_path = base + ".related.lock"
+        self._lock = threading.RLock()
+        self._vectors = None
+        self._df = None
+        self._df_stamp = None
+
+    def _connect(self):
+        conn = self.index._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            "note_id INTEGER PRIMARY KEY, row INTEGER NOT NULL UNIQUE, size INTEGER NOT NULL, mtime REAL NOT NULL)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY)")
+        return conn
+
+    @contextmanager
+    def _locked(self):
+        """Hold the index across threads and processes, with the vectors and document frequencies up to date."""
+        with self.index._lock, self._lock:
+            # Connecting first creates the cache folder the lock file lives in
+            conn = self._connect()
+            with open(self.lock_path, "a+b") as file:
+                lock_file(file)
+                try:
+                    self._open(conn)
+                    yield conn
+                finally:
+                    unlock_file(file)
+
+    def _open(self, conn):
+        row_bytes = 2 * self.dimensions
+        size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        if self._vectors is None or size != len(self._vectors) * row_bytes:
+            # First use, or another process grew the file (or started it over)
+            self._vectors = None
+            rows = size // row_bytes
+            if not rows or size != rows * row_bytes:
+                # Missing, or written with another RELATED.DIMENSIONS: start over
+                conn.execute("DELETE FROM vectors")
+                conn.execute("DELETE FROM free_rows")
+                with open(self.vectors_path, "wb") as f:
+                    f.truncate(INITIAL_ROWS * row_bytes)
+                rows = INITIAL_ROWS
+                self._df = None
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r+", shape=(rows, self.dimensions))
+        self._load_df(conn)
+
+    def _df_file_stamp(self):
+        try:
+            stat = os.stat(self.df_path)
+        except OSError:
+            return None
+        # Saved by replacing the file, so a new save always shows up as a new inode or mtime
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load_df(self, conn):
+        stamp = self._df_file_stamp()
+        if self._df is not None and stamp is not None and stamp == self._df_stamp:
+            return
+        count = conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+        try:
+            saved = np.load(self.df_path)
+            if saved.shape == (self.dimensions + 1,) and saved[-1] == count:
+                self._df, self._df_stamp = saved[:-1], stamp
+                return
+        except (OSError, ValueError):
+            pass
+        # Missing or out of step with the rows after a crash: count again
+        self._df = np.zeros(self.dimensions)
+        for start in range(0, len(self._vectors), RELATED_CONFIG["BLOCK_ROWS"]):
+            self._df += (self._vectors[start:start + RELATED_CONFIG["BLOCK_ROWS"]] != 0).sum(axis=0)
+        self._save_df(conn)
+
+    def _save_df(self, conn):
+        self._vectors.flush()
+        count = conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+        temp_path = self.df_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, np.append(self._df, count))
+        os.replace(temp_path, self.df_path)
+        self._df_stamp = self._df_file_stamp()
+
+    def _grow(self, rows: int):
+        self._vectors.flush()
+        self._vectors = None
+        row_bytes = 2 * self.dimensions
+        with open(self.vectors_path, "r+b") as f:
+            # Never shrink the file: rows past ours may belong to another process
+            current = os.fstat(f.fileno()).st_size
+            size = max(rows * row_bytes, current)
+            if size > current:
+                f.truncate(size)
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r+", shape=(size // row_bytes, self.dimensions))
+
+    def vectorize(self, text: str) -> np.ndarray:
+        """Hashed, sublinear term frequencies of ``text``."""
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        counts = Counter(TOKEN.findall(text.lower()))
+        if not counts:
+            return vector
+        hashes = np.fromiter((zlib.crc32(token.encode("utf-8")) for token in counts), dtype=np.uint32, count=len(counts))
+        weights = 1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+        # The top bit picks the sign, so colliding terms tend to cancel rather than pile up
+        signs = np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)
+        np.add.at(vector, hashes % self.dimensions, weights * signs)
+        return vector
+
+    def _store(self, conn, note_id: int, vector: np.ndarray, size: int, mtime: float):
+        row = conn.execute("SELECT row FROM vectors WHERE note_id = ?", (note_id,)).fetchone()
+        if row:
+            row = row[0]
+            self._df -= self._vectors[row] != 0
+        else:
+            free = conn.execute("SELECT MIN(row) FROM free_rows").fetchone()[0]
+            if free is not None:
+                row = free
+                conn.execute("DELETE FROM free_rows WHERE row = ?", (row,))
+            else:
+                row = conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM vectors").fetchone()[0]
+                if row >= len(self._vectors):
+                    self._grow(2 * len(self._vectors))
+        self._vectors[row] = vector
+        self._df += vector != 0
+        conn.execute("INSERT OR REPLACE INTO vectors(note_id, row, size, mtime) VALUES (?, ?, ?, ?)", (note_id, row, size, mtime))
+
+    def _drop(self, conn, note_id: int, row: int):
+        self._df -= self._vectors[row] != 0
+        self._vectors[row] = 0
+        conn.execute("DELETE FROM vectors WHERE note_id = ?", (note_id,))
+        conn.execute("INSERT OR IGNORE INTO free_rows(row) VALUES (?)", (row,))
+
+    def _update(self, conn, where: str = "1", params=()):
+        changed = conn.execute(
+            "SELECT n.id, n.size, n.mtime FROM notes n LEFT JOIN vectors v ON v.note_id = n.id "
+            f"WHERE ({where}) AND (v.note_id IS NULL OR v.size != n.size OR v.mtime != n.mtime)",
+            params,
+        ).fetchall()
+        gone = conn.execute("SELECT v.note_id, v.row FROM vectors v LEFT JOIN notes n ON n.id = v.note_id WHERE n.id IS NULL").fetchall()
+        if not changed and not gone:
+            return
+        try:
+            with self.index._transaction(conn):
+                for note_id, row in gone:
+                    self._drop(conn, note_id, row)
+                for note_id, size, mtime in changed:
+                    # One body at a time, so a first build of a large vault does not hold every note in memory
+                    body = conn.execute("SELECT body FROM notes_fts WHERE rowid = ?", (note_id,)).fetchone()
+                    self._store(conn, note_id, self.vectorize(body[0] if body else ""), size, mtime)
+        except BaseException:
+            # The rows were rolled back but the counts in memory were not: reload the saved ones on next use
+            self._df = None
+            raise
+        self._save_df(conn)
+        logger.info("Related notes: vectorized %d note(s), dropped %d", len(changed), len(gone))
+
+    def sync(self):
+        """Bring the vectors in line with the vault, vectorizing only new and changed notes."""
+        self.index._sync_notes()
+        with self._locked() as conn:
+            self._update(conn)
+
+    def update_note(self, path: str):
+        """Vectorize one note right after it was written and indexed."""
+        with self._locked() as conn:
+            self._update(conn, "n.path = ?", (self.index._relative(path),))
+
+    def _search(self, conn, query: np.ndarray, k: int, exclude_row: Optional[int] = None) -> List[Dict[str, Any]]:
+        count = conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+        used = conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM vectors").fetchone()[0]
+        if not count or not query.any():
+            return []
+        weights = (np.log((1 + count) / (1 + self._df)) + 1) ** 2
+        weighted_query = query * weights
+        query_norm = math.sqrt(float(query * query @ weights))
+
+        best_rows, best_scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        block_rows = RELATED_CONFIG["BLOCK_ROWS"]
+        for start in range(0, used, block_rows):
+            block = np.asarray(self._vectors[start:min(start + block_rows, used)], dtype=np.float32)
+            norms = np.sqrt((block * block) @ weights)
+            scores = (block @ weighted_query) / np.maximum(norms * query_norm, 1e-9)
+            if exclude_row is not None and start <= exclude_row < start + len(block):
+                scores[exclude_row - start] = 0
+            top = np.argpartition(-scores, min(k, len(scores) - 1))[:k]
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+            keep = np.argsort(-best_scores)[:k]
+            best_rows, best_scores = best_rows[keep], best_scores[keep]
+
+        results = []
+        for row, score in zip(best_rows.tolist(), best_scores.tolist()):
+            if score < RELATED_CONFIG["MIN_SCORE"]:
+                break
+            found = conn.execute("SELECT n.path FROM vectors v JOIN notes n ON n.id = v.note_id WHERE v.row = ?", (row,)).fetchone()
+            if found:
+                results.append({"path": self.index._absolute(found[0]), "link": os.path.splitext(found[0])[0].replace(os.sep, "/"), "score": score})
+        return results
+
+    def related(self, path: str, k: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Notes most similar to the note at ``path``, best first.
+
+        Returns:
+            list: Up to ``k`` (default ``RELATED.TOP_K``) dicts with ``path``, ``link`` (the
+                vault-relative wikilink target) and ``score`` (cosine similarity)
+        """
+        self.sync()
+        with self._locked() as conn:
+            row = conn.execute(
+                "SELECT v.row FROM vectors v JOIN notes n ON n.id = v.note_id WHERE n.path = ?", (self.index._relative(path),)
+            ).fetchone()
+            if row is None:
+                return []
+            query = np.asarray(self._vectors[row[0]], dtype=np.float32)
+            return self._search(conn, query, k or RELATED_CONFIG["TOP_K"], exclude_row=row[0])
+
+    def suggest(self, text: str, exclude: Optional[str] = None, k: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Notes most similar to ``text``, e.g. a section about to be written, without syncing first.
+
+        Args:
+            text (str): Text to find related notes for
+            exclude (str): Path of a note to leave out, typically the one being written
+            k (int): Number of notes, defaults to ``RELATED.TOP_K``
+        """
+        k = k or RELATED_CONFIG["TOP_K"]
+        with self._locked() as conn:
+            exclude_row = None
+            if exclude:
+                row = conn.execute(
+                    "SELECT v.row FROM vectors v JOIN notes n ON n.id = v.note_id WHERE n.path = ?", (self.index._relative(exclude),)
+                ).fetchone()
+                exclude_row = row[0] if row else None
+            return self._search(conn, self.vectorize(text), k, exclude_row)
+
+
+_related = {}
+_related_lock = threading.Lock()
+
+
+def get_related_notes(root: str) -> RelatedNotes:
+    """Shared related-notes index for the vault at ``root``, one per process."""
+    index = get_vault_index(root)
+    with _related_lock:
+        if index.path not in _related:
+            _related[index.path] = RelatedNotes(index)
+        return _related[index.path]
+
+
+def related_links(root: str, note_path: str, text: str) -> str:
+    """
+    Markdown line linking the notes most related to ``text``, to add to a section of ``note_path``.
+
+    Returns:
+        str: ``**Related:** [[...]], ...`` line, or an empty string when ``RELATED.LINK_ON_WRITE``
+            is off or nothing is similar enough
+    """
+    if not RELATED_CONFIG["LINK_ON_WRITE"]:
+        return ""
+    suggestions = get_related_notes(root).suggest(text, exclude=note_path)
+    if not suggestions:
+        return ""
+    return "\n**Related:** " + ", ".join(f"[[{suggestion['link']}]]" for suggestion in suggestions) + "\n"
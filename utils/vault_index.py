@@ -0,0 +1,361 @@
+import os, re, json, time, hashlib, sqlite3, logging, threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from utils.cache import CACHE_DIR
+
+config = json.load(open("config.json"))
+VAULT_INDEX_CONFIG = config["VAULT_INDEX"]
+SEARCH_CONFIG = config["SEARCH"]
+
+# Words of a search query; everything else (FTS5 operators, quotes) is dropped
+QUERY_TERM = re.compile(r"\w+", re.UNICODE)
+# Heading markers, which would turn a one-line snippet into a heading
+SNIPPET_HEADING = re.compile(r"(?<!\S)#{1,6}\s")
+
+logger = logging.getLogger(__name__)
+
+
+def _skipped(name: str, is_dir: bool) -> bool:
+    # Hidden entries, the asset store and desktop.ini files never show up in the vault views
+    return name.startswith('.') or (is_dir and name == 'assets') or (not is_dir and name.endswith('.ini'))
+
+
+class VaultIndex:
+    """
+    Persistent index of a vault's folders and files, kept current from directory mtimes.
+
+    Adding, removing or renaming an entry changes the mtime of the directory it
+    is in, so a directory is only listed again when its own mtime moved; an
+    unchanged vault costs one ``stat`` per folder to check, and the file listing
+    of a folder is answered from SQLite one page at a time. Sizes and mtimes of
+    the files on the requested page are refreshed when they are shown, since
+    editing a file in place does not touch its directory.
+
+    Args:
+        root (str): Vault root
+        path (str): Location of the SQLite file, defaults to one file per vault under the cache folder
+    """
+
+    def __init__(self, root: str, path: Optional[str] = None):
+        self.root = os.path.normpath(root)
+        digest = hashlib.sha256(os.path.normcase(self.root).encode("utf-8")).hexdigest()[:16]
+        self.path = path or os.path.join(CACHE_DIR, f"vault_index_{digest}.sqlite3")
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        self._tree_checked = 0.0
+        self._notes_checked = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "parent TEXT NOT NULL, name TEXT NOT NULL, is_dir INTEGER NOT NULL, size INTEGER NOT NULL, "
+                "mtime REAL NOT NULL, PRIMARY KEY (parent, name))"
+            )
+            conn.execute("INSERT OR IGNORE INTO dirs(path, mtime_ns) VALUES ('', NULL)")
+            # Full-text index of the notes; a note's rowid in notes_fts is its id in notes
+            conn.execute("CREATE TABLE IF NOT EXISTS notes (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, size INTEGER NOT NULL, mtime REAL NOT NULL)")
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(title, body, tokenize='porter unicode61 remove_diacritics 2')")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    @contextmanager
+    def _transaction(conn: sqlite3.Connection):
+        """
+        Write transaction on ``conn``, committed on success and rolled back on any error.
+
+        The write lock is taken up front (``BEGIN IMMEDIATE``), so another process
+        writing to the index makes this one wait out the busy timeout instead of
+        failing halfway with "database is locked"; and a failed transaction never
+        stays open on the shared connection, which would break every later ``BEGIN``.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    def _relative(self, path: str) -> str:
+        relative = os.path.relpath(os.path.normpath(path), self.root)
+        return "" if relative == "." else relative
+
+    def _absolute(self, relative: str) -> str:
+        return os.path.join(self.root, relative) if relative else self.root
+
+    @staticmethod
+    def _subtree(relative: str) -> Tuple[str, Tuple[str, str, str]]:
+        # Everything at or below ``relative``: the path itself, or paths between "relative/" and "relative0"
+        if not relative:
+            return "1", ()
+        return "(path = ? OR (path > ? AND path < ?))", (relative, relative + os.sep, relative + chr(ord(os.sep) + 1))
+
+    def _forget(self, conn, relative: str):
+        where, params = self._subtree(relative)
+        conn.execute(f"DELETE FROM dirs WHERE {where}", params)
+        conn.execute(f"DELETE FROM entries WHERE {where.replace('path', 'parent')}", params)
+
+    def _sync_dir(self, relative: str) -> List[str]:
+        """
+        List ``relative`` again if its mtime moved since it was indexed.
+
+        Returns:
+            list: Sub-folders that were added and still have to be listed
+        """
+        conn = self._connect()
+        row = conn.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (relative,)).fetchone()
+        try:
+            mtime_ns = os.stat(self._absolute(relative)).st_mtime_ns
+        except OSError:
+            if relative:
+                with self._transaction(conn):
+                    self._forget(conn, relative)
+                    conn.execute("DELETE FROM entries WHERE parent = ? AND name = ?", (os.path.dirname(relative), os.path.basename(relative)))
+            return []
+        if row is not None and row[0] == mtime_ns:
+            return []
+
+        entries = []
+        try:
+            with os.scandir(self._absolute(relative)) as scan:
+                for entry in scan:
+                    try:
+                        is_dir = entry.is_dir()
+                        if _skipped(entry.name, is_dir):
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((relative, entry.name, int(is_dir), 0 if is_dir else stat.st_size, stat.st_mtime))
+        except OSError as e:
+            logger.warning("Could not list %s: %s", self._absolute(relative), e)
+            return []
+
+        folders = {os.path.join(relative, name) for _, name, is_dir, _, _ in entries if is_dir}
+        known = {os.path.join(relative, name) for name, in conn.execute("SELECT name FROM entries WHERE parent = ? AND is_dir = 1", (relative,))}
+        with self._transaction(conn):
+            for gone in known - folders:
+                self._forget(conn, gone)
+            conn.executemany("INSERT OR IGNORE INTO dirs(path, mtime_ns) VALUES (?, NULL)", [(folder,) for folder in folders - known])
+            conn.execute("DELETE FROM entries WHERE parent = ?", (relative,))
+            conn.executemany("INSERT INTO entries(parent, name, is_dir, size, mtime) VALUES (?, ?, ?, ?, ?)", entries)
+            conn.execute("INSERT OR REPLACE INTO dirs(path, mtime_ns) VALUES (?, ?)", (relative, mtime_ns))
+        return sorted(folders - known)
+
+    def refresh(self, force: bool = False):
+        """
+        Bring the whole index up to date, at most once every ``VAULT_INDEX.REFRESH_SECONDS`` unless ``force``.
+
+        Every indexed folder is checked with one ``stat``; only folders whose
+        mtime moved are listed again, and new folders found on the way are
+        indexed right away.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._tree_checked < VAULT_INDEX_CONFIG["REFRESH_SECONDS"]:
+                return
+            started = time.perf_counter()
+            pending = [path for path, in self._connect().execute("SELECT path FROM dirs ORDER BY path")]
+            while pending:
+                pending.extend(self._sync_dir(pending.pop()))
+            self._tree_checked = time.monotonic()
+            logger.info("Vault index of %s refreshed in %.3fs", self.root, time.perf_counter() - started)
+
+    def invalidate(self):
+        """Make the next :meth:`refresh` check the folders again, e.g. after the app changed the vault."""
+        self._tree_checked = 0.0
+
+    def folders(self) -> List[str]:
+        """Relative paths of every folder in the vault, sorted."""
+        self.refresh()
+        with self._lock:
+            return [path for path, in self._connect().execute("SELECT path FROM dirs WHERE path != '' ORDER BY path")]
+
+    def list_dir(self, path: str, offset: int = 0, limit: Optional[int] = None) -> Tuple[int, List[Dict[str, Any]]]:
+        """
+        One page of a folder's entries, folders first, then by case-insensitive name.
+
+        Args:
+            path (str): Absolute path of the folder
+            offset (int): Entries to skip
+            limit (int): Entries to return, all when ``None``
+
+        Returns:
+            tuple: Total number of entries in the folder and the requested page, as dicts
+                with ``name``, ``path``, ``is_directory``, ``size`` and ``modified``
+        """
+        relative = self._relative(path)
+        if relative.startswith(os.pardir) or not os.path.isdir(path):
+            return 0, []
+        with self._lock:
+            if relative:
+                # A folder opened from the explorer may not have been indexed yet
+                self._connect().execute("INSERT OR IGNORE INTO dirs(path, mtime_ns) VALUES (?, NULL)", (relative,))
+            self._sync_dir(relative)
+            conn = self._connect()
+            total = conn.execute("SELECT COUNT(*) FROM entries WHERE parent = ?", (relative,)).fetchone()[0]
+            rows = conn.execute(
+                "SELECT name, is_dir, size, mtime FROM entries WHERE parent = ? "
+                "ORDER BY is_dir DESC, name COLLATE NOCASE LIMIT ? OFFSET ?",
+                (relative, -1 if limit is None else limit, offset),
+            ).fetchall()
+
+            items, updates = [], []
+            for name, is_dir, size, mtime in rows:
+                full_path = os.path.join(path, name)
+                if not is_dir:
+                    try:
+                        stat = os.stat(full_path)
+                    except OSError:
+                        continue
+                    if (stat.st_size, stat.st_mtime) != (size, mtime):
+                        size, mtime = stat.st_size, stat.st_mtime
+                        updates.append((size, mtime, relative, name))
+                items.append({'name': name, 'path': full_path, 'is_directory': bool(is_dir), 'size': size, 'modified': mtime})
+            if updates:
+                conn.executemany("UPDATE entries SET size = ?, mtime = ? WHERE parent = ? AND name = ?", updates)
+        return total, items
+
+    def _index_note(self, conn, relative: str, stat=None):
+        full_path = self._absolute(relative)
+        try:
+            stat = stat or os.stat(full_path)
+            with open(full_path, "r", encoding="utf-8", errors="replace") as f:
+                body = f.read()
+        except OSError:
+            self._drop_note(conn, relative)
+            return
+        row = conn.execute("SELECT id FROM notes WHERE path = ?", (relative,)).fetchone()
+        if row:
+            conn.execute("DELETE FROM notes_fts WHERE rowid = ?", (row[0],))
+            conn.execute("UPDATE notes SET size = ?, mtime = ? WHERE id = ?", (stat.st_size, stat.st_mtime, row[0]))
+            note_id = row[0]
+        else:
+            note_id = conn.execute("INSERT INTO notes(path, size, mtime) VALUES (?, ?, ?)", (relative, stat.st_size, stat.st_mtime)).lastrowid
+        conn.execute("INSERT INTO notes_fts(rowid, title, body) VALUES (?, ?, ?)", (note_id, os.path.splitext(os.path.basename(relative))[0], body))
+        # Appending to a note leaves its folder's mtime alone, so the listing would otherwise keep the old
+        # size and mtime and every later sync would index the note again
+        conn.execute(
+            "UPDATE entries SET size = ?, mtime = ? WHERE parent = ? AND name = ?",
+            (stat.st_size, stat.st_mtime, os.path.dirname(relative), os.path.basename(relative)),
+        )
+
+    def _drop_note(self, conn, relative: str):
+        row = conn.execute("SELECT id FROM notes WHERE path = ?", (relative,)).fetchone()
+        if row:
+            conn.execute("DELETE FROM notes_fts WHERE rowid = ?", (row[0],))
+            conn.execute("DELETE FROM notes WHERE id = ?", (row[0],))
+
+    def index_note(self, path: str):
+        """(Re-)index one note right after it was written, so it can be found before the next refresh."""
+        relative = self._relative(path)
+        if relative.startswith(os.pardir):
+            return
+        with self._lock:
+            conn = self._connect()
+            with self._transaction(conn):
+                self._index_note(conn, relative)
+
+    def _sync_notes(self):
+        """
+        Bring the full-text index in line with the folder index.
+
+        Notes that appeared, disappeared or changed size or mtime in a listed
+        folder are (re-)indexed. Notes edited in place do not touch their folder,
+        so every ``SEARCH.RESCAN_SECONDS`` each indexed note is also checked with
+        a ``stat``.
+        """
+        self.refresh()
+        with self._lock:
+            conn = self._connect()
+            indexed = {path: (size, mtime) for path, size, mtime in conn.execute("SELECT path, size, mtime FROM notes")}
+            listed = {
+                os.path.join(parent, name): (size, mtime)
+                for parent, name, size, mtime in conn.execute("SELECT parent, name, size, mtime FROM entries WHERE is_dir = 0 AND name LIKE '%.md'")
+            }
+            changed = [path for path, state in listed.items() if indexed.get(path) != state]
+            gone = [path for path in indexed if path not in listed]
+
+            rescan = time.monotonic() - self._notes_checked >= SEARCH_CONFIG["RESCAN_SECONDS"]
+            stats = {}
+            if rescan:
+                unchanged = set(listed) - set(changed)
+                for path, state in indexed.items():
+                    if path not in unchanged:
+                        continue
+                    try:
+                        stat = os.stat(self._absolute(path))
+                    except OSError:
+                        gone.append(path)
+                        continue
+                    if (stat.st_size, stat.st_mtime) != state:
+                        changed.append(path)
+                        stats[path] = stat
+
+            if changed or gone:
+                started = time.perf_counter()
+                with self._transaction(conn):
+                    for path in gone:
+                        self._drop_note(conn, path)
+                    for path in changed:
+                        self._index_note(conn, path, stats.get(path))
+                logger.info("Indexed %d note(s) and dropped %d in %.3fs", len(changed), len(gone), time.perf_counter() - started)
+            if rescan:
+                self._notes_checked = time.monotonic()
+
+    def search(self, query: str, offset: int = 0, limit: int = 10) -> Tuple[int, List[Dict[str, Any]]]:
+        """
+        Full-text search over the notes of the vault, best matches first.
+
+        Every word of ``query`` must occur in the note (the last one as a
+        prefix, so results show up while typing). Matches in the title weigh
+        more than matches in the body.
+
+        Args:
+            query (str): Words to look for
+            offset (int): Results to skip
+            limit (int): Results to return
+
+        Returns:
+            tuple: Total number of matching notes and the requested page, as dicts with
+                ``name``, ``path``, ``snippet`` (matches wrapped in ``**``) and ``modified``
+        """
+        terms = QUERY_TERM.findall(query)
+        if not terms:
+            return 0, []
+        match = " ".join(f'"{term}"' for term in terms) + "*"
+        self._sync_notes()
+        with self._lock:
+            conn = self._connect()
+            total = conn.execute("SELECT COUNT(*) FROM notes_fts WHERE notes_fts MATCH ?", (match,)).fetchone()[0]
+            rows = conn.execute(
+                "SELECT n.path, n.mtime, snippet(notes_fts, 1, '**', '**', '…', ?) FROM notes_fts "
+                "JOIN notes n ON n.id = notes_fts.rowid WHERE notes_fts MATCH ? "
+                "ORDER BY bm25(notes_fts, ?, 1.0) LIMIT ? OFFSET ?",
+                (SEARCH_CONFIG["SNIPPET_TOKENS"], match, SEARCH_CONFIG["TITLE_WEIGHT"], limit, offset),
+            ).fetchall()
+        return total, [
+            {'name': os.path.basename(path), 'path': self._absolute(path), 'snippet': SNIPPET_HEADING.sub("", " ".join(snippet.split())), 'modified': mtime}
+            for path, mtime, snippet in rows
+        ]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_vault_index(root: str) -> VaultIndex:
+    """Shared index for the vault at ``root``, one per process."""
+    key = os.path.normcase(os.path.normpath(root))
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = VaultIndex(root)
+        return _indexes[key]
@@ -0,0 +1,196 @@
+import os, json, time, hashlib, logging, threading
+from typing import Dict, List, Optional
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+from utils.cache import DiskCache, CACHE_DIR
+from utils.pipeline import take_notes, LocalFile
+
+config = json.load(open("config.json"))
+WATCHER_CONFIG = config["WATCHER"]
+
+SUPPORTED_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg")
+
+logger = logging.getLogger(__name__)
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _InboxHandler(FileSystemEventHandler):
+    def __init__(self, watcher, inbox):
+        self.watcher = watcher
+        self.inbox = inbox
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher.touch(self.inbox, event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.touch(self.inbox, event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.watcher.touch(self.inbox, event.dest_path)
+
+
+class InboxWatcher:
+    """
+    Turn PDFs and images dropped into inbox folders into notes as they arrive.
+
+    Filesystem events mark files as pending; a file is only processed once it
+    has seen no events for ``debounce`` seconds and its size and mtime are
+    stable, so partially written or still-copying files are left alone. Notes
+    are written to a vault folder mirroring the file's place inside the inbox,
+    one note per file, and the content hash of every ingested file is remembered
+    so unchanged files are never processed twice.
+
+    Args:
+        folders (list): ``{"INBOX": ..., "VAULT_FOLDER": ...}`` mappings to watch
+        vault_path (str): Vault root the ``VAULT_FOLDER`` entries are relative to
+        model_generation (str): Model used to generate notes
+        model_formatting (str): Model used to format notes
+        ocr_enhance (bool): Force OCR on PDFs with a text layer
+        hedge (bool): Hedge slow requests with the next model of HEDGING.FALLBACK_CHAIN
+        debounce (float): Quiet period in seconds before a file is picked up
+        polling (bool): Poll instead of using native change notifications (network shares)
+    """
+
+    def __init__(
+        self,
+        folders: List[Dict[str, str]],
+        vault_path: str,
+        model_generation: str,
+        model_formatting: Optional[str] = None,
+        ocr_enhance: bool = False,
+        hedge: bool = False,
+        debounce: float = WATCHER_CONFIG["DEBOUNCE_SECONDS"],
+        polling: bool = False,
+    ):
+        self.folders = [{"INBOX": os.path.abspath(folder["INBOX"]), "VAULT_FOLDER": folder["VAULT_FOLDER"]} for folder in folders]
+        self.vault_path = vault_path
+        self.model_generation = model_generation
+        self.model_formatting = model_formatting or model_generation
+        self.ocr_enhance = ocr_enhance
+        self.hedge = hedge
+        self.debounce = debounce
+        self.observer = PollingObserver() if polling else Observer()
+        self.ingested = DiskCache(os.path.join(CACHE_DIR, "watcher.sqlite3"))
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def touch(self, inbox: str, path: str):
+        """Record activity on ``path``; it is processed once it has settled."""
+        if not path.lower().endswith(SUPPORTED_EXTENSIONS) or os.path.basename(path).startswith('.'):
+            return
+        with self._lock:
+            self._pending[path] = {"inbox": inbox, "last_event": time.monotonic(), "stat": None}
+        self._wake.set()
+
+    def _settled(self) -> List[Dict[str, str]]:
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, entry in list(self._pending.items()):
+                if now - entry["last_event"] < self.debounce:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self._pending[path]
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if signature != entry["stat"]:
+                    # Still growing (or first look): check again after another quiet period
+                    entry["stat"], entry["last_event"] = signature, now
+                    continue
+                del self._pending[path]
+                ready.append({"path": path, "inbox": entry["inbox"]})
+        return ready
+
+    def _target(self, inbox: str, path: str):
+        folder = next(folder for folder in self.folders if folder["INBOX"] == inbox)
+        relative_dir = os.path.relpath(os.path.dirname(path), inbox)
+        vault_folder = os.path.normpath(os.path.join(self.vault_path, folder["VAULT_FOLDER"], relative_dir))
+        title = os.path.splitext(os.path.basename(path))[0]
+        return title, vault_folder
+
+    def _ingest(self, ready: List[Dict[str, str]]):
+        batch = []
+        for entry in ready:
+            try:
+                digest = _file_digest(entry["path"])
+            except OSError as e:
+                logger.error("Could not read %s: %s", entry["path"], e)
+                continue
+            if self.ingested.get(digest) is not None:
+                logger.info("Skipping already ingested file: %s", entry["path"])
+                continue
+            batch.append({**entry, "digest": digest})
+        if not batch:
+            return
+
+        targets = [self._target(entry["inbox"], entry["path"]) for entry in batch]
+        print(f"Taking notes for {len(batch)} new file(s)")
+        results = take_notes(
+            [LocalFile(entry["path"]) for entry in batch],
+            title=[title for title, _ in targets],
+            vault_path=[vault_folder for _, vault_folder in targets],
+            model_generation=self.model_generation,
+            model_formatting=self.model_formatting,
+            ocr_enhance=self.ocr_enhance,
+            hedge=self.hedge,
+        )
+        for entry, result in zip(batch, results):
+            if result["note_path"]:
+                self.ingested.set(entry["digest"], result["note_path"].encode("utf-8"))
+                print(f"{entry['path']} -> {result['note_path']}")
+            else:
+                print(f"{entry['path']}: failed ({result['error']})")
+
+    def _initial_scan(self):
+        # One pass at start-up picks up files dropped while the watcher was down
+        for folder in self.folders:
+            for root, dirs, files in os.walk(folder["INBOX"]):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                for name in files:
+                    self.touch(folder["INBOX"], os.path.join(root, name))
+
+    def run(self, initial_scan: bool = True):
+        """Watch until :meth:`stop` is called or the process is interrupted."""
+        for folder in self.folders:
+            os.makedirs(folder["INBOX"], exist_ok=True)
+            self.observer.schedule(_InboxHandler(self, folder["INBOX"]), folder["INBOX"], recursive=True)
+            print(f"Watching {folder['INBOX']} -> {os.path.join(self.vault_path, folder['VAULT_FOLDER'])}")
+        self.observer.start()
+        if initial_scan:
+            self._initial_scan()
+
+        try:
+            while not self._stopped.is_set():
+                # Sleep until something happens; with pending files, wake up to re-check them
+                with self._lock:
+                    timeout = self.debounce if self._pending else 60
+                self._wake.wait(timeout)
+                self._wake.clear()
+                ready = self._settled()
+                if ready:
+                    try:
+                        self._ingest(ready)
+                    except Exception as e:
+                        logger.error("Error ingesting files: %s", e, exc_info=True)
+        finally:
+            self.observer.stop()
+            self.observer.join()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()